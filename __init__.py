@@ -13,20 +13,15 @@ helpers/entity_registry
 """
 
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.const import CONF_TYPE, Platform
+from homeassistant.const import Platform
 from homeassistant.core import HomeAssistant
-from homeassistant.helpers.entity_platform import AddEntitiesCallback
-from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
+from homeassistant.helpers.typing import ConfigType
 
-from homeassistant.helpers.area_registry import AreaEntry, AreaRegistry
-import homeassistant.helpers.area_registry as area_registry
-
-from .const import DOMAIN, CONF_POLLING, CONF_SYNC_ROOMS
-from .light import KlyqaLight
+from .const import DOMAIN, CONF_PUSH, CONF_SYNC_ROOMS
 from .api import Klyqa
+from .services import async_setup_services, async_unload_services
 
 from homeassistant.const import (
-    ATTR_ENTITY_ID,
     CONF_HOST,
     CONF_PASSWORD,
     CONF_USERNAME,
@@ -36,7 +31,7 @@ from homeassistant.const import (
 
 # TODO List the platforms that you want to support.
 # For your initial PR, limit it to 1 platform.
-PLATFORMS: list[Platform] = [Platform.LIGHT]
+PLATFORMS: list[Platform] = [Platform.LIGHT, Platform.SENSOR]
 
 
 async def async_setup(hass: HomeAssistant, yaml_config: ConfigType) -> bool:
@@ -54,15 +49,17 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     sync_rooms = (
         entry.data.get(CONF_SYNC_ROOMS) if entry.data.get(CONF_SYNC_ROOMS) else False
     )
+    push_notifications = bool(entry.data.get(CONF_PUSH))
     klyqa_api: Klyqa
     if DOMAIN in hass.data:
         klyqa_api = hass.data[DOMAIN]
-        await hass.async_add_executor_job(klyqa_api.shutdown)
+        await klyqa_api.async_stop(executor=False)
 
         klyqa_api._username = username
         klyqa_api._password = password
         klyqa_api._host = host
         klyqa_api.sync_rooms = sync_rooms
+        klyqa_api.push_notifications = push_notifications
     else:
         klyqa_api: Klyqa = await hass.async_add_executor_job(
             Klyqa,
@@ -72,16 +69,18 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
             hass,
             False,
             sync_rooms,
+            push_notifications,
         )
         hass.data[DOMAIN] = klyqa_api
 
-    if not await hass.async_add_executor_job(
-        klyqa_api.login,
-    ):
-        return False
+    # With the settings of the last run the lights are set up right away, the
+    # login and the settings refresh run with the bulb search.
+    if not await klyqa_api.async_load_cached_settings():
+        if not await klyqa_api.executor.async_add_job(klyqa_api.login):
+            return False
+        await klyqa_api.executor.async_add_job(klyqa_api.load_settings)
 
     hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, klyqa_api.shutdown)
-    await hass.async_add_executor_job(klyqa_api.load_settings)
     # await hass.async_add_executor_job(klyqa.search_lights)
 
     # hass.data.setdefault(DOMAIN, {})[entry.entry_id] = co
@@ -93,6 +92,7 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
         )
 
     hass.config_entries.async_setup_platforms(entry, PLATFORMS)
+    async_setup_services(hass)
     entry.async_on_unload(entry.add_update_listener(async_reload_entry))
 
     return True
@@ -103,9 +103,9 @@ async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
 
     unload_ok = await hass.config_entries.async_unload_platforms(entry, PLATFORMS)
 
-    await hass.async_add_executor_job(hass.data[DOMAIN].shutdown)
-
-    hass.data.pop(DOMAIN)
+    async_unload_services(hass)
+    klyqa_api: Klyqa = hass.data.pop(DOMAIN)
+    await klyqa_api.async_stop()
 
     return unload_ok
 
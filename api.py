@@ -1,37 +1,76 @@
-import argparse
+from __future__ import annotations
+
 import asyncio
+import concurrent.futures
+import contextlib
 import datetime
 import json
-import pickle
 import select
 import socket
 import sys
 import time
-import traceback
 import os
 import errno
+import functools
+import hashlib
 import threading
 
 import uuid
-import requests
+from typing import TYPE_CHECKING
 
-from typing import Any, cast
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers import area_registry as ar
-
-# pycryptodome
-try:
-    from Cryptodome.Cipher import AES
-    from Cryptodome.Random import get_random_bytes
-except:
-    from Crypto.Cipher import AES
-    from Crypto.Random import get_random_bytes
-
-from .const import CONF_POLLING, DEFAULT_CACHEDB, DOMAIN, LOGGER
+from homeassistant.helpers.storage import Store
+
+# requests, argparse, pickle and the crypto library are imported where they
+# are used, importing the integration does not wait for them.
+from . import encoding
+from .const import DEFAULT_CACHEDB, LOGGER
+from .connections import ConnectionManager
+from .dispatch import GroupDispatcher
+from .effects import EffectEngine
+from .executor import KlyqaExecutor
+from .metrics import BulbMetrics, Metrics
+from .push import SettingsPush
+from .trace import RAW, RX, TX, FrameTrace
+from .stream import ColorStream
+
+if TYPE_CHECKING:
+    import argparse
 
 STATE_CONNECTED = "CONNECTED"
 STATE_WAIT_IV = "WAIT_IV"
 
+"""Round trip times above are capped when aligning synchronized commands."""
+SYNC_MAX_RTT = 0.2
+"""Seconds before a synchronized write that are waited busily instead of slept."""
+SYNC_SPIN = 0.002
+
+"""Seconds a bulb waits beyond the search time for its connection from a running search."""
+DISCOVERY_GRACE = 2.0
+
+"""Bytes a bulb connection may have waiting for its socket before sending is refused."""
+TX_BUFFER_LIMIT = 4096
+"""Seconds a command waits for the socket to take its bytes."""
+TX_TIMEOUT = 0.5
+"""Seconds a ping waits for the pong of the bulb."""
+PING_TIMEOUT = 0.5
+"""Seconds a confirmed bulb status is trusted to skip commands it already shows."""
+STATUS_FRESH = 5.0
+
+"""Seconds the account settings are used before the lights reload them."""
+SETTINGS_MAX_AGE = 60.0
+"""Storage of the last loaded settings, the lights start with them."""
+SETTINGS_STORE_KEY = "klyqa.settings"
+SETTINGS_STORE_VERSION = 1
+SETTINGS_SAVE_DELAY = 10
+
+"""Connections of answering bulbs the search may have waiting to be accepted."""
+DISCOVERY_BACKLOG = 1024
+
+"""File descriptors kept free besides one connection per bulb."""
+FD_RESERVE = 256
+
 SCENES = [
     {
         "id": 100,
@@ -211,129 +250,588 @@ def reply_field(reply, field) -> str:
 
 
 class Connection:
-    sending_aes = None
-    receiving_aes = None
-    state = ""
-    socket: socket.SocketType
-    address = ""
-    local_iv = ""
-    remote_iv = ""
-    u_id = ""
-
-
-def send_msg(socket, message, sending_aes) -> bool:
-    LOGGER.debug("Sending: " + message)
-    message_encoded = message.encode("utf-8")
-    while len(message_encoded) % 16:
-        message_encoded = message_encoded + bytes([0x20])
-
-    message_encrypted = sending_aes.encrypt(message_encoded)
-    retry_counter = 0
-
-    while retry_counter < 10:
+    """Tcp connection to a bulb with its AES session."""
+
+    __slots__ = (
+        "socket",
+        "address",
+        "u_id",
+        "state",
+        "local_iv",
+        "remote_iv",
+        "sending_aes",
+        "receiving_aes",
+        "rtt",
+        "tx_buffer",
+        "rx_buffer",
+        "last_seen",
+    )
+
+    def __init__(self, socket: socket.SocketType = None, address=""):
+        self.socket = socket
+        self.address = address
+        self.u_id = ""
+        self.state = ""
+        self.local_iv = ""
+        self.remote_iv = ""
+        self.sending_aes = None
+        self.receiving_aes = None
+        """Smoothed round trip time of the commands in seconds."""
+        self.rtt = 0.0
+        """Encrypted bytes waiting for the socket."""
+        self.tx_buffer = bytearray()
+        """Received bytes of an incomplete package, waiting for the rest of it."""
+        self.rx_buffer = b""
+        """Monotonic time of the last answer of the bulb."""
+        self.last_seen = 0.0
+
+
+class BulbStatus:
+    """Parsed status answer of a bulb."""
+
+    __slots__ = ("power", "mode", "rgb", "temperature", "brightness", "active_scene")
+
+    def __init__(
+        self,
+        power="",
+        mode="",
+        rgb=(0, 0, 0),
+        temperature=0,
+        brightness=0.0,
+        active_scene="",
+    ):
+        """
+        Args:
+            power (str): "on" or "off".
+            mode (str): "rgb", "cct" (temperature) or "cmd" (scene).
+            rgb (tuple): Color (red, green, blue) 0-255.
+            temperature (int): Kelvin.
+            brightness (float): Percent 0-100.
+            active_scene (str): Scene id in "cmd" mode.
+        """
+        self.power = power
+        self.mode = mode
+        self.rgb = rgb
+        self.temperature = temperature
+        self.brightness = brightness
+        self.active_scene = active_scene
+
+    @classmethod
+    def from_response(cls, response) -> BulbStatus | None:
+        """Parse the answer of the bulb, None if it is not a status."""
+        if not isinstance(response, dict) or response.get("type") != "status":
+            return None
+        color = response.get("color") or {}
+        return cls(
+            power=response.get("status", ""),
+            mode=response.get("mode", ""),
+            rgb=(
+                int(color.get("red", 0)),
+                int(color.get("green", 0)),
+                int(color.get("blue", 0)),
+            ),
+            temperature=int(response.get("temperature") or 0),
+            brightness=float((response.get("brightness") or {}).get("percentage", 0)),
+            active_scene=str(response.get("active_scene", "")),
+        )
+
+    def as_tuple(self) -> tuple:
+        return tuple(getattr(self, x) for x in self.__slots__)
+
+    def as_dict(self) -> dict:
+        """Json serializable fields, see from_dict."""
+        status = {x: getattr(self, x) for x in self.__slots__}
+        status["rgb"] = list(self.rgb)
+        return status
+
+    @classmethod
+    def from_dict(cls, status) -> BulbStatus | None:
+        """Status from the fields of as_dict, None if they are invalid."""
         try:
-            socket.send(
-                bytes(
-                    [len(message_encrypted) // 256, len(message_encrypted) % 256, 0, 2]
-                )
-                + message_encrypted
+            return cls(
+                power=str(status["power"]),
+                mode=str(status["mode"]),
+                rgb=tuple(int(x) for x in status["rgb"][:3]),
+                temperature=int(status["temperature"]),
+                brightness=float(status["brightness"]),
+                active_scene=str(status["active_scene"]),
             )
-            return True
-        except socket.timeout:
-            LOGGER.debug("Send timed out, retrying...")
-        except Exception as excp:
-            LOGGER.error("Could not send message on tcp connection...")
-            LOGGER.error(traceback.format_exc())
-        time.sleep(0.3)
-        retry_counter += 1
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, BulbStatus) and self.as_tuple() == other.as_tuple()
+
+    def __hash__(self) -> int:
+        return hash(self.as_tuple())
+
+    def __repr__(self) -> str:
+        return "BulbStatus" + repr(self.as_tuple())
+
+
+def encrypt_msg(message, sending_aes) -> bytes:
+    """Pad and encrypt the message and put the package header in front."""
+    LOGGER.debug("Sending: %s", message)
+    return encoding.encrypt_package(message, sending_aes)
+
 
+def send_msg(connection: Connection, message, timeout=TX_TIMEOUT) -> bool:
+    """Encrypt and send the message unless the connection is congested."""
+    if congested(connection):
+        return False
+    return send_package(
+        connection, encrypt_msg(message, connection.sending_aes), timeout
+    )
+
+
+def congested(connection: Connection, timeout=0.0) -> bool:
+    """
+    Flush the waiting bytes of the connection within timeout seconds and tell
+    if more than TX_BUFFER_LIMIT bytes are still waiting.
+
+    Check it before encrypting a message, an encrypted message has to be sent
+    as the chained cipher of the bulb expects it next.
+    """
+    if connection.tx_buffer:
+        flush_packages(connection, timeout)
+    if len(connection.tx_buffer) > TX_BUFFER_LIMIT:
+        LOGGER.debug(
+            "Connection to bulb %s congested, %s bytes waiting",
+            connection.u_id,
+            len(connection.tx_buffer),
+        )
+        return True
     return False
 
 
+def send_package(connection: Connection, package, timeout=TX_TIMEOUT) -> bool:
+    """Append the package to the waiting bytes of the connection and flush them."""
+    connection.tx_buffer += package
+    return flush_packages(connection, timeout)
+
+
+def flush_packages(connection: Connection, timeout=0.0) -> bool:
+    """
+    Write the waiting bytes of the connection, partial writes are continued.
+
+    Waits up to timeout seconds for the socket to take the bytes, what is
+    left stays waiting for the next flush.
+
+    Returns:
+        bool: False if the connection failed.
+    """
+    buffer = connection.tx_buffer
+    deadline = time.monotonic() + timeout
+    try:
+        while buffer:
+            try:
+                del buffer[: connection.socket.send(buffer)]
+                continue
+            except (socket.timeout, BlockingIOError):
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait_socket(connection.socket, remaining, write=True)
+    except OSError as exception:
+        LOGGER.error("Could not send message on tcp connection: %s", exception)
+        buffer.clear()
+        return False
+    return True
+
+
+def new_aes(key: bytes, initial_vector: bytes):
+    """AES-CBC cipher of a bulb session, pycryptodome is loaded on first use."""
+    try:
+        from Cryptodome.Cipher import AES
+    except ImportError:
+        from Crypto.Cipher import AES
+    return AES.new(key, AES.MODE_CBC, iv=initial_vector)
+
+
+def wait_socket(sock: socket.socket, timeout, write=False) -> bool:
+    """Wait until the socket is readable or writable, return if it is.
+
+    select() fails for descriptors above FD_SETSIZE (1024), which hundreds of
+    bulb connections next to Home Assistant reach, poll() has no such limit.
+    """
+    if not hasattr(select, "poll"):
+        readable, writable, _ = select.select(
+            [] if write else [sock], [sock] if write else [], [], timeout
+        )
+        return bool(readable or writable)
+    poller = select.poll()
+    poller.register(sock, select.POLLOUT if write else select.POLLIN)
+    return bool(poller.poll(max(0, timeout) * 1000))
+
+
+def raise_fd_limit(bulbs) -> None:
+    """Raise the soft limit of open files to fit a connection per bulb."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = bulbs + FD_RESERVE
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return
+    if hard != resource.RLIM_INFINITY and hard < wanted:
+        LOGGER.warning(
+            "Open files limited to %s, %s bulbs need about %s", hard, bulbs, wanted
+        )
+        wanted = hard
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    except (OSError, ValueError) as exception:
+        LOGGER.warning("Could not raise the open files limit: %s", exception)
+
+
+def measure_rtt(connection: Connection, sample) -> None:
+    """Smooth the round trip time sample into the connection round trip time."""
+    if connection.rtt:
+        connection.rtt = 0.8 * connection.rtt + 0.2 * sample
+    else:
+        connection.rtt = sample
+
+
 def color_message(red, green, blue, transition, skip_wait=False):
     wait_time = transition if not skip_wait else 0
-    return (
-        json.dumps(
-            {
-                "type": "request",
-                "color": {
-                    "red": red,
-                    "green": green,
-                    "blue": blue,
-                },
-                "transitionTime": transition,
-            }
-        ),
-        wait_time,
-    )
+    return (encoding.color_payload(red, green, blue, transition), wait_time)
 
 
 def temperature_message(temperature, transition, skip_wait=False):
     wait_time = transition if not skip_wait else 0
-    return (
-        json.dumps(
-            {
-                "type": "request",
-                "temperature": temperature,
-                "transitionTime": transition,
-            }
-        ),
-        wait_time,
-    )
+    return (encoding.temperature_payload(temperature, transition), wait_time)
 
 
 def percent_color_message(red, green, blue, warm, cold, transition, skip_wait):
     wait_time = transition if not skip_wait else 0
     return (
-        json.dumps(
-            {
-                "type": "request",
-                "p_color": {
-                    "red": red,
-                    "green": green,
-                    "blue": blue,
-                    "warm": warm,
-                    "cold": cold,
-                    # "brightness" : brightness
-                },
-                "transitionTime": transition,
-            }
-        ),
+        encoding.percent_color_payload(red, green, blue, warm, cold, transition),
         wait_time,
     )
 
 
 def brightness_message(brightness, transition):
-    return (
-        json.dumps(
-            {
-                "type": "request",
-                "brightness": {
-                    "percentage": brightness,
-                },
-                "transitionTime": transition,
-            }
-        ),
-        transition,
+    return (encoding.brightness_payload(brightness, transition), transition)
+
+
+@functools.lru_cache(maxsize=None)
+def command_parser() -> argparse.ArgumentParser:
+    """Parser of the bulb commands, built once."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="virtual App interface")
+
+    parser.add_argument("--color", nargs=3, help="set color command (r,g,b) 0-255")
+    parser.add_argument(
+        "--temperature",
+        nargs=1,
+        help="set temperature command (kelvin 1000-12000) (1000:warm, 12000:cold)",
+    )
+    parser.add_argument("--brightness", nargs=1, help="set brightness in percent 0-100")
+    parser.add_argument(
+        "--percent_color",
+        nargs=5,
+        metavar=("RED", "GREEN", "BLUE", "WARM", "COLD"),
+        help="set colors and white tones in percent 0 - 100",
+    )
+    parser.add_argument(
+        "--transitionTime",
+        nargs=1,
+        help="transition time in milliseconds",
+        default=[0],
+    )
+    parser.add_argument(
+        "--power", nargs=1, metavar='"on"/"off"', help="turns the bulb on/off"
+    )
+    parser.add_argument("--myip", nargs=1, help="specify own IP for broadcast sender")
+    parser.add_argument("--ota", nargs=1, help="specify http URL for ota")
+    parser.add_argument(
+        "--ping", help="send ping", action="store_const", const=True, default=False
+    )
+    parser.add_argument(
+        "--request",
+        help="send status request",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--factory_reset",
+        help="trigger a factory reset on the device (Warning: device has to be onboarded again afterwards)",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--routine_list",
+        help="lists stored routines",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--routine_put",
+        help="store new routine",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--routine_delete",
+        help="delete routine",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--routine_start",
+        help="start routine",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--routine_id", help="specify routine id to act on (for put, start, delete)"
+    )
+    parser.add_argument("--routine_scene", help="specify routine scene label (for put)")
+    parser.add_argument("--routine_commands", help="specify routine program (for put)")
+    parser.add_argument(
+        "--reboot",
+        help="trigger a reboot",
+        action="store_const",
+        const=True,
+        default=False,
+    )
+
+    parser.add_argument(
+        "--passive",
+        help="vApp will passively listen vor UDP SYN from devices",
+        action="store_const",
+        const=True,
+        default=False,
     )
+    parser.add_argument(
+        "--enable_tb", nargs=1, help="enable thingsboard connection (yes/no)"
+    )
+    return parser
+
+
+def command_messages(*argv) -> list:
+    """
+    Translate the bulb command arguments into the messages for the bulb.
+
+    Argv:
+        described in code (see parser)
+
+    Returns:
+        list: (message, pause in milliseconds after sending) in sending order.
+    """
+    args = command_parser().parse_args(argv)
+
+    message_queue_tx = []
+
+    if args.ota is not None:
+        message_queue_tx.append(
+            (json.dumps({"type": "fw_update", "url": args.ota}), 3000)
+        )
+
+    if args.ping:
+        message_queue_tx.append((json.dumps({"type": "ping"}), 10000))
+
+    if args.request:
+        message_queue_tx.append((json.dumps({"type": "request"}), 1000))
+
+    if args.enable_tb is not None:
+        answer = args.enable_tb[0]
+        if answer != "yes" and answer != "no":
+            print("ERROR --enable_tb needs to be yes or no")
+            sys.exit(1)
+
+        message_queue_tx.append(
+            (json.dumps({"type": "backend", "link_enabled": answer}), 1000)
+        )
+
+    if args.passive:
+        pass
+
+    if args.color is not None:
+        r, g, b = args.color
+        transition_time = args.transitionTime[0]
+        message_queue_tx.append(
+            color_message(
+                r, g, b, int(transition_time), skip_wait=args.brightness is not None
+            )
+        )
+
+    if args.temperature is not None:
+        kelvin = args.temperature[0]
+        transition_time = args.transitionTime[0]
+        message_queue_tx.append(
+            temperature_message(
+                kelvin, int(transition_time), skip_wait=args.brightness is not None
+            )
+        )
+
+    if args.brightness is not None:
+        brightness = args.brightness[0]
+        transition_time = args.transitionTime[0]
+        message_queue_tx.append(brightness_message(brightness, int(transition_time)))
+
+    if args.percent_color is not None:
+        r, g, b, w, c = args.percent_color
+        transition_time = args.transitionTime[0]
+        message_queue_tx.append(
+            percent_color_message(
+                r,
+                g,
+                b,
+                w,
+                c,
+                int(transition_time),
+                skip_wait=args.brightness is not None,
+            )
+        )
+
+    if args.factory_reset:
+        message_queue_tx.append((json.dumps({"type": "factory_reset"}), 500))
+
+    if args.routine_list:
+        message_queue_tx.append(
+            (json.dumps({"type": "routine", "action": "list"}), 500)
+        )
+
+    if args.routine_put:
+        message_queue_tx.append(
+            (
+                json.dumps(
+                    {
+                        "type": "routine",
+                        "action": "put",
+                        "id": args.routine_id,
+                        "scene": args.routine_scene,
+                        "commands": args.routine_commands,
+                    }
+                ),
+                500,
+            )
+        )
+
+    if args.routine_delete:
+        message_queue_tx.append(
+            (
+                json.dumps(
+                    {"type": "routine", "action": "delete", "id": args.routine_id}
+                ),
+                500,
+            )
+        )
+    if args.routine_start:
+        message_queue_tx.append(
+            (
+                json.dumps(
+                    {"type": "routine", "action": "start", "id": args.routine_id}
+                ),
+                500,
+            )
+        )
+
+    if args.power:
+        message_queue_tx.append(
+            (json.dumps({"type": "request", "status": args.power[0]}), 500)
+        )
+
+    if args.reboot:
+        message_queue_tx.append((json.dumps({"type": "reboot"}), 500))
+
+    return message_queue_tx
+
+
+def target_args(target: dict) -> list:
+    """
+    Translate a target state of the bulb into the bulb command arguments.
+
+    Args:
+        target (dict): Any of "power" ("on"/"off"), "color" (r, g, b),
+            "percent_color" (r, g, b, warm, cold), "temperature" (kelvin),
+            "brightness" (percent) and "transition" (milliseconds).
+    """
+    args = []
+    if "power" in target:
+        args.extend(["--power", target["power"]])
+    if "color" in target:
+        args.extend(["--color", *[str(x) for x in target["color"]]])
+    if "percent_color" in target:
+        args.extend(["--percent_color", *[str(x) for x in target["percent_color"]]])
+    if "temperature" in target:
+        args.extend(["--temperature", str(target["temperature"])])
+    if "brightness" in target:
+        args.extend(["--brightness", str(target["brightness"])])
+    if target.get("transition"):
+        args.extend(["--transitionTime", str(target["transition"])])
+    return args
 
 
 class KlyqaLightDevice:
-    state = {}
-    connection: Connection = None
+    """Bulb of the klyqa account with its connection and last confirmed status."""
 
-    def __init__(self, state={}, connection=None):
-        self.state = state
+    __slots__ = ("status", "status_at", "connection")
+
+    def __init__(
+        self, status: BulbStatus | None = None, connection: Connection | None = None
+    ):
+        self.status = status
+        """Monotonic time the bulb confirmed the status, 0 if it is not confirmed."""
+        self.status_at = 0.0
         self.connection = connection
 
+    def changes(self, target: dict) -> dict:
+        """
+        Compare the target state with the last confirmed status of the bulb.
+
+        Args:
+            target (dict): Target state (see target_args).
+
+        Returns:
+            dict: The part of the target the bulb does not show yet, empty if
+                there is nothing to send. The whole target if the status was
+                not confirmed within STATUS_FRESH seconds.
+        """
+        status = self.status
+        if status is None or time.monotonic() - self.status_at > STATUS_FRESH:
+            return target
+
+        changes = dict(target)
+        if changes.get("power") == status.power:
+            del changes["power"]
+        if (
+            "color" in changes
+            and status.mode == "rgb"
+            and tuple(int(x) for x in changes["color"]) == status.rgb
+        ):
+            del changes["color"]
+        if (
+            "temperature" in changes
+            and status.mode == "cct"
+            and int(changes["temperature"]) == status.temperature
+        ):
+            del changes["temperature"]
+        if "brightness" in changes and int(changes["brightness"]) == int(
+            status.brightness
+        ):
+            del changes["brightness"]
+
+        if list(changes) == ["transition"]:
+            return {}
+        return changes
+
 
 class Klyqa:
     """Klyqa Manager Module"""
 
-    lights = {}
     _access_token = ""
     _account_token = ""
-    _bearer = {}
 
     def __init__(
         self,
@@ -343,13 +841,52 @@ class Klyqa:
         hass: HomeAssistant = None,
         disable_cache=False,
         sync_rooms=True,
+        push_notifications=False,
     ):
         self._username = username
         self._password = password
         self.sync_rooms: bool = sync_rooms
+        """Listen to the change notifications of the cloud, see push.py."""
+        self.push_notifications: bool = push_notifications
         self._cache_path = DEFAULT_CACHEDB
         self._host = host
         self.hass = hass
+        self.executor = KlyqaExecutor(hass)
+        self.lights: dict[str, KlyqaLightDevice] = {}
+        self._bearer = {}
+        """Home Assistant state writes of the entities, written and suppressed as unchanged"""
+        self.state_updates = {"written": 0, "suppressed": 0}
+        """Settings loads that changed the settings and that found them unchanged"""
+        self.settings_loads = {"changed": 0, "unchanged": 0}
+        self.metrics = Metrics()
+        self.trace = FrameTrace()
+        self.dispatcher = GroupDispatcher(self)
+        self.effects = EffectEngine(self)
+        self.stream = ColorStream(self)
+        self.connections = ConnectionManager(self)
+        self.push = SettingsPush(self)
+        self._bulb_locks = {}
+        self._discovery_lock = threading.Lock()
+        self._discovery: concurrent.futures.Future | None = None
+        self._waiters: dict[str, list[concurrent.futures.Future]] = {}
+        self._settings = {"devices": [], "rooms": [], "routines": [], "timers": []}
+        """Account devices by local device id."""
+        self._devices: dict[str, dict] = {}
+        """Monotonic time of the last settings request."""
+        self._settings_loaded = 0.0
+        self._settings_refresh: asyncio.Future | None = None
+        self._start_task: asyncio.Task | None = None
+        """Set by async_stop, the background tasks are not started anymore."""
+        self._stopped = False
+        """ETag, Last-Modified and content hash of the loaded settings."""
+        self._settings_version: dict[str, str] = {}
+        self._product_configs: dict[str, dict] = {}
+        self._product_requests: dict[str, asyncio.Future] = {}
+        self._store = (
+            Store(hass, SETTINGS_STORE_VERSION, SETTINGS_STORE_KEY, private=True)
+            if hass
+            else None
+        )
 
         # # Create a new cache template
         # self._cache = {
@@ -378,6 +915,8 @@ class Klyqa:
         self._account_token = ""
 
         login_data = {"email": self._username, "password": self._password}
+        import requests
+
         login_response = requests.post(self._host + "/auth/login", json=login_data)
 
         if login_response.status_code != 200 and login_response.status_code != 201:
@@ -400,28 +939,86 @@ class Klyqa:
 
     def request_get(self, url, params=None, **kwargs):
         """Send request get and if logged out login again and request again."""
-        response = requests.get(self._host + url, params, **kwargs)
-        if response.status_code == 401 and (not self.login() or not self._access_token):
+        response = self._timed_get(url, params, **kwargs)
+        if response.status_code != 401 or not self.login() or not self._access_token:
             return response
-        response = requests.get(self._host + url, params, **kwargs)
+        if "Authorization" in kwargs.get("headers", {}):
+            # Retry with the new access token.
+            kwargs["headers"] = {
+                **kwargs["headers"],
+                "Authorization": self._bearer["Authorization"],
+            }
+        response = self._timed_get(url, params, **kwargs)
+        return response
+
+    def _timed_get(self, url, params=None, **kwargs):
+        cloud = self.metrics.cloud
+        cloud.requests += 1
+        started = time.monotonic()
+        try:
+            import requests
+
+            response = requests.get(self._host + url, params, **kwargs)
+        except Exception:
+            cloud.errors += 1
+            raise
+        finally:
+            cloud.latency.observe(time.monotonic() - started)
+        if response.status_code >= 400:
+            cloud.errors += 1
         return response
 
     # async def async_request_get(self, url, params=None, **kwargs):
     #     return await self.hass.async_add_executor_job(self.request_get, url, params, **kwargs)
 
-    def request_get_beared(self, url, params=None, **kwargs):
+    def request_get_beared(self, url, params=None, headers=None, **kwargs):
         """Send request get and if logged out login again."""
-        response_object = self.request_get(url, params, headers=self._bearer, **kwargs)
+        response_object = self.request_get(
+            url, params, headers={**self._bearer, **(headers or {})}, **kwargs
+        )
         return response_object
 
     def load_settings(self) -> bool:
-        """Load settings from klyqa account."""
-        settings_response = self.request_get_beared("/settings")
+        """Load settings from klyqa account.
+
+        The request is conditional on the ETag and Last-Modified of the loaded
+        settings where the cloud sends them, an answer 304 or a body with the
+        hash of the loaded one leaves the settings, the rooms and the lights
+        untouched.
+        """
+        self._settings_loaded = time.monotonic()
+        version = self._settings_version
+        headers = {}
+        if "etag" in version:
+            headers["If-None-Match"] = version["etag"]
+        if "last_modified" in version:
+            headers["If-Modified-Since"] = version["last_modified"]
+        settings_response = self.request_get_beared("/settings", headers=headers)
+        if settings_response.status_code == 304:
+            self.settings_loads["unchanged"] += 1
+            return True
         if settings_response.status_code != 200:
             return False
-        self._settings = json.loads(settings_response.text)
+        content_hash = hashlib.sha256(settings_response.content).hexdigest()
+        if content_hash == version.get("hash"):
+            self.settings_loads["unchanged"] += 1
+            return True
+        self.settings_loads["changed"] += 1
+        version = {"hash": content_hash}
+        if "ETag" in settings_response.headers:
+            version["etag"] = settings_response.headers["ETag"]
+        if "Last-Modified" in settings_response.headers:
+            version["last_modified"] = settings_response.headers["Last-Modified"]
+        rooms = self._settings["rooms"]
+        settings = json.loads(settings_response.text)
+        self._set_settings(settings, version)
+        if self._store:
+            data = {"username": self._username, "settings": settings, **version}
+            self.hass.add_job(
+                self._store.async_delay_save, lambda: data, SETTINGS_SAVE_DELAY
+            )
 
-        if self.sync_rooms and len(self._settings["rooms"]) > 0:
+        if self.sync_rooms and settings["rooms"] and settings["rooms"] != rooms:
             LOGGER.debug("Applying rooms from klyqa accounts to Home Assistant")
             area_reg = ar.async_get(self.hass)
             for room in self._settings["rooms"]:
@@ -432,8 +1029,156 @@ class Klyqa:
 
         return True
 
+    def _set_settings(self, settings, version):
+        # Unchanged devices keep their settings object, the lights only
+        # apply the settings of the changed ones.
+        devices = []
+        for device in settings["devices"]:
+            loaded = self._devices.get(device["localDeviceId"])
+            devices.append(loaded if loaded == device else device)
+        settings["devices"] = devices
+        self._settings = settings
+        self._settings_version = version
+        self._devices = {x["localDeviceId"]: x for x in settings["devices"]}
+
+    async def async_load_cached_settings(self) -> bool:
+        """Use the settings stored by the last run of the account, if any."""
+        if not self._store:
+            return False
+        data = await self._store.async_load()
+        if not data or data.get("username") != self._username:
+            return False
+        self._set_settings(
+            data["settings"],
+            {x: data[x] for x in ("etag", "last_modified", "hash") if x in data},
+        )
+        return True
+
+    def schedule_start(self, seconds_to_discover=1) -> None:
+        """Run async_start in the background, async_stop cancels it."""
+        self._stopped = False
+        self._start_task = self.hass.async_create_task(
+            self.async_start(seconds_to_discover=seconds_to_discover)
+        )
+
+    async def async_start(self, seconds_to_discover=1) -> None:
+        """Login, refresh the settings and prefetch the product configs while
+        the bulbs are searched."""
+        jobs = [self._async_refresh_cloud()]
+        if self.connections.missing():
+            jobs.append(
+                self.async_search_lights(seconds_to_discover=seconds_to_discover)
+            )
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                LOGGER.warning("Klyqa startup: %s", result)
+        self.connections.start()
+        self.push.start()
+
+    async def _async_refresh_cloud(self):
+        if not self._access_token and not await self.executor.async_add_job(self.login):
+            LOGGER.warning("Klyqa login failed, using the stored settings")
+            return
+        await self.async_refresh_settings()
+        await asyncio.gather(
+            *[
+                self.async_product_config(product_id)
+                for product_id in {x["productId"] for x in self._settings["devices"]}
+            ]
+        )
+
+    def subscribe_connection(self, u_id) -> asyncio.Future:
+        """Connection to the bulb once a search handshakes it, None if the search
+        ends without it. Subscribe before the search starts."""
+        return asyncio.wrap_future(self._subscribe(u_id))
+
+    async def async_refresh_settings(self, max_age=None) -> None:
+        """Reload the settings when the last request is older than max_age seconds.
+
+        Concurrent callers share one request, so the polling lights of a large
+        account cost one settings request per max_age, even when it fails. By
+        default SETTINGS_MAX_AGE, or the fallback age of the push channel while
+        the cloud notifies the changes of the account.
+        """
+        if max_age is None:
+            max_age = (
+                self.push.FALLBACK_AGE if self.push.connected else SETTINGS_MAX_AGE
+            )
+        if self._settings_refresh is None:
+            if time.monotonic() - self._settings_loaded < max_age:
+                return
+            self._settings_refresh = self.executor.async_add_job(self.load_settings)
+            self._settings_refresh.add_done_callback(self._settings_refreshed)
+        await asyncio.shield(self._settings_refresh)
+
+    def _settings_refreshed(self, refresh: asyncio.Future):
+        self._settings_refresh = None
+
+    def device_settings(self, u_id) -> dict | None:
+        """Account settings of the device."""
+        return self._devices.get(u_id)
+
+    def load_product_config(self, product_id) -> dict | None:
+        """Request the config of the product from the cloud."""
+        response = self.request_get_beared("/config/product/" + product_id)
+        if response.status_code != 200:
+            return None
+        config = json.loads(response.text)
+        self._product_configs[product_id] = config
+        return config
+
+    async def async_product_config(self, product_id) -> dict | None:
+        """Config of the product, requested once per product for all its bulbs."""
+        if product_id in self._product_configs:
+            return self._product_configs[product_id]
+        request = self._product_requests.get(product_id)
+        if request is None:
+            request = self.executor.async_add_job(self.load_product_config, product_id)
+            self._product_requests[product_id] = request
+            request.add_done_callback(
+                lambda _: self._product_requests.pop(product_id, None)
+            )
+        return await asyncio.shield(request)
+
+    def room_devices(self, room_name) -> list:
+        """Local device ids of the bulbs in the klyqa room."""
+        for room in self._settings["rooms"]:
+            if room["name"] == room_name:
+                return [device["localDeviceId"] for device in room["devices"]]
+        return []
+
+    async def async_stop(self, executor=True) -> None:
+        """
+        Stop the effects, the stream, the connection manager and the push
+        channel, then log out and close the bulb connections.
+
+        Args:
+            executor (bool): Shut down the thread pool as well, False when the
+                instance is set up again.
+        """
+        self._stopped = True
+        if self._start_task:
+            # A start still running would start the connection manager and
+            # the push channel after they were stopped.
+            self._start_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await self._start_task
+            self._start_task = None
+        self.effects.stop_all()
+        self.stream.stop()
+        self.connections.stop()
+        self.push.stop()
+        try:
+            await self.executor.async_add_job(self.shutdown)
+        finally:
+            if executor:
+                self.executor.shutdown()
+
     def shutdown(self):
         """Load settings from klyqa account."""
+        import requests
+
         response = requests.post(self._host + "/auth/logout", headers=self._bearer)
         for light in self.lights:
             if self.lights[light].connection.socket:
@@ -442,64 +1187,129 @@ class Klyqa:
                 except:
                     pass
 
-    search_lights_mutex = threading.Lock()
-
     def search_lights(self, seconds_to_discover=10, u_id=None):
-        """Get a thread lock safe light searching broadcast of the klyqa bulbs."""
+        """
+        Search the klyqa bulbs by broadcast or join the search already running.
 
-        while True:
-            got_mutex = self.search_lights_mutex.acquire(blocking=False)
-            if not got_mutex and not u_id:
-                return None
-            # If looking for unit_id connection, check if current is now established
-            # (in parallel possible) . Then return it.
-            if (
-                u_id
-                and u_id in self.lights
-                and not self.lights[u_id].connection.socket._closed
-            ):
-                state = self._send_to_bulb(
-                    "--ping",
-                    connection=self.lights[u_id].connection,
-                    reconnect=False,
-                )
+        Args:
+            u_id: Local device id. Return the connection to the bulb as soon as
+                it is handshaked, while the search goes on for the other bulbs.
+            seconds_to_discover: Time to look for the lights from the account devices.
 
-                if state and state.get("type") == "pong":
-                    return self.lights[u_id].connection
-                try:
-                    self.lights[u_id].connection.socket.close()
-                    self.lights[u_id].connection.socket._closed = True
-                except Exception:
-                    pass
-            if got_mutex:
-                break
-            if self.search_lights_mutex.acquire(blocking=True, timeout=100):
-                break
+        Returns:
+            connection: If u_id is given and the bulb was found.
+        """
+        if u_id:
+            connection = self._ping_connection(u_id)
+            if connection:
+                return connection
+
+        waiter = self._subscribe(u_id) if u_id else None
+        discovery, started = self._start_discovery()
+        if started:
+            self._run_discovery(discovery, seconds_to_discover)
+        if waiter is None:
+            return None
+        try:
+            return waiter.result(timeout=seconds_to_discover + DISCOVERY_GRACE)
+        except concurrent.futures.TimeoutError:
+            return None
 
-        return_connection = self.__search_lights(seconds_to_discover, u_id)
+    async def async_search_lights(self, seconds_to_discover=10, u_id=None):
+        """Search the klyqa bulbs like search_lights without holding a thread while waiting."""
+        waiter = self._subscribe(u_id) if u_id else None
+        discovery, started = self._start_discovery()
+        if started:
+            job = self.executor.async_add_job(
+                self._run_discovery, discovery, seconds_to_discover, timeout=None
+            )
+            job.add_done_callback(
+                functools.partial(self._discovery_job_done, discovery)
+            )
+        return await asyncio.wrap_future(waiter or discovery)
 
-        LOGGER.info(
-            "Search for bulbs finished. " + str(threading.current_thread().ident),
-        )
-        self.search_lights_mutex.release()
-        return return_connection
+    def _ping_connection(self, u_id) -> Connection | None:
+        """Return the connection to the bulb if it still answers, else close it."""
+        if u_id not in self.lights or not self.lights[u_id].connection:
+            return None
+        connection = self.lights[u_id].connection
+        if connection.socket is None or connection.socket._closed:
+            return None
 
-    def __search_lights(self, seconds_to_discover=10, u_id=None):
+        with self._bulb_lock(u_id):
+            state = self._send_to_bulb(
+                "--ping", connection=connection, reconnect=False, timeout=PING_TIMEOUT
+            )
+        if state and state.get("type") == "pong":
+            return connection
+        try:
+            connection.socket.close()
+            connection.socket._closed = True
+        except Exception:
+            pass
+        return None
+
+    def _subscribe(self, u_id) -> concurrent.futures.Future:
+        """Future of the connection to the bulb, set when a search handshakes it."""
+        future = concurrent.futures.Future()
+        with self._discovery_lock:
+            self._waiters.setdefault(u_id, []).append(future)
+        return future
+
+    def _notify(self, connection: Connection):
+        with self._discovery_lock:
+            futures = self._waiters.pop(connection.u_id, [])
+        for future in futures:
+            if not future.done():
+                future.set_result(connection)
+
+    def _start_discovery(self) -> tuple[concurrent.futures.Future, bool]:
+        """Return the running search, or a new one and True if the caller has to run it."""
+        with self._discovery_lock:
+            if self._discovery is not None:
+                return self._discovery, False
+            self._discovery = concurrent.futures.Future()
+            return self._discovery, True
+
+    def _run_discovery(self, discovery, seconds_to_discover):
+        try:
+            self.__search_lights(seconds_to_discover)
+        finally:
+            self._finish_discovery(discovery)
+
+    def _discovery_job_done(self, discovery, job: asyncio.Future):
+        # A search rejected or cancelled by the pool never ran to its end.
+        if job.cancelled() or job.exception():
+            self._finish_discovery(discovery)
+
+    def _finish_discovery(self, discovery):
+        """End the search, bulbs not found so far get no connection."""
+        with self._discovery_lock:
+            if self._discovery is not discovery:
+                # Already finished, a later search may be running.
+                return
+            waiters = self._waiters
+            self._waiters = {}
+            self._discovery = None
+        for futures in waiters.values():
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+        if not discovery.done():
+            discovery.set_result(None)
+        LOGGER.info("Search for bulbs finished.")
+
+    def __search_lights(self, seconds_to_discover=10):
         """
-        If the local device id u_id is given, the function will search for lights
-        and return the connection if the light with the u_id is found
-        and a connection could be estasblished.
+        Broadcast for the lights and handshake the connections of the lights
+        answering. Subscribers of a light get its connection right away.
         Args:
-            u_id: Local device id.
             seconds_to_discover: Time to look for the lights from the account devices.
-        returns:
-            connection: If u_id is given.
         """
         LOGGER.info(
             "Search for bulbs ... " + str(threading.current_thread().ident),
         )
 
-        return_connection = None
         udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         udp.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -511,7 +1321,7 @@ class Klyqa:
         tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_address = ("0.0.0.0", 3333)
         tcp.bind(server_address)
-        tcp.listen()
+        tcp.listen(DISCOVERY_BACKLOG)
 
         time_started = datetime.datetime.now()
         seconds_left = datetime.timedelta(milliseconds=0)
@@ -531,10 +1341,8 @@ class Klyqa:
             except Exception as exception:
                 read_burst_response = False
             while read_burst_response:
-                readable, _, _ = select.select([tcp], [], [], 0.1)
-                if tcp in readable:
-                    connection = Connection()
-                    connection.socket, connection.address = tcp.accept()
+                if wait_socket(tcp, 0.1):
+                    connection = Connection(*tcp.accept())
                     # almost disable blocking socket
                     connection.socket.settimeout(0.001)
                     lights_found_num = lights_found_num + 1
@@ -552,6 +1360,7 @@ class Klyqa:
                                 connection.u_id
                             ].connection.socket._closed:
                                 connection.socket.close()
+                                self._notify(self.lights[connection.u_id].connection)
                                 continue
 
                             # if there is still a open connection try to close it
@@ -561,10 +1370,10 @@ class Klyqa:
                                 pass
                         # TODO: Make self.lights better name light_states maybe.
                         self.lights[connection.u_id] = KlyqaLightDevice(
-                            state=state, connection=connection
+                            status=BulbStatus.from_response(state),
+                            connection=connection,
                         )
-                        if connection.u_id == u_id:
-                            return_connection = connection
+                        self._notify(connection)
 
                     LOGGER.debug("TCP layer connected")
                 else:
@@ -574,10 +1383,7 @@ class Klyqa:
             seconds_left = datetime.datetime.now() - time_started
 
         tcp.close()
-        if return_connection is not None:
-            return return_connection
-
-        return
+        udp.close()
 
     def send_to_bulb(self, *argv, u_id=None, **kwargs) -> dict:
         """
@@ -619,23 +1425,206 @@ class Klyqa:
         response = None
         TRY_MAX = 2
         attempt_num = 1
-        while (
-            not (
-                response := self._send_to_bulb(
-                    *argv,
-                    connection=self.lights[u_id].connection,
-                    retry=attempt_num > 1,
+        metrics = self.metrics.bulb(u_id)
+        metrics.commands += 1
+        with self._bulb_lock(u_id):
+            while (
+                not (
+                    response := self._send_to_bulb(
+                        *argv,
+                        connection=self.lights[u_id].connection,
+                        retry=attempt_num > 1,
+                    )
                 )
-            )
-            and attempt_num <= TRY_MAX
-        ):
-            LOGGER.info("No answer from lamp %s. Try resend", str(u_id))
-            attempt_num = attempt_num + 1
-            if attempt_num >= TRY_MAX:
+                and attempt_num <= TRY_MAX
+            ):
                 LOGGER.info("No answer from lamp %s. Try resend", str(u_id))
+                attempt_num = attempt_num + 1
+                metrics.retries += 1
+                if attempt_num >= TRY_MAX:
+                    LOGGER.info("No answer from lamp %s. Try resend", str(u_id))
 
+        if response:
+            metrics.answered += 1
+        else:
+            metrics.no_answer += 1
         return response
 
+    def send_color_frame(self, u_id, red, green, blue, transition=0) -> bool:
+        """
+        Send a color to the bulb without waiting for its answer. Used for effect
+        and stream frames where only the newest color matters.
+
+        Returns:
+            bool: True if the frame was written to the connection.
+        """
+        if u_id not in self.lights or not self.lights[u_id].connection:
+            return False
+
+        with self._bulb_lock(u_id):
+            connection: Connection = self.lights[u_id].connection
+            if connection.state != STATE_CONNECTED or connection.socket._closed:
+                return False
+            self._read_pending(connection)
+            message, _ = color_message(red, green, blue, transition, skip_wait=True)
+            # A frame never waits for the socket, a congested bulb skips frames.
+            if not send_msg(connection, message, timeout=0):
+                return False
+            self.trace.record(TX, u_id, 2, message)
+            return True
+
+    async def async_set_many(self, targets: dict) -> dict:
+        """
+        Set many bulbs to their own target states concurrently, over the
+        existing connections and without refreshing the cloud settings. Bulbs
+        already showing their target state are skipped.
+
+        Args:
+            targets (dict): Local device id to target state (see target_args).
+
+        Returns:
+            dict: Local device id to the result with "success", the answer
+                of the bulb as "state" and the "duration" in milliseconds.
+        """
+
+        async def async_set(u_id, target):
+            started = time.monotonic()
+            if u_id not in self.lights:
+                return u_id, {
+                    "success": False,
+                    "error": "not connected",
+                    "duration": 0.0,
+                }
+            target = self.lights[u_id].changes(target)
+            if not target:
+                return u_id, {"success": True, "skipped": True, "duration": 0.0}
+            response = await self.executor.async_add_job(
+                functools.partial(self.send_to_bulb, *target_args(target), u_id=u_id)
+            )
+            return u_id, {
+                "success": bool(response),
+                "state": response,
+                "duration": round((time.monotonic() - started) * 1000, 1),
+            }
+
+        return dict(
+            await asyncio.gather(
+                *[async_set(u_id, target) for u_id, target in targets.items()]
+            )
+        )
+
+    def send_synchronized(self, commands: dict) -> dict:
+        """
+        Write commands to several bulbs at the same time, so that their
+        transitions start together.
+
+        All messages of a round are encrypted first and then written to the
+        sockets in one tight loop. A bulb with a longer round trip time gets its
+        message earlier by half the difference, so all messages arrive together.
+        Further messages of the commands follow in the next rounds after the pause
+        of the previous message. The answers are not waited for. The locks of
+        the bulbs are released in the pauses between the rounds.
+
+        Args:
+            commands (dict): Local device id to the messages of command_messages.
+
+        Returns:
+            dict: Local device id to True if all messages were written.
+        """
+        u_ids = sorted(
+            x for x in commands if x in self.lights and self.lights[x].connection
+        )
+        results = {u_id: u_id in u_ids for u_id in commands}
+
+        rounds = max([len(commands[u_id]) for u_id in u_ids], default=0)
+        for round_num in range(rounds):
+            # The locks are held for the writes of one round only, commands to
+            # the bulbs run in the pauses between the rounds.
+            with contextlib.ExitStack() as stack:
+                for u_id in u_ids:
+                    if results[u_id] and round_num < len(commands[u_id]):
+                        stack.enter_context(self._bulb_lock(u_id))
+
+                packages = []
+                pause = 0
+                for u_id in u_ids:
+                    connection: Connection = self.lights[u_id].connection
+                    if not results[u_id] or round_num >= len(commands[u_id]):
+                        continue
+                    if (
+                        not connection
+                        or connection.state != STATE_CONNECTED
+                        or connection.socket._closed
+                    ):
+                        results[u_id] = False
+                        continue
+                    self._read_pending(connection)
+                    if congested(connection):
+                        results[u_id] = False
+                        continue
+                    msg, ts = commands[u_id][round_num]
+                    pause = max(pause, ts)
+                    lead = min(connection.rtt, SYNC_MAX_RTT) / 2
+                    packages.append(
+                        (
+                            lead,
+                            u_id,
+                            connection,
+                            encrypt_msg(msg, connection.sending_aes),
+                        )
+                    )
+                    self.trace.record(TX, u_id, 2, msg)
+
+                packages.sort(key=lambda package: package[0], reverse=True)
+                started = time.perf_counter()
+                for lead, u_id, connection, package in packages:
+                    send_at = started + packages[0][0] - lead
+                    # Sleep most of the gap, the GIL is free for the event loop,
+                    # and spin only the last SYNC_SPIN seconds for the accuracy.
+                    gap = send_at - time.perf_counter() - SYNC_SPIN
+                    if gap > 0:
+                        time.sleep(gap)
+                    while time.perf_counter() < send_at:
+                        pass
+                    results[u_id] = send_package(connection, package, timeout=0)
+                    # The status is confirmed again by the answer, read with the
+                    # next command or by read_answers.
+                    self.lights[u_id].status_at = 0.0
+
+                for _, u_id, connection, _ in packages:
+                    if results[u_id] and connection.tx_buffer:
+                        results[u_id] = flush_packages(connection, TX_TIMEOUT)
+
+            if round_num < rounds - 1:
+                time.sleep(pause / 1000)
+
+        return results
+
+    def read_answers(self, u_ids) -> None:
+        """Read the answers of the bulbs to synchronized sends into their status.
+
+        A bulb busy with a command is skipped, the command reads the answers.
+        """
+        for u_id in u_ids:
+            connection = self.lights[u_id].connection if u_id in self.lights else None
+            if (
+                not connection
+                or connection.state != STATE_CONNECTED
+                or connection.socket is None
+                or connection.socket._closed
+            ):
+                continue
+            lock = self._bulb_lock(u_id)
+            if lock.acquire(blocking=False):
+                try:
+                    self._read_pending(connection)
+                finally:
+                    lock.release()
+
+    def _bulb_lock(self, u_id) -> threading.RLock:
+        """Lock serializing the commands to one bulb (shared cipher state)."""
+        return self._bulb_locks.setdefault(u_id, threading.RLock())
+
     def search_missing_bulbs(self):
         """TODO: this function is crap. we look if any bulb connection is missing and search then for it. therefore make a list of bulbs missing connection and then look for them."""
         if len(self.lights) < len(self._settings["devices"]):  # self._settings.devices
@@ -657,6 +1646,8 @@ class Klyqa:
         Kwargs:
             connection (Connection): Tcp connection to the bulb.
             reconnect (bool): Reconnect if tcp connection fails.
+            timeout (float): Seconds to wait at most after each message instead
+                of its pause.
 
         Returns:
             Json object: The answer of the bulb if successful.
@@ -669,277 +1660,64 @@ class Klyqa:
         reconnect = True
         if "reconnect" in kwargs:
             reconnect = kwargs["reconnect"]
+        timeout = kwargs.get("timeout")
 
+        started = time.monotonic()
         if not connection.local_iv:
             connection.state = STATE_WAIT_IV
-            connection.local_iv = get_random_bytes(8)
+            connection.local_iv = os.urandom(8)
         else:
             connection.state = STATE_CONNECTED
 
-        parser = argparse.ArgumentParser(description="virtual App interface")
-
-        parser.add_argument("--color", nargs=3, help="set color command (r,g,b) 0-255")
-        parser.add_argument(
-            "--temperature",
-            nargs=1,
-            help="set temperature command (kelvin 1000-12000) (1000:warm, 12000:cold)",
-        )
-        parser.add_argument(
-            "--brightness", nargs=1, help="set brightness in percent 0-100"
-        )
-        parser.add_argument(
-            "--percent_color",
-            nargs=5,
-            metavar=("RED", "GREEN", "BLUE", "WARM", "COLD"),
-            help="set colors and white tones in percent 0 - 100",
-        )
-        parser.add_argument(
-            "--transitionTime",
-            nargs=1,
-            help="transition time in milliseconds",
-            default=[0],
-        )
-        parser.add_argument(
-            "--power", nargs=1, metavar='"on"/"off"', help="turns the bulb on/off"
-        )
-        parser.add_argument(
-            "--party",
-            help="blink fast and furious",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-
-        parser.add_argument(
-            "--myip", nargs=1, help="specify own IP for broadcast sender"
-        )
-        parser.add_argument("--ota", nargs=1, help="specify http URL for ota")
-        parser.add_argument(
-            "--ping", help="send ping", action="store_const", const=True, default=False
-        )
-        parser.add_argument(
-            "--request",
-            help="send status request",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--factory_reset",
-            help="trigger a factory reset on the device (Warning: device has to be onboarded again afterwards)",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--routine_list",
-            help="lists stored routines",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--routine_put",
-            help="store new routine",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--routine_delete",
-            help="delete routine",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--routine_start",
-            help="start routine",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--routine_id", help="specify routine id to act on (for put, start, delete)"
-        )
-        parser.add_argument(
-            "--routine_scene", help="specify routine scene label (for put)"
-        )
-        parser.add_argument(
-            "--routine_commands", help="specify routine program (for put)"
-        )
-        parser.add_argument(
-            "--reboot",
-            help="trigger a reboot",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-
-        parser.add_argument(
-            "--passive",
-            help="vApp will passively listen vor UDP SYN from devices",
-            action="store_const",
-            const=True,
-            default=False,
-        )
-        parser.add_argument(
-            "--enable_tb", nargs=1, help="enable thingsboard connection (yes/no)"
-        )
-
         if len(argv) < 1:
-            parser.print_help()
+            command_parser().print_help()
             return
 
-        args = parser.parse_args(argv)
-
-        message_queue_tx = []
-
-        if args.ota is not None:
-            message_queue_tx.append(
-                (json.dumps({"type": "fw_update", "url": args.ota}), 3000)
-            )
-
-        if args.ping:
-            message_queue_tx.append((json.dumps({"type": "ping"}), 10000))
-
-        if args.request:
-            message_queue_tx.append((json.dumps({"type": "request"}), 1000))
-
-        if args.enable_tb is not None:
-            answer = args.enable_tb[0]
-            if answer != "yes" and answer != "no":
-                print("ERROR --enable_tb needs to be yes or no")
-                sys.exit(1)
-
-            message_queue_tx.append(
-                (json.dumps({"type": "backend", "link_enabled": answer}), 1000)
-            )
-
-        if args.passive:
-            pass
-
-        if args.color is not None:
-            r, g, b = args.color
-            transition_time = args.transitionTime[0]
-            message_queue_tx.append(
-                color_message(
-                    r, g, b, int(transition_time), skip_wait=args.brightness is not None
-                )
-            )
-
-        if args.temperature is not None:
-            kelvin = args.temperature[0]
-            transition_time = args.transitionTime[0]
-            message_queue_tx.append(
-                temperature_message(
-                    kelvin, int(transition_time), skip_wait=args.brightness is not None
-                )
-            )
-
-        if args.brightness is not None:
-            brightness = args.brightness[0]
-            transition_time = args.transitionTime[0]
-            message_queue_tx.append(
-                brightness_message(brightness, int(transition_time))
-            )
-
-        if args.percent_color is not None:
-            r, g, b, w, c = args.percent_color
-            transition_time = args.transitionTime[0]
-            message_queue_tx.append(
-                percent_color_message(
-                    r,
-                    g,
-                    b,
-                    w,
-                    c,
-                    int(transition_time),
-                    skip_wait=args.brightness is not None,
-                )
-            )
-
-        if args.factory_reset:
-            message_queue_tx.append((json.dumps({"type": "factory_reset"}), 500))
+        message_queue_tx = command_messages(*argv)
 
-        if args.routine_list:
-            message_queue_tx.append(
-                (json.dumps({"type": "routine", "action": "list"}), 500)
-            )
-
-        if args.routine_put:
-            message_queue_tx.append(
-                (
-                    json.dumps(
-                        {
-                            "type": "routine",
-                            "action": "put",
-                            "id": args.routine_id,
-                            "scene": args.routine_scene,
-                            "commands": args.routine_commands,
-                        }
-                    ),
-                    500,
-                )
-            )
-
-        if args.routine_delete:
-            message_queue_tx.append(
-                (
-                    json.dumps(
-                        {"type": "routine", "action": "delete", "id": args.routine_id}
-                    ),
-                    500,
-                )
-            )
-        if args.routine_start:
-            message_queue_tx.append(
-                (
-                    json.dumps(
-                        {"type": "routine", "action": "start", "id": args.routine_id}
-                    ),
-                    500,
-                )
-            )
-
-        if args.power:
-            message_queue_tx.append(
-                (json.dumps({"type": "request", "status": args.power[0]}), 500)
-            )
-
-        if args.reboot:
-            message_queue_tx.append((json.dumps({"type": "reboot"}), 500))
-
-        data = []
+        data = b""
 
         message_queue_tx.reverse()
         last_send = datetime.datetime.now()
 
         def do_reconnect():
             """Try reconnect only once per send."""
-            nonlocal reconnect, self
+            nonlocal reconnect, self, data
             reconnect = False
+            data = b""
+            if connection.u_id:
+                self.metrics.bulb(connection.u_id).reconnects += 1
             # self.load_settings()
             return self.search_lights(u_id=connection.u_id)
 
         if connection.socket._closed:
             connection = do_reconnect()
+        if connection and connection.state == STATE_CONNECTED and not retry:
+            # Answers the bulb sent since the last command are not the answer
+            # to this one, and would inflate the round trip time.
+            self._read_pending(connection)
+        if connection:
+            # The rest of a package read by the last receive.
+            data = connection.rx_buffer
+            connection.rx_buffer = b""
 
         pause = datetime.timedelta(milliseconds=0)
         elapsed = datetime.datetime.now() - last_send
         aes_key = ""
-        while len(message_queue_tx) > 0 or elapsed < pause or args.party:
+        sent_at = None
+        while len(message_queue_tx) > 0 or elapsed < pause:
             try:
-                data = connection.socket.recv(4096)
-                if data == "":
-                    print("wrong")
-                if len(data) == 0:
+                chunk = connection.socket.recv(4096)
+                if len(chunk) == 0:
                     LOGGER.debug("EOF")
                     if reconnect:
                         connection = do_reconnect()
                         continue
                     else:
                         return
+                self.trace.record(RX, connection.u_id, RAW, chunk)
+                # The bytes of an incomplete package wait for the rest of it.
+                data = data + chunk
             except socket.timeout:
                 # LOGGER.debug("timeout")
                 # continue
@@ -974,9 +1752,26 @@ class Klyqa:
             if connection.state == STATE_CONNECTED and (not retry or len(data) == 0):
                 send_next = elapsed >= pause
                 if len(message_queue_tx) > 0 and send_next:
-                    msg, ts = message_queue_tx.pop()
-                    pause = datetime.timedelta(milliseconds=ts)
-                    if not send_msg(connection.socket, msg, connection.sending_aes):
+                    batch = [message_queue_tx.pop()]
+                    # Messages without pause go out in one write with the next one.
+                    while batch[-1][1] == 0 and len(message_queue_tx) > 0:
+                        batch.append(message_queue_tx.pop())
+                    pause = datetime.timedelta(milliseconds=batch[-1][1])
+                    if timeout is not None:
+                        pause = min(pause, datetime.timedelta(seconds=timeout))
+                    LOGGER.debug("Sending: %s", batch)
+                    sent = False
+                    if not congested(connection, TX_TIMEOUT):
+                        package = encoding.encrypt_packages(
+                            [msg for msg, _ in batch], connection.sending_aes
+                        )
+                        sent = send_package(connection, package)
+                    if sent:
+                        for msg, _ in batch:
+                            self.trace.record(TX, connection.u_id, 2, msg)
+                    if not sent:
+                        if connection.u_id:
+                            self.metrics.bulb(connection.u_id).frame_errors += 1
                         """Upon send error, try reconnect to the lamps and append message for transmission again."""
                         try:
                             connection.socket.close()
@@ -985,33 +1780,19 @@ class Klyqa:
                         if reconnect:
                             connection = do_reconnect()
                             if connection:
-                                message_queue_tx.append((msg, ts))
+                                message_queue_tx.extend(reversed(batch))
                             else:
                                 return None
                         else:
                             return None
                     last_send = datetime.datetime.now()
+                    sent_at = time.monotonic()
 
-            if args.party and len(message_queue_tx) < 2:
-                r, g, b = get_random_bytes(3)
-
-                brightness = 50
-                if args.brightness is not None:
-                    brightness = int(args.brightness[0])
-                transition_time = 300
-                if args.transitionTime is not None:
-                    transition_time = int(args.transitionTime[0])
-                message_queue_tx.append(
-                    color_message(r, g, b, transition_time, brightness)
-                )
-                pause = datetime.timedelta(milliseconds=transition_time)
-
-            while len(data):
+            while len(data) >= 4:
                 LOGGER.debug(
-                    "TCP server received "
-                    + str(len(data))
-                    + " bytes from "
-                    + str(connection.address)
+                    "TCP server received %s bytes from %s",
+                    len(data),
+                    connection.address,
                 )
 
                 pkg_len = data[0] * 256 + data[1]
@@ -1025,50 +1806,102 @@ class Klyqa:
                 data = data[4 + pkg_len :]
 
                 if connection.state == STATE_WAIT_IV and pkg_type == 0:
-                    LOGGER.debug("Plain: " + str(pkg))
+                    LOGGER.debug("Plain: %s", pkg)
                     response_object = json.loads(pkg)
                     connection.u_id = response_object["ident"]["unit_id"]
+                    self.trace.record(
+                        RX, connection.u_id, 0, pkg.decode("utf-8", "replace")
+                    )
                     for device in self._settings["devices"]:
                         if device["localDeviceId"] == connection.u_id:
                             aes_key = bytes.fromhex(device["aesKey"])
                             break
 
-                    connection.socket.send(bytes([0, 8, 0, 1]) + connection.local_iv)
+                    send_package(connection, bytes([0, 8, 0, 1]) + connection.local_iv)
+                    self.trace.record(TX, connection.u_id, 1, connection.local_iv)
 
                 if connection.state == STATE_WAIT_IV and pkg_type == 1:
                     connection.remote_iv = pkg
+                    self.trace.record(RX, connection.u_id, 1, pkg)
 
-                    connection.sending_aes = AES.new(
-                        aes_key,
-                        AES.MODE_CBC,
-                        iv=connection.local_iv + connection.remote_iv,
+                    connection.sending_aes = new_aes(
+                        aes_key, connection.local_iv + connection.remote_iv
                     )
-                    connection.receiving_aes = AES.new(
-                        aes_key,
-                        AES.MODE_CBC,
-                        iv=connection.remote_iv + connection.local_iv,
+                    connection.receiving_aes = new_aes(
+                        aes_key, connection.remote_iv + connection.local_iv
                     )
 
                     connection.state = STATE_CONNECTED
+                    self.metrics.bulb(connection.u_id).handshake.observe(
+                        time.monotonic() - started
+                    )
 
                 elif connection.state == STATE_CONNECTED and pkg_type == 2:
-                    cipher = pkg
-
-                    response_plain = connection.receiving_aes.decrypt(cipher)
-                    response_decoded = ""
-                    try:
-                        response_decoded = response_plain.decode("utf-8")
-                    except Exception as exception:
-                        response_decoded = str(response_plain)
-                    uid = connection.u_id + " " if connection.u_id else ""
-                    LOGGER.debug("Decrypted: " + uid + response_decoded)
-                    try:
-                        response = json.loads(response_decoded)
-                    except Exception as exception:
-                        return
-                    if connection.u_id and connection.u_id in self.lights:
-                        self.lights[connection.u_id].state = response
-                    return response
+                    if sent_at is not None and not retry:
+                        measure_rtt(connection, time.monotonic() - sent_at)
+                        self.metrics.bulb(connection.u_id).rtt.observe(
+                            time.monotonic() - sent_at
+                        )
+                    # Answers after this one are read in order by the next command.
+                    connection.rx_buffer = data
+                    return self._decrypt_answer(connection, pkg)
+
+    def _decrypt_answer(self, connection: Connection, cipher) -> dict:
+        """Decrypt an answer of the bulb and keep its state."""
+        # Errors before the bulb identified itself are counted nowhere.
+        metrics = (
+            self.metrics.bulb(connection.u_id) if connection.u_id else BulbMetrics()
+        )
+        try:
+            response_plain = connection.receiving_aes.decrypt(cipher)
+        except ValueError:
+            metrics.frame_errors += 1
+            return None
+        response_decoded = ""
+        try:
+            response_decoded = response_plain.decode("utf-8")
+        except Exception as exception:
+            metrics.decrypt_errors += 1
+            response_decoded = str(response_plain)
+        LOGGER.debug("Decrypted: %s %s", connection.u_id, response_decoded)
+        self.trace.record(RX, connection.u_id, 2, response_decoded)
+        try:
+            response = json.loads(response_decoded)
+        except Exception as exception:
+            metrics.json_errors += 1
+            return None
+        connection.last_seen = time.monotonic()
+        status = BulbStatus.from_response(response)
+        if status and connection.u_id and connection.u_id in self.lights:
+            self.lights[connection.u_id].status = status
+            self.lights[connection.u_id].status_at = connection.last_seen
+        return response
+
+    def _read_pending(self, connection: Connection):
+        """Read the answers the bulb sent since the last command.
+
+        The receiving cipher is chained, so every answer has to be decrypted in order
+        even if nobody waits for it. The bytes of an incomplete package are
+        kept for the next read.
+        """
+        data = connection.rx_buffer
+        connection.rx_buffer = b""
+        while True:
+            try:
+                chunk = connection.socket.recv(4096)
+            except (socket.timeout, BlockingIOError):
+                break
+            except OSError:
+                return
+            if len(chunk) == 0:
+                break
+            self.trace.record(RX, connection.u_id, RAW, chunk)
+            data += chunk
+
+        packages, connection.rx_buffer = encoding.split_packages(data)
+        for pkg_type, pkg in packages:
+            if pkg_type == 2:
+                self._decrypt_answer(connection, pkg)
 
     def _load_cache(self):
         """Load existing cache and merge for updating if required."""
@@ -1086,6 +1919,8 @@ class Klyqa:
 
     def _load_cache_filesystem(self):
         """Load cache file from the filesystem."""
+        import pickle
+
         filename = self._cache_path
         with open(filename, "rb") as handle:
             try:
@@ -1107,6 +1942,8 @@ class Klyqa:
         return dct
 
     def _save_cache(self, data=None):
+        import pickle
+
         filename = self._cache_path
         data = self._cache
         """Save login data to file."""
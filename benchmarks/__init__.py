@@ -0,0 +1,5 @@
+"""Benchmarks of the Klyqa integration.
+
+Run a benchmark as module from the Home Assistant config directory, e.g.
+python -m custom_components.klyqa.benchmarks.encoding
+"""
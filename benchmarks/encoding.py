@@ -0,0 +1,85 @@
+"""Micro-benchmarks of the bulb command encoding.
+
+Compares the templates and the single step padding of the encoding module
+with serializing dicts by json.dumps and padding byte by byte.
+"""
+from __future__ import annotations
+
+import json
+import os
+import timeit
+
+# pycryptodome
+try:
+    from Cryptodome.Cipher import AES
+except:
+    from Crypto.Cipher import AES
+
+from .. import encoding
+
+NUMBER = 20000
+
+
+def _dumps_color(red, green, blue, transition) -> str:
+    return json.dumps(
+        {
+            "type": "request",
+            "color": {"red": red, "green": green, "blue": blue},
+            "transitionTime": transition,
+        }
+    )
+
+
+def _pad_bytewise(data: bytes) -> bytes:
+    while len(data) % 16:
+        data = data + bytes([0x20])
+    return data
+
+
+def _encrypt_bytewise(message, sending_aes) -> bytes:
+    encrypted = sending_aes.encrypt(_pad_bytewise(message.encode("utf-8")))
+    return bytes([len(encrypted) // 256, len(encrypted) % 256, 0, 2]) + encrypted
+
+
+def _aes():
+    return AES.new(os.urandom(16), AES.MODE_CBC, os.urandom(16))
+
+
+def _per_command(statement) -> float:
+    """Best time of one call in microseconds."""
+    return min(timeit.repeat(statement, number=NUMBER, repeat=5)) / NUMBER * 1e6
+
+
+def run() -> dict:
+    """Time the encoding of one color command, per step and in total."""
+    message = encoding.color_payload(255, 128, 0, 100)
+    frames = [encoding.color_payload(x, 128, 0, 100) for x in range(10)]
+    aes = _aes()
+
+    return {
+        "payload_dumps_us": _per_command(lambda: _dumps_color(255, 128, 0, 100)),
+        "payload_template_us": _per_command(
+            lambda: encoding.color_payload(255, 128, 0, 100)
+        ),
+        "pad_bytewise_us": _per_command(lambda: _pad_bytewise(message.encode())),
+        "pad_single_step_us": _per_command(lambda: encoding.pad(message.encode())),
+        "command_before_us": _per_command(
+            lambda: _encrypt_bytewise(_dumps_color(255, 128, 0, 100), aes)
+        ),
+        "command_after_us": _per_command(
+            lambda: encoding.encrypt_package(
+                encoding.color_payload(255, 128, 0, 100), aes
+            )
+        ),
+        "ten_frames_separate_us": _per_command(
+            lambda: b"".join(encoding.encrypt_package(x, aes) for x in frames)
+        ),
+        "ten_frames_one_buffer_us": _per_command(
+            lambda: encoding.encrypt_packages(frames, aes)
+        ),
+    }
+
+
+if __name__ == "__main__":
+    for name, result in run().items():
+        print(f"{name:28} {result:8.2f}")
@@ -0,0 +1,179 @@
+"""Load test of one integration instance with a large account.
+
+Sets up the light platform for hundreds of emulated bulbs and checks the
+scale targets of the README: discovery time, setup time, memory and file
+descriptors per bulb, and the cloud and thread pool load of the polling.
+Exits with status 1 when a target is missed:
+python -m custom_components.klyqa.benchmarks.scale --bulbs 500
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from homeassistant.const import CONF_HOST, CONF_PASSWORD, CONF_USERNAME
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers import area_registry as ar
+
+from ..api import Klyqa, raise_fd_limit
+from ..const import DOMAIN
+from ..emulator import Fleet, NetworkConditions
+from ..emulator.cloud import CloudStub, make_account
+from ..light import POLLS_PER_SECOND, KlyqaLight, async_setup_klyqa, poll_interval
+from .suite import LoopMonitor
+
+"""Upper bounds of the results, per bulb where named so."""
+TARGETS = {
+    "discovery_seconds": 10.0,
+    "undiscovered": 0,
+    "setup_seconds": 2.0,
+    "memory_per_bulb_kib": 64.0,
+    "fds_per_bulb": 1.05,
+    "poll_round_ratio": 1.2,
+    "cloud_requests_per_round": 1,
+    "rejected_jobs": 0,
+}
+
+
+def open_fds() -> int:
+    """Open file descriptors of the process, 0 where /proc is missing."""
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return 0
+
+
+async def poll_round(lights: list[KlyqaLight]) -> float:
+    """Update every light once at the rate of the polling, return the seconds."""
+
+    async def update(index, light):
+        await asyncio.sleep(index / POLLS_PER_SECOND)
+        await light.async_update()
+
+    started = time.monotonic()
+    await asyncio.gather(*[update(i, x) for i, x in enumerate(lights)])
+    return time.monotonic() - started
+
+
+async def run(args: argparse.Namespace) -> dict:
+    hass = HomeAssistant()
+    hass.config.config_dir = tempfile.mkdtemp()
+    await ar.async_load(hass)
+    settings = make_account(
+        args.bulbs,
+        rooms=args.bulbs // 10,
+        routines=args.bulbs // 20,
+        timers=args.bulbs // 20,
+        seed=args.seed,
+    )
+    fleet = Fleet(
+        settings["devices"],
+        NetworkConditions(latency=args.latency / 1000, seed=args.seed),
+    )
+    cloud = CloudStub(settings)
+    # Room for the ends of the emulated bulbs in this process as well.
+    raise_fd_limit(2 * args.bulbs)
+    await fleet.start()
+    host = await cloud.start()
+
+    monitor = LoopMonitor()
+    monitor.start()
+    fds = open_fds()
+    tracemalloc.start()
+    memory = tracemalloc.get_traced_memory()[0]
+
+    klyqa = Klyqa("scale@klyqa.de", "scale", host, hass, sync_rooms=False)
+    hass.data[DOMAIN] = klyqa
+    results = {"bulbs": args.bulbs, "targets": TARGETS}
+    try:
+        await klyqa.executor.async_add_job(klyqa.login)
+        await klyqa.executor.async_add_job(klyqa.load_settings)
+
+        started = time.monotonic()
+        await klyqa.async_search_lights(seconds_to_discover=args.discovery_seconds)
+        results["discovery_seconds"] = round(time.monotonic() - started, 3)
+        results["undiscovered"] = args.bulbs - len(klyqa.lights)
+
+        entities = []
+        started = time.monotonic()
+        await async_setup_klyqa(
+            hass,
+            {CONF_USERNAME: "scale@klyqa.de", CONF_PASSWORD: "scale", CONF_HOST: host},
+            entities.extend,
+        )
+        results["setup_seconds"] = round(time.monotonic() - started, 3)
+        results["entities"] = len(entities)
+
+        memory = tracemalloc.get_traced_memory()[0] - memory
+        tracemalloc.stop()
+        results["memory_per_bulb_kib"] = round(memory / args.bulbs / 1024, 2)
+        # The emulated bulbs run in this process, their ends of the
+        # connections are not counted.
+        results["fds_per_bulb"] = round(
+            (open_fds() - fds - fleet.connected()) / args.bulbs, 3
+        )
+
+        lights = [x for x in entities if isinstance(x, KlyqaLight)]
+        for light in lights:
+            light.hass = hass
+        interval = poll_interval(args.bulbs).total_seconds()
+        requests = []
+        rounds = []
+        for _ in range(args.rounds):
+            # Stale settings, the worst case of a round.
+            klyqa._settings_loaded = 0.0
+            before = sum(cloud.requests.values())
+            rounds.append(await poll_round(lights))
+            requests.append(sum(cloud.requests.values()) - before)
+        results["poll_interval_seconds"] = interval
+        results["poll_round_seconds"] = [round(x, 3) for x in rounds]
+        results["poll_round_ratio"] = round(max(rounds) / interval, 3)
+        # The first round requests the product configs once per product.
+        results["cloud_requests_per_round"] = max(requests[1:] or requests)
+        results["cloud_requests_first_round"] = requests[0]
+        results["rejected_jobs"] = klyqa.executor.rejected
+        results["thread_pool"] = klyqa.executor.metrics()
+        results["loop_blocking"] = monitor.stop()
+    finally:
+        await klyqa.async_stop()
+        await fleet.stop()
+        await cloud.stop()
+
+    results["missed"] = {
+        name: results.get(name)
+        for name, target in TARGETS.items()
+        if results.get(name) is None or results[name] > target
+    }
+    return results
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Klyqa integration load test")
+    parser.add_argument("--bulbs", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=5, help="milliseconds")
+    parser.add_argument("--discovery-seconds", type=int, default=30)
+    parser.add_argument("--rounds", type=int, default=2, help="poll rounds")
+    parser.add_argument("--output", help="json file, default stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+    return 1 if results["missed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
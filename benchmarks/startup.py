@@ -0,0 +1,226 @@
+"""Import and setup time of the integration, guarded against regressions.
+
+Measures in a fresh interpreter how long the integration modules take to
+import on top of the Home Assistant modules they use, and which modules
+they load. Then times the setup of a config entry until the light entities
+exist and until all of them are available, against emulated bulbs and the
+cloud stub, on a first start and on a start with stored settings. Exits with status
+1 when a budget is exceeded or a lazily imported module is loaded on import:
+python -m custom_components.klyqa.benchmarks.startup
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from homeassistant.const import (
+    CONF_HOST,
+    CONF_PASSWORD,
+    CONF_USERNAME,
+    EVENT_HOMEASSISTANT_FINAL_WRITE,
+)
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers import area_registry as ar
+
+from ..api import Klyqa
+from ..const import DOMAIN
+from ..emulator import Fleet, NetworkConditions
+from ..emulator.cloud import CloudConditions, CloudStub, make_account
+from ..light import KlyqaLight, async_setup_klyqa
+
+PACKAGE = __package__.rpartition(".")[0]
+"""Folder the package is imported from, the config folder for custom_components.klyqa."""
+IMPORT_ROOT = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), *[".."] * (PACKAGE.count(".") + 2))
+)
+
+"""Modules Home Assistant has loaded before the integration is imported."""
+BASELINE = (
+    "homeassistant.config_entries",
+    "homeassistant.components.diagnostics",
+    "homeassistant.components.light",
+    "homeassistant.components.sensor",
+    "homeassistant.helpers.config_validation",
+    "homeassistant.helpers.entity_platform",
+)
+MODULES = ("", ".config_flow", ".light", ".sensor", ".diagnostics")
+"""Modules the integration only imports where they are used."""
+LAZY = (
+    "Crypto",
+    "Cryptodome",
+    "argparse",
+    "numpy",
+    "pickle",
+    "requests",
+)
+
+"""The setup budget is until all lights are available on a first start, the
+warm budget until the entities exist when the settings of the last run are
+stored."""
+BUDGETS = {
+    "import_seconds": 0.1,
+    "setup_seconds": 2.0,
+    "warm_entities_seconds": 0.2,
+}
+
+IMPORT_SCRIPT = """
+import importlib, json, sys, time
+for name in {baseline!r}:
+    importlib.import_module(name)
+before = set(sys.modules)
+started = time.perf_counter()
+for name in {modules!r}:
+    importlib.import_module({package!r} + name)
+seconds = time.perf_counter() - started
+print(json.dumps({{"seconds": seconds, "modules": sorted(set(sys.modules) - before)}}))
+"""
+
+
+def measure_import(timeout=None) -> dict:
+    """Import the integration in a new interpreter."""
+    script = IMPORT_SCRIPT.format(baseline=BASELINE, modules=MODULES, package=PACKAGE)
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        check=True,
+        cwd=IMPORT_ROOT,
+        text=True,
+        timeout=timeout,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+async def measure_setup(hass: HomeAssistant, host, timeout) -> dict:
+    """Set up the integration like a config entry until all lights are available."""
+    entities = []
+    started = time.monotonic()
+    klyqa = Klyqa("startup@klyqa.de", "startup", host, hass, sync_rooms=False)
+    hass.data[DOMAIN] = klyqa
+    try:
+        if not await klyqa.async_load_cached_settings():
+            await klyqa.executor.async_add_job(klyqa.login)
+            await klyqa.executor.async_add_job(klyqa.load_settings)
+        await async_setup_klyqa(
+            hass,
+            {
+                CONF_USERNAME: "startup@klyqa.de",
+                CONF_PASSWORD: "startup",
+                CONF_HOST: host,
+            },
+            entities.extend,
+        )
+        entities_seconds = time.monotonic() - started
+        lights = [x for x in entities if isinstance(x, KlyqaLight)]
+
+        def available():
+            return sum(x.available and x.is_on is not None for x in lights)
+
+        while available() < len(lights) and time.monotonic() - started < timeout:
+            await asyncio.sleep(0.01)
+        return {
+            "entities_seconds": round(entities_seconds, 3),
+            "available_seconds": round(time.monotonic() - started, 3),
+            "lights": len(lights),
+            "available": available(),
+        }
+    finally:
+        await klyqa.async_stop()
+        await hass.async_block_till_done()
+        hass.data.pop(DOMAIN)
+
+
+async def measure_starts(args: argparse.Namespace) -> dict:
+    """Time a first start and a start with the settings stored by the first."""
+    hass = HomeAssistant()
+    hass.config.config_dir = tempfile.mkdtemp()
+    await ar.async_load(hass)
+    settings = make_account(args.bulbs, rooms=args.bulbs // 10, seed=args.seed)
+    fleet = Fleet(
+        settings["devices"],
+        NetworkConditions(latency=args.latency / 1000, seed=args.seed),
+    )
+    cloud = CloudStub(settings, CloudConditions(latency=args.cloud_latency / 1000))
+    await fleet.start()
+    host = await cloud.start()
+    try:
+        cold = await measure_setup(hass, host, args.timeout)
+        # Write the stored settings and let the bulbs notice the closed connections.
+        hass.bus.async_fire(EVENT_HOMEASSISTANT_FINAL_WRITE)
+        await hass.async_block_till_done()
+        while fleet.connected():
+            await asyncio.sleep(0.01)
+        warm = await measure_setup(hass, host, args.timeout)
+    finally:
+        await fleet.stop()
+        await cloud.stop()
+    return {"cold": cold, "warm": warm}
+
+
+def run(args: argparse.Namespace, timeout=None) -> dict:
+    """
+    Measure the imports and the starts against the budgets.
+
+    Args:
+        timeout (float): Seconds each import and both starts may take at most,
+            a hanging run raises a TimeoutError instead of blocking.
+    """
+    imports = [measure_import(timeout) for _ in range(args.repeat)]
+    starts = asyncio.run(asyncio.wait_for(measure_starts(args), timeout))
+    lazy = sorted({x for x in imports[0]["modules"] if x.partition(".")[0] in LAZY})
+    results = {
+        "budgets": BUDGETS,
+        "import_seconds": round(min(x["seconds"] for x in imports), 4),
+        "imported_modules": len(imports[0]["modules"]),
+        "lazy_modules_imported": lazy,
+        "setup_seconds": starts["cold"]["available_seconds"],
+        "warm_entities_seconds": starts["warm"]["entities_seconds"],
+        "starts": starts,
+    }
+    results["missed"] = {
+        name: results[name]
+        for name, budget in BUDGETS.items()
+        if results[name] > budget
+    }
+    if lazy:
+        results["missed"]["lazy_modules_imported"] = lazy
+    for name, start in starts.items():
+        if start["available"] < start["lights"]:
+            results["missed"][name + "_unavailable_lights"] = (
+                start["lights"] - start["available"]
+            )
+    return results
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Klyqa integration startup time")
+    parser.add_argument("--bulbs", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=5, help="milliseconds")
+    parser.add_argument("--cloud-latency", type=float, default=100, help="milliseconds")
+    parser.add_argument(
+        "--timeout", type=float, default=10, help="seconds to wait for the lights"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="import runs")
+    parser.add_argument("--output", help="json file, default stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    results = run(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+    return 1 if results["missed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
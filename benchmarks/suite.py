@@ -0,0 +1,245 @@
+"""Benchmarks of the integration against emulated bulbs and a stub cloud.
+
+Measures the discovery time of the fleet, the turn on latency through
+KlyqaLight.async_turn_on, the sustained command throughput and how long the
+event loop was blocked meanwhile. The results are written as json, so runs of
+different versions can be compared:
+python -m custom_components.klyqa.benchmarks.suite --bulbs 50 --output before.json
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import tempfile
+import time
+
+from homeassistant.core import HomeAssistant
+
+from ..api import Klyqa
+from ..const import DOMAIN
+from ..emulator import Fleet, NetworkConditions
+from ..emulator.cloud import CloudStub, make_account
+from ..light import KlyqaLight
+
+"""Command of the throughput benchmark, with a transition the bulb answers in."""
+COMMAND = ("--color", "255", "120", "0", "--transitionTime", "100")
+
+
+def percentiles(samples) -> dict:
+    """p50, p95, p99 and maximum of the samples in seconds, as milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "p50_ms": round(rank(0.5) * 1000, 2),
+        "p95_ms": round(rank(0.95) * 1000, 2),
+        "p99_ms": round(rank(0.99) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+class LoopMonitor:
+    """Measures how late the event loop wakes up a task sleeping INTERVAL seconds."""
+
+    INTERVAL = 0.005
+    """Lags above are counted as blocking."""
+    BLOCKING = 0.05
+
+    def __init__(self):
+        self.lags: list[float] = []
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.INTERVAL
+            await asyncio.sleep(self.INTERVAL)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+    def stop(self) -> dict:
+        self._task.cancel()
+        blocking = [x for x in self.lags if x > self.BLOCKING]
+        return {
+            **percentiles(self.lags),
+            "blocked_ms": round(sum(blocking) * 1000, 1),
+            "blocking_count": len(blocking),
+        }
+
+
+async def bench_discovery(klyqa: Klyqa, seconds_to_discover) -> dict:
+    started = time.monotonic()
+    await klyqa.async_search_lights(seconds_to_discover=seconds_to_discover)
+    return {
+        "bulbs": len(klyqa._settings["devices"]),
+        "found": len(klyqa.lights),
+        "seconds": round(time.monotonic() - started, 3),
+    }
+
+
+async def bench_turn_on(hass: HomeAssistant, klyqa: Klyqa, count) -> dict:
+    """Turn on the lights one after another with changing colors."""
+    lights = []
+    for device in klyqa._settings["devices"]:
+        if device["localDeviceId"] not in klyqa.lights:
+            continue
+        light = KlyqaLight(
+            device,
+            klyqa.lights[device["localDeviceId"]],
+            klyqa,
+            "light.benchmark_" + device["localDeviceId"],
+            should_poll=False,
+            rooms=[],
+            timers=[],
+            routines=[],
+        )
+        light.hass = hass
+        lights.append(light)
+    if not lights:
+        return percentiles([])
+
+    samples = []
+    for index in range(count):
+        light = lights[index % len(lights)]
+        started = time.monotonic()
+        await light.async_turn_on(rgb_color=(index % 256, 255 - index % 256, 0))
+        samples.append(time.monotonic() - started)
+    return percentiles(samples)
+
+
+def _send_commands(klyqa: Klyqa, u_ids, deadline) -> tuple[int, int]:
+    sent = answered = 0
+    while time.monotonic() < deadline:
+        for u_id in u_ids:
+            sent += 1
+            answered += bool(klyqa.send_to_bulb(*COMMAND, u_id=u_id))
+    return sent, answered
+
+
+async def bench_throughput(klyqa: Klyqa, seconds) -> dict:
+    """Commands per second to a single bulb and to the whole fleet."""
+    u_ids = list(klyqa.lights)
+    if not u_ids:
+        return {}
+
+    started = time.monotonic()
+    _, single = await klyqa.executor.async_add_job(
+        _send_commands, klyqa, u_ids[:1], started + seconds, timeout=None
+    )
+    single_seconds = time.monotonic() - started
+
+    workers = klyqa.executor.max_workers
+    started = time.monotonic()
+    results = await asyncio.gather(
+        *[
+            klyqa.executor.async_add_job(
+                _send_commands,
+                klyqa,
+                u_ids[index::workers],
+                started + seconds,
+                timeout=None,
+            )
+            for index in range(min(workers, len(u_ids)))
+        ]
+    )
+    fleet_seconds = time.monotonic() - started
+    sent = sum(x[0] for x in results)
+    answered = sum(x[1] for x in results)
+    return {
+        "single_bulb_cps": round(single / single_seconds, 1),
+        "fleet_cps": round(answered / fleet_seconds, 1),
+        "fleet_per_bulb_cps": round(answered / fleet_seconds / len(u_ids), 2),
+        "fleet_unanswered": sent - answered,
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    hass = HomeAssistant()
+    hass.config.config_dir = tempfile.mkdtemp()
+    settings = make_account(args.bulbs, seed=args.seed)
+
+    fleet = Fleet(
+        settings["devices"],
+        NetworkConditions(
+            latency=args.latency / 1000,
+            jitter=args.jitter / 1000,
+            fragment=args.fragment,
+            drop=args.drop,
+            seed=args.seed,
+        ),
+    )
+    cloud = CloudStub(settings)
+    await fleet.start()
+    host = await cloud.start()
+
+    monitor = LoopMonitor()
+    monitor.start()
+    klyqa = Klyqa("benchmark@klyqa.de", "benchmark", host, hass, sync_rooms=False)
+    hass.data[DOMAIN] = klyqa
+    try:
+        await klyqa.executor.async_add_job(klyqa.login)
+        await klyqa.executor.async_add_job(klyqa.load_settings)
+        results = {
+            "label": args.label,
+            "python": platform.python_version(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "bulbs": args.bulbs,
+            "conditions": {
+                "latency_ms": args.latency,
+                "jitter_ms": args.jitter,
+                "fragment": args.fragment,
+                "drop": args.drop,
+            },
+            "discovery": await bench_discovery(klyqa, args.discovery_seconds),
+            "turn_on": await bench_turn_on(hass, klyqa, args.turn_ons),
+            "throughput": await bench_throughput(klyqa, args.seconds),
+            "cloud": cloud.stats(),
+            "thread_pool": klyqa.executor.metrics(),
+        }
+        results["loop_blocking"] = monitor.stop()
+    finally:
+        await klyqa.async_stop()
+        await fleet.stop()
+        await cloud.stop()
+    return results
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Klyqa integration benchmarks")
+    parser.add_argument("--bulbs", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=5, help="milliseconds")
+    parser.add_argument("--jitter", type=float, default=2, help="milliseconds")
+    parser.add_argument("--fragment", type=float, default=0)
+    parser.add_argument("--drop", type=float, default=0)
+    parser.add_argument("--discovery-seconds", type=int, default=10)
+    parser.add_argument("--turn-ons", type=int, default=100)
+    parser.add_argument("--seconds", type=float, default=5, help="per throughput run")
+    parser.add_argument("--label", default="", help="name of the run, e.g. a version")
+    parser.add_argument("--output", help="json file, default stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> dict:
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
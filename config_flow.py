@@ -1,29 +1,21 @@
 """Config flow for Klyqa."""
 # import my_pypi_dependency
 
-from typing import Any, cast
-from numpy import integer
+from typing import cast
 
-from requests.exceptions import ConnectTimeout, HTTPError
 import voluptuous as vol
 
-from homeassistant.core import HomeAssistant
-from homeassistant.helpers import config_entry_flow
-
-from . import api
 from .api import Klyqa
-from .const import CONF_POLLING, DEFAULT_CACHEDB, DOMAIN, LOGGER
-import homeassistant.helpers.config_validation as cv
+from .const import DOMAIN, LOGGER
 
 from homeassistant import config_entries
 from homeassistant.const import (
     CONF_PASSWORD,
     CONF_HOST,
     CONF_SCAN_INTERVAL,
-    CONF_ROOM,
     CONF_USERNAME,
 )
-from .const import CONF_SYNC_ROOMS
+from .const import CONF_PUSH, CONF_SYNC_ROOMS
 from homeassistant.data_entry_flow import FlowResult
 
 # user_step_data_schema = {
@@ -40,6 +32,7 @@ user_step_data_schema = {
     vol.Required(CONF_PASSWORD, default="testpwd1"): str,
     vol.Required(CONF_SCAN_INTERVAL, default=60): int,
     vol.Required(CONF_SYNC_ROOMS, default=True): bool,
+    vol.Required(CONF_PUSH, default=False): bool,
     vol.Required(CONF_HOST, default="http://localhost:3000"): str,
 }
 
@@ -83,6 +76,7 @@ class KlyqaConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
         self._password: str | None = None
         self._cache: str | None = None
         self._scan_interval: int = 30
+        self._push: bool = False
         self._host: str | None = None
         self._klyqa = None
         pass
@@ -117,6 +111,7 @@ class KlyqaConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
         self._password = user_input[CONF_PASSWORD]
         self._scan_interval = user_input[CONF_SCAN_INTERVAL]
         self._sync_rooms = user_input[CONF_SYNC_ROOMS]
+        self._push = user_input[CONF_PUSH]
         self._host = user_input[CONF_HOST]
 
         return await self._async_klyqa_login(step_id="user")
@@ -125,41 +120,30 @@ class KlyqaConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
         """Handle login with Klyqa."""
         # self._cache = self.hass.config.path(DEFAULT_CACHEDB)
         errors = {}
-        if DOMAIN in self.hass.data:
-            self._klyqa = self.hass.data[DOMAIN]
-            try:
-                await self.hass.async_add_executor_job(self._klyqa.shutdown)
-            except Exception as e:
-                pass
-
+        klyqa = Klyqa(
+            self._username,
+            self._password,
+            self._host,
+            self.hass,
+            sync_rooms=self._sync_rooms,
+            push_notifications=self._push,
+        )
         try:
-
-            self._klyqa: Klyqa = Klyqa(
-                self._username,
-                self._password,
-                self._host,
-                self.hass,
-                sync_rooms=self._sync_rooms,
-            )
-            if not await self.hass.async_add_executor_job(
-                self._klyqa.login,
-            ):
+            if not await klyqa.executor.async_add_job(klyqa.login):
                 raise Exception("Unable to login")
-
-            if self._klyqa:
-                self.hass.data[DOMAIN] = self._klyqa
-
-        except (ConnectTimeout, HTTPError):
-            LOGGER.error("Unable to connect to Klyqa: %s", ex)
-            errors = {"base": "cannot_connect"}
-
         except Exception as ex:
-
             LOGGER.error("Unable to connect to Klyqa: %s", ex)
             errors = {"base": "cannot_connect"}
-
-        if not self._klyqa or not self._klyqa._access_token:
-            errors = {"base": "cannot_connect"}
+            klyqa.executor.shutdown()
+        else:
+            # Retire the running instance only once the new one is logged in.
+            if DOMAIN in self.hass.data:
+                try:
+                    await self.hass.data[DOMAIN].async_stop()
+                except Exception:
+                    pass
+            self.hass.data[DOMAIN] = klyqa
+            self._klyqa = klyqa
 
         if errors:
             return self.async_show_form(
@@ -177,6 +161,7 @@ class KlyqaConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             CONF_PASSWORD: self._password,
             CONF_SCAN_INTERVAL: self._scan_interval,
             CONF_SYNC_ROOMS: self._sync_rooms,
+            CONF_PUSH: self._push,
             CONF_HOST: self._host,
         }
         existing_entry = await self.async_set_unique_id(self._username)
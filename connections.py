@@ -0,0 +1,148 @@
+"""Keeps the bulbs of the account connected with an established session."""
+from __future__ import annotations
+
+import asyncio
+import time
+
+from .const import LOGGER
+
+
+def network_addresses() -> frozenset:
+    """IPv4 addresses of the network interfaces, empty if they cannot be listed."""
+    try:
+        import ifaddr
+    except ImportError:
+        return frozenset()
+    return frozenset(
+        ip.ip
+        for adapter in ifaddr.get_adapters()
+        for ip in adapter.ips
+        if ip.is_IPv4 and not ip.ip.startswith("127.")
+    )
+
+
+class ConnectionManager:
+    """Reconciles the bulb connections with the devices of the account.
+
+    A reconcile pings the connections idle for KEEPALIVE_IDLE seconds, closing
+    the dead ones, and searches when devices of the account have no
+    connection. So the first command after a long idle time or an outage of
+    the bulb finds it connected with its session established, instead of
+    paying for the search and the handshake. A bulb coming back online only
+    connects when it hears a search, searches without a new bulb back off up
+    to MAX_BACKOFF seconds. Reconciles run every INTERVAL seconds, one that
+    finds the addresses of the network interfaces changed pings every
+    connection and searches at once.
+    """
+
+    INTERVAL = 30.0
+    KEEPALIVE_IDLE = 60.0
+    SEARCH_SECONDS = 3
+    MAX_BACKOFF = 600.0
+
+    def __init__(self, klyqa):
+        self._klyqa = klyqa
+        self._task: asyncio.Task | None = None
+        self._addresses: frozenset | None = None
+        self._backoff = self.INTERVAL
+        self._next_search = 0.0
+        self.reconciles = 0
+        self.searches = 0
+        self.pings = 0
+        self.closed = 0
+        self.network_changes = 0
+
+    def start(self) -> None:
+        """Reconcile every INTERVAL seconds until stopped."""
+        if self._task is None and not self._klyqa._stopped:
+            self._task = self._klyqa.hass.async_create_task(self._async_run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def missing(self) -> list[str]:
+        """Devices of the account without an open connection."""
+        lights = self._klyqa.lights
+        return [
+            u_id
+            for u_id in self._klyqa._devices
+            if u_id not in lights
+            or not lights[u_id].connection
+            or not lights[u_id].connection.socket
+            or lights[u_id].connection.socket._closed
+        ]
+
+    def stats(self) -> dict:
+        return {
+            "missing": len(self.missing()),
+            "reconciles": self.reconciles,
+            "searches": self.searches,
+            "pings": self.pings,
+            "closed": self.closed,
+            "network_changes": self.network_changes,
+            "search_backoff": self._backoff,
+        }
+
+    async def _async_run(self):
+        while True:
+            await asyncio.sleep(self.INTERVAL)
+            try:
+                await self.async_reconcile()
+            except Exception as exception:
+                LOGGER.warning("Klyqa connection reconcile failed: %s", exception)
+
+    async def async_reconcile(self) -> None:
+        """Keep the open connections alive and search the missing bulbs."""
+        self.reconciles += 1
+        klyqa = self._klyqa
+        idle = self.KEEPALIVE_IDLE
+        addresses = await klyqa.executor.async_add_job(network_addresses)
+        if self._addresses is not None and addresses != self._addresses:
+            LOGGER.info("Network addresses changed, reconnecting the Klyqa bulbs")
+            self.network_changes += 1
+            # Connections over a lost address stay open until written to.
+            idle = 0.0
+            self._backoff = self.INTERVAL
+            self._next_search = 0.0
+        self._addresses = addresses
+
+        await self._async_keepalive(idle)
+
+        missing = len(self.missing())
+        if not missing or time.monotonic() < self._next_search:
+            return
+        self.searches += 1
+        await klyqa.async_search_lights(seconds_to_discover=self.SEARCH_SECONDS)
+        if len(self.missing()) < missing:
+            self._backoff = self.INTERVAL
+        else:
+            self._backoff = min(self._backoff * 2, self.MAX_BACKOFF)
+        self._next_search = time.monotonic() + self._backoff
+
+    async def _async_keepalive(self, idle) -> None:
+        """Ping the connections without an answer for idle seconds."""
+        klyqa = self._klyqa
+        now = time.monotonic()
+        u_ids = [
+            u_id
+            for u_id, device in list(klyqa.lights.items())
+            if device.connection
+            and device.connection.socket
+            and not device.connection.socket._closed
+            and now - device.connection.last_seen >= idle
+        ]
+        # One batch per pool size, the pool queue stays free for commands.
+        batch_size = klyqa.executor.max_workers
+        for index in range(0, len(u_ids), batch_size):
+            batch = u_ids[index : index + batch_size]
+            results = await asyncio.gather(
+                *[
+                    klyqa.executor.async_add_job(klyqa._ping_connection, x)
+                    for x in batch
+                ],
+                return_exceptions=True,
+            )
+            self.pings += len(batch)
+            self.closed += sum(x is None for x in results)
@@ -14,3 +14,4 @@ DOMAIN = "klyqa"
 DEFAULT_CACHEDB = "klyqa.cache"
 CONF_POLLING = "polling"
 CONF_SYNC_ROOMS = "sync_rooms"
+CONF_PUSH = "push_notifications"
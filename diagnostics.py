@@ -0,0 +1,48 @@
+"""Diagnostics of the Klyqa integration."""
+from __future__ import annotations
+
+from homeassistant.components.diagnostics import async_redact_data
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.const import CONF_PASSWORD, CONF_USERNAME
+from homeassistant.core import HomeAssistant
+
+from .api import Klyqa
+from .const import DOMAIN
+
+TO_REDACT = {CONF_PASSWORD, CONF_USERNAME}
+
+
+async def async_get_config_entry_diagnostics(
+    hass: HomeAssistant, entry: ConfigEntry
+) -> dict:
+    """Return the connection, command and cloud metrics of the Klyqa bulbs."""
+    klyqa: Klyqa = hass.data[DOMAIN]
+    return {
+        "entry": async_redact_data(entry.as_dict(), TO_REDACT),
+        "bulbs": {
+            u_id: {
+                "connected": bool(
+                    device.connection
+                    and device.connection.socket
+                    and not device.connection.socket._closed
+                ),
+                "rtt_ms": round(device.connection.rtt * 1000, 1)
+                if device.connection
+                else None,
+                "status": repr(device.status),
+            }
+            for u_id, device in klyqa.lights.items()
+        },
+        "metrics": klyqa.metrics.as_dict(),
+        "state_updates": klyqa.state_updates,
+        "settings_loads": klyqa.settings_loads,
+        "effects": {
+            "frames_sent": klyqa.effects.frames_sent,
+            "frames_dropped": klyqa.effects.frames_dropped,
+        },
+        "stream": klyqa.stream.stats(),
+        "connections": klyqa.connections.stats(),
+        "push": klyqa.push.stats(),
+        "thread_pool": klyqa.executor.metrics(),
+        "trace": klyqa.trace.stats(),
+    }
@@ -0,0 +1,64 @@
+"""Synchronized dispatch of the commands to several Klyqa bulbs."""
+from __future__ import annotations
+
+import asyncio
+
+from .const import LOGGER
+
+
+class GroupDispatcher:
+    """Collects the bulb commands of a short time window into one synchronized send.
+
+    Home Assistant turns on the lights of a room or area by calling
+    async_turn_on of each light concurrently. Commands arriving within WINDOW
+    seconds are written together with Klyqa.send_synchronized, so the bulbs
+    change at the same time instead of one after another.
+    """
+
+    WINDOW = 0.02
+
+    def __init__(self, klyqa):
+        self._klyqa = klyqa
+        self._pending: dict[str, tuple[list, list[asyncio.Future]]] = {}
+        self._flush_handle: asyncio.TimerHandle | None = None
+
+    async def async_send(self, u_id, messages) -> bool:
+        """Send the messages to the bulb together with the commands of the window.
+
+        Args:
+            messages (list): Messages of command_messages.
+
+        Returns:
+            bool: True if the messages were written to the bulb connection.
+        """
+        hass = self._klyqa.hass
+        future = hass.loop.create_future()
+        # A newer command of the same bulb replaces the waiting one.
+        futures = self._pending.get(u_id, ([], []))[1] + [future]
+        self._pending[u_id] = (messages, futures)
+
+        if self._flush_handle is None:
+            self._flush_handle = hass.loop.call_later(self.WINDOW, self._flush)
+        return await future
+
+    def _flush(self):
+        batch = self._pending
+        self._pending = {}
+        self._flush_handle = None
+        self._klyqa.hass.async_create_task(self._async_send_batch(batch))
+
+    async def _async_send_batch(self, batch):
+        try:
+            results = await self._klyqa.executor.async_add_job(
+                self._klyqa.send_synchronized,
+                {u_id: messages for u_id, (messages, _) in batch.items()},
+            )
+        except Exception as exception:
+            LOGGER.error("Synchronized send failed: %s", exception)
+            results = {}
+
+        LOGGER.debug("Synchronized send to %s bulbs: %s", len(batch), results)
+        for u_id, (_, futures) in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(results.get(u_id, False))
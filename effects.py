@@ -0,0 +1,180 @@
+"""Client-side light effects for the Klyqa bulbs."""
+from __future__ import annotations
+
+import asyncio
+import colorsys
+import math
+import random
+
+from .const import LOGGER
+
+
+def _hsv(hue, saturation=1.0, value=1.0) -> tuple[int, int, int]:
+    red, green, blue = colorsys.hsv_to_rgb(hue % 1.0, saturation, value)
+    return (round(red * 255), round(green * 255), round(blue * 255))
+
+
+def _scale(color, level) -> tuple[int, int, int]:
+    return (round(color[0] * level), round(color[1] * level), round(color[2] * level))
+
+
+def _party(elapsed, color):
+    """Jump to a random saturated color each frame."""
+    return _hsv(random.random())
+
+
+def _breathe(elapsed, color):
+    """Fade the base color in and out every four seconds."""
+    return _scale(color, 0.15 + 0.85 * (0.5 - 0.5 * math.cos(elapsed * math.pi / 2)))
+
+
+def _candle(elapsed, color):
+    """Flicker around a warm candle tone."""
+    return _scale((255, 147, 41), 0.7 + 0.3 * random.random())
+
+
+def _color_loop(elapsed, color):
+    """Cycle through the hue circle once in 30 seconds."""
+    return _hsv(elapsed / 30)
+
+
+EFFECTS = [
+    {"label": "Party Mode", "fps": 4, "frame": _party},
+    {"label": "Breathe", "fps": 10, "frame": _breathe},
+    {"label": "Candle", "fps": 8, "frame": _candle},
+    {"label": "Color Loop", "fps": 10, "frame": _color_loop},
+]
+
+"""Effects over all bulbs of a room, rendered by the function named in frames."""
+ROOM_EFFECTS = [
+    {"label": "Rainbow Wave", "fps": 10, "frame": "rainbow_wave"},
+    {"label": "Gradient", "fps": 10, "frame": "gradient"},
+    {"label": "Chase", "fps": 10, "frame": "chase"},
+    {"label": "Room Breathe", "fps": 10, "frame": "room_breathe"},
+]
+
+
+class EffectEngine:
+    """Runs client-side effects as cancellable asyncio tasks.
+
+    Frames are paced to the effect frame rate. While a bulb has not taken the
+    previous frame yet, new frames for it are dropped instead of queued, so a
+    lagging bulb never falls behind the animation.
+    """
+
+    def __init__(self, klyqa):
+        self._klyqa = klyqa
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._running: dict[str, str] = {}
+        self.frames_sent = 0
+        self.frames_dropped = 0
+
+    def running_effect(self, u_id) -> str | None:
+        """Return the label of the effect running on the bulb."""
+        return self._running.get(u_id)
+
+    def start(self, u_id, label, color=(255, 255, 255), fps=None) -> bool:
+        """Start the effect on the bulb, replacing a running one."""
+        effect_result = [x for x in EFFECTS if x["label"] == label]
+        if len(effect_result) < 1:
+            return False
+        effect = effect_result[0]
+        color = tuple(color)
+
+        def render(elapsed):
+            return [effect["frame"](elapsed, color)]
+
+        self._launch([u_id], label, render, fps or effect["fps"])
+        return True
+
+    def start_room(self, u_ids, label, color=(255, 255, 255), fps=None) -> bool:
+        """Start the room effect on the bulbs, rendered for all of them at once."""
+        # Loaded on demand, numpy is only needed while a room effect runs.
+        from . import frames
+
+        effect_result = [x for x in ROOM_EFFECTS if x["label"] == label]
+        if len(effect_result) < 1 or len(u_ids) < 1:
+            return False
+        effect = effect_result[0]
+        bulb_positions = frames.positions(len(u_ids))
+
+        def render(elapsed):
+            return frames.render(effect, elapsed, bulb_positions, color)
+
+        self._launch(list(u_ids), label, render, fps or effect["fps"])
+        return True
+
+    def stop(self, u_id) -> None:
+        """Stop the effect running on the bulb.
+
+        A room effect keeps running on the other bulbs of the room.
+        """
+        self._running.pop(u_id, None)
+        task = self._tasks.pop(u_id, None)
+        if task and task not in self._tasks.values():
+            task.cancel()
+
+    def stop_all(self) -> None:
+        """Stop all running effects."""
+        for u_id in list(self._tasks):
+            self.stop(u_id)
+
+    def _launch(self, u_ids, label, render, fps):
+        for u_id in u_ids:
+            self.stop(u_id)
+        task = self._klyqa.hass.async_create_task(
+            self._async_run(u_ids, label, render, fps)
+        )
+        for u_id in u_ids:
+            self._running[u_id] = label
+            self._tasks[u_id] = task
+
+    async def _async_run(self, u_ids, label, render, fps):
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        interval = 1.0 / fps
+        transition = int(interval * 1000)
+        started = next_frame = loop.time()
+        sending = {}
+
+        LOGGER.debug("Start effect %s on bulbs %s", label, ", ".join(u_ids))
+        try:
+            while True:
+                members = [x for x in u_ids if self._tasks.get(x) is task]
+                if len(members) < 1:
+                    return
+
+                now = loop.time()
+                colors = render(now - started)
+                for index, u_id in enumerate(u_ids):
+                    if u_id not in members:
+                        continue
+                    pending = sending.get(u_id)
+                    if pending is not None and not pending.done():
+                        self.frames_dropped += 1
+                        continue
+                    if pending is not None and pending.exception():
+                        LOGGER.debug(
+                            "Effect frame to bulb %s failed: %s",
+                            u_id,
+                            pending.exception(),
+                        )
+                    red, green, blue = colors[index]
+                    sending[u_id] = self._klyqa.executor.async_add_job(
+                        self._klyqa.send_color_frame,
+                        u_id,
+                        red,
+                        green,
+                        blue,
+                        transition,
+                    )
+                    self.frames_sent += 1
+
+                next_frame += interval
+                if next_frame < now:
+                    skipped = int((now - next_frame) / interval) + 1
+                    self.frames_dropped += skipped * len(members)
+                    next_frame += skipped * interval
+                await asyncio.sleep(next_frame - loop.time())
+        finally:
+            LOGGER.debug("Stop effect %s on bulbs %s", label, ", ".join(u_ids))
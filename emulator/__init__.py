@@ -0,0 +1,11 @@
+"""Emulator of Klyqa bulbs on the local network.
+
+Virtual bulbs answer the QCX-SYN broadcasts of search_lights, connect back to
+the integration and speak the Klyqa LAN protocol, so discovery and commands
+can be exercised without hardware. Run a fleet from the config folder with
+python -m custom_components.klyqa.emulator --bulbs 100
+With --cloud-port a stand-in of the klyqa cloud serves the account of the
+fleet as well, see cloud.py.
+"""
+from .bulb import VirtualBulb
+from .fleet import Fleet, NetworkConditions, make_devices
@@ -0,0 +1,110 @@
+"""Run a fleet of virtual Klyqa bulbs until interrupted."""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+
+from ..const import LOGGER
+from .cloud import CloudConditions, CloudStub, make_account
+from .fleet import Fleet, NetworkConditions
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Klyqa bulb emulator")
+    parser.add_argument("--bulbs", type=int, default=10, help="number of bulbs")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the fleet")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds")
+    parser.add_argument("--jitter", type=float, default=0, help="milliseconds")
+    parser.add_argument(
+        "--fragment", type=float, default=0, help="probability 0-1 of fragmentation"
+    )
+    parser.add_argument(
+        "--drop", type=float, default=0, help="probability 0-1 of no answer"
+    )
+    parser.add_argument(
+        "--devices", help="write the device settings of the fleet to this json file"
+    )
+    parser.add_argument("--rooms", type=int, default=0, help="rooms of the account")
+    parser.add_argument("--routines", type=int, default=0)
+    parser.add_argument("--timers", type=int, default=0)
+    parser.add_argument(
+        "--cloud-port",
+        type=int,
+        help="serve the account on this port, use http://<address>:<port> as host",
+    )
+    parser.add_argument("--cloud-latency", type=float, default=0, help="milliseconds")
+    parser.add_argument(
+        "--cloud-failures",
+        type=float,
+        default=0,
+        help="probability 0-1 of a failing cloud request",
+    )
+    parser.add_argument(
+        "--token-lifetime", type=float, help="seconds an access token is valid"
+    )
+    return parser.parse_args(argv)
+
+
+async def main(args: argparse.Namespace) -> None:
+    settings = make_account(
+        args.bulbs,
+        rooms=args.rooms,
+        routines=args.routines,
+        timers=args.timers,
+        seed=args.seed,
+    )
+    devices = settings["devices"]
+    if args.devices:
+        with open(args.devices, "w", encoding="utf-8") as file:
+            json.dump(devices, file, indent=2)
+
+    fleet = Fleet(
+        devices,
+        NetworkConditions(
+            latency=args.latency / 1000,
+            jitter=args.jitter / 1000,
+            fragment=args.fragment,
+            drop=args.drop,
+            seed=args.seed,
+        ),
+    )
+    await fleet.start()
+    LOGGER.info("Emulating %s bulbs", len(devices))
+
+    cloud = None
+    if args.cloud_port is not None:
+        cloud = CloudStub(
+            settings,
+            CloudConditions(
+                latency=args.cloud_latency / 1000,
+                failures=args.cloud_failures,
+                token_lifetime=args.token_lifetime,
+                seed=args.seed,
+            ),
+            host="0.0.0.0",
+            port=args.cloud_port,
+        )
+        await cloud.start()
+        LOGGER.info("Serving the account on port %s", cloud.port)
+    try:
+        while True:
+            await asyncio.sleep(10)
+            LOGGER.info(
+                "%s bulbs connected, %s broadcasts received",
+                fleet.connected(),
+                fleet.syn_received,
+            )
+    finally:
+        await fleet.stop()
+        if cloud:
+            await cloud.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(main(parse_args()))
+    except KeyboardInterrupt:
+        pass
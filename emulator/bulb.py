@@ -0,0 +1,96 @@
+"""State and command handling of one virtual Klyqa bulb."""
+from __future__ import annotations
+
+import json
+
+
+class VirtualBulb:
+    """Keeps the state of a bulb and answers the requests of the integration."""
+
+    def __init__(self, device: dict):
+        """
+        Args:
+            device (dict): Device settings of the account, with localDeviceId
+                and aesKey.
+        """
+        self.u_id = device["localDeviceId"]
+        self.aes_key = bytes.fromhex(device["aesKey"])
+        self.power = "on"
+        self.mode = "rgb"
+        self.color = {"red": 255, "green": 255, "blue": 255}
+        self.temperature = 2700
+        self.brightness = 100
+        self.active_scene = ""
+        self.routines: dict[str, dict] = {}
+        """Requests handled, by their type."""
+        self.handled: dict[str, int] = {}
+
+    def ident(self) -> dict:
+        return {"type": "ident", "ident": {"unit_id": self.u_id}}
+
+    def status(self) -> dict:
+        return {
+            "type": "status",
+            "status": self.power,
+            "color": dict(self.color),
+            "brightness": {"percentage": self.brightness},
+            "temperature": self.temperature,
+            "mode": self.mode,
+            "active_scene": self.active_scene,
+        }
+
+    def handle(self, message: str) -> dict | None:
+        """Apply the request of the integration, return the answer."""
+        try:
+            request = json.loads(message)
+        except ValueError:
+            return {"type": "error", "error": "invalid json"}
+
+        request_type = request.get("type", "")
+        self.handled[request_type] = self.handled.get(request_type, 0) + 1
+
+        if request_type == "ping":
+            return {"type": "pong"}
+        if request_type == "routine":
+            return self._routine(request)
+        if request_type != "request":
+            return {"type": request_type, "result": "ok"}
+
+        if "status" in request:
+            self.power = request["status"]
+        if "color" in request:
+            self.color = {x: int(request["color"][x]) for x in ("red", "green", "blue")}
+            self.mode = "rgb"
+        if "p_color" in request:
+            self.color = {
+                x: round(int(request["p_color"][x]) * 2.55)
+                for x in ("red", "green", "blue")
+            }
+            self.mode = "rgb"
+        if "temperature" in request:
+            self.temperature = int(request["temperature"])
+            self.mode = "cct"
+        if "brightness" in request:
+            self.brightness = int(request["brightness"]["percentage"])
+        return self.status()
+
+    def _routine(self, request) -> dict:
+        action = request.get("action")
+        routine_id = str(request.get("id"))
+        if action == "put":
+            self.routines[routine_id] = {
+                "id": routine_id,
+                "scene": request.get("scene"),
+                "commands": request.get("commands"),
+            }
+        elif action == "delete":
+            self.routines.pop(routine_id, None)
+        elif action == "start" and routine_id in self.routines:
+            self.mode = "cmd"
+            self.active_scene = str(self.routines[routine_id]["scene"])
+            return self.status()
+        return {
+            "type": "routine",
+            "action": action,
+            "routines": list(self.routines.values()),
+        }
@@ -0,0 +1,281 @@
+"""Stand-in of the klyqa cloud API serving synthetic accounts.
+
+Serves the routes the integration talks to on its host: /auth/login,
+/auth/logout, /settings, /config/product/<id> and the websocket of the
+account notifications. Latency, failing requests and expiring access tokens
+can be injected, so cold starts, token refreshes and settings loads can be
+measured at scale without the real backend. The settings are served with an
+ETag and Last-Modified and answered conditionally, unless disabled.
+"""
+from __future__ import annotations
+
+import asyncio
+import datetime
+import email.utils
+import hashlib
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+from ..push import PUSH_PATH, SETTINGS_CHANGED
+from .fleet import PRODUCT_ID, make_devices
+
+
+class CloudConditions:
+    """Latency, failures and token lifetime of the emulated cloud."""
+
+    def __init__(
+        self,
+        latency=0.0,
+        jitter=0.0,
+        failures=0.0,
+        failure_status=503,
+        token_lifetime=None,
+        seed=None,
+    ):
+        """
+        Args:
+            latency (float): Seconds before a request is answered.
+            jitter (float): Seconds the latency varies by, in both directions.
+            failures (float): Probability 0-1 that a request fails.
+            failure_status (int): Http status of the failed requests.
+            token_lifetime (float): Seconds an access token is valid, None for
+                tokens valid until logout.
+            seed: Seed of the random decisions, for reproducible runs.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.failures = failures
+        self.failure_status = failure_status
+        self.token_lifetime = token_lifetime
+        self.random = random.Random(seed)
+
+    def delay(self) -> float:
+        return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def failed(self) -> bool:
+        return self.random.random() < self.failures
+
+
+def make_account(
+    devices=10, rooms=0, routines=0, timers=0, seed=None, product_id=PRODUCT_ID
+) -> dict:
+    """Settings of an account as the klyqa cloud serves them.
+
+    The devices are spread evenly over the rooms, every routine and timer
+    has one task switching a few of the devices.
+    """
+    generator = random.Random(seed)
+    device_settings = make_devices(devices, seed=seed, product_id=product_id)
+    u_ids = [x["localDeviceId"] for x in device_settings]
+
+    def tasks():
+        count = min(len(u_ids), generator.randint(1, 5))
+        return [{"devices": generator.sample(u_ids, count), "type": "request"}]
+
+    return {
+        "devices": device_settings,
+        "rooms": [
+            {
+                "id": str(uuid.UUID(int=generator.getrandbits(128))),
+                "name": f"Virtual Room {index + 1}",
+                "devices": [{"localDeviceId": x} for x in u_ids[index::rooms]],
+            }
+            for index in range(rooms)
+        ],
+        "routines": [
+            {"id": f"routine{index}", "name": f"Routine {index}", "tasks": tasks()}
+            for index in range(routines if u_ids else 0)
+        ],
+        "timers": [
+            {"id": f"timer{index}", "name": f"Timer {index}", "tasks": tasks()}
+            for index in range(timers if u_ids else 0)
+        ],
+    }
+
+
+class CloudStub:
+    """Local http server answering the requests the integration makes to its host."""
+
+    def __init__(
+        self, settings, conditions=None, host="127.0.0.1", port=0, conditional=True
+    ):
+        """
+        Args:
+            settings (dict): Settings of the account, see make_account.
+            conditions (CloudConditions): Injected latency, failures and token
+                expiry.
+            port (int): Port to listen on, 0 for a free port.
+            conditional (bool): Answer If-None-Match and If-Modified-Since of
+                the settings requests, False for a backend without them.
+        """
+        self.settings = settings
+        self.conditions = conditions or CloudConditions()
+        self.conditional = conditional
+        self._etag = ""
+        self._modified: datetime.datetime | None = None
+        self.host = host
+        self.port = port
+        """Requests served, by route and by answer status."""
+        self.requests: dict[str, int] = {}
+        self.statuses: dict[int, int] = {}
+        """Valid access tokens with their expiry time."""
+        self._tokens: dict[str, float] = {}
+        self._sockets: set[web.WebSocketResponse] = set()
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> str:
+        """Start serving, return the host url for the integration."""
+        app = web.Application(middlewares=[self._conditions])
+        app.router.add_post("/auth/login", self._login)
+        app.router.add_post("/auth/logout", self._logout)
+        app.router.add_get("/settings", self._settings)
+        app.router.add_get("/config/product/{product_id}", self._product)
+        app.router.add_get(PUSH_PATH, self._notifications)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        return self.url
+
+    async def stop(self) -> None:
+        await self.disconnect_notifications()
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def expire_tokens(self) -> None:
+        """Invalidate all access tokens, the next requests are answered with 401."""
+        self._tokens.clear()
+
+    async def notify_settings_changed(self) -> int:
+        """Signal a change of the settings to the listeners, return their number."""
+        message = {"type": SETTINGS_CHANGED}
+        await asyncio.gather(
+            *[x.send_json(message) for x in self._sockets], return_exceptions=True
+        )
+        return len(self._sockets)
+
+    async def disconnect_notifications(self) -> None:
+        """Close the websockets of the listeners, like a restart of the cloud."""
+        await asyncio.gather(*[x.close() for x in list(self._sockets)])
+
+    def stats(self) -> dict:
+        return {
+            "requests": dict(self.requests),
+            "statuses": dict(self.statuses),
+            "tokens": len(self._tokens),
+            "listeners": len(self._sockets),
+        }
+
+    def _count(self, route):
+        self.requests[route] = self.requests.get(route, 0) + 1
+
+    @web.middleware
+    async def _conditions(self, request: web.Request, handler):
+        delay = self.conditions.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        if self.conditions.failed():
+            response = web.json_response(
+                {"error": "injected failure"}, status=self.conditions.failure_status
+            )
+        else:
+            response = await handler(request)
+        self.statuses[response.status] = self.statuses.get(response.status, 0) + 1
+        return response
+
+    def _authorized(self, request: web.Request) -> bool:
+        token = request.headers.get("Authorization", "").partition("Bearer ")[2]
+        expiry = self._tokens.get(token)
+        if expiry is None:
+            return False
+        if time.monotonic() > expiry:
+            del self._tokens[token]
+            return False
+        return True
+
+    async def _login(self, request: web.Request) -> web.Response:
+        self._count("login")
+        token = uuid.uuid4().hex
+        lifetime = self.conditions.token_lifetime
+        self._tokens[token] = (
+            time.monotonic() + lifetime if lifetime is not None else float("inf")
+        )
+        return web.json_response(
+            {"accessToken": token, "accountToken": uuid.uuid4().hex}, status=201
+        )
+
+    async def _logout(self, request: web.Request) -> web.Response:
+        self._count("logout")
+        token = request.headers.get("Authorization", "").partition("Bearer ")[2]
+        self._tokens.pop(token, None)
+        return web.json_response({}, status=201)
+
+    async def _settings(self, request: web.Request) -> web.Response:
+        self._count("settings")
+        if not self._authorized(request):
+            return web.json_response({"error": "unauthorized"}, status=401)
+        body = json.dumps(self.settings).encode()
+        if not self.conditional:
+            return web.Response(body=body, content_type="application/json")
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        if etag != self._etag:
+            # Http dates have whole seconds.
+            self._etag = etag
+            self._modified = datetime.datetime.now(datetime.timezone.utc).replace(
+                microsecond=0
+            )
+        headers = {
+            "ETag": etag,
+            "Last-Modified": email.utils.format_datetime(self._modified, usegmt=True),
+        }
+        if "If-None-Match" in request.headers:
+            unchanged = request.headers["If-None-Match"] == etag
+        else:
+            unchanged = request.if_modified_since is not None and (
+                request.if_modified_since >= self._modified
+            )
+        if unchanged:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type="application/json", headers=headers)
+
+    async def _notifications(self, request: web.Request) -> web.StreamResponse:
+        self._count("notifications")
+        if not self._authorized(request):
+            return web.json_response({"error": "unauthorized"}, status=401)
+        websocket = web.WebSocketResponse(heartbeat=30)
+        await websocket.prepare(request)
+        self._sockets.add(websocket)
+        try:
+            # Listeners only receive, wait until they disconnect.
+            async for _ in websocket:
+                pass
+        finally:
+            self._sockets.discard(websocket)
+        return websocket
+
+    async def _product(self, request: web.Request) -> web.Response:
+        self._count("product")
+        if not self._authorized(request):
+            return web.json_response({"error": "unauthorized"}, status=401)
+        product_id = request.match_info["product_id"]
+        return web.json_response(
+            {
+                "id": product_id,
+                "deviceTraits": [
+                    {"trait": "@core/traits/color"},
+                    {"trait": "@core/traits/brightness"},
+                    {"trait": "@core/traits/color-temperature"},
+                ],
+            }
+        )
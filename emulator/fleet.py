@@ -0,0 +1,191 @@
+"""Fleet of virtual Klyqa bulbs served from one asyncio event loop."""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import socket
+
+# pycryptodome
+try:
+    from Cryptodome.Cipher import AES
+except:
+    from Crypto.Cipher import AES
+
+from .. import encoding
+from ..const import LOGGER
+from .bulb import VirtualBulb
+
+SYN = b"QCX-SYN"
+UDP_PORT = 2222
+TCP_PORT = 3333
+PRODUCT_ID = "@klyqa.lighting.rgb-cw-ww.e27"
+
+
+class NetworkConditions:
+    """Latency, jitter, fragmentation and losses of the emulated network."""
+
+    def __init__(self, latency=0.0, jitter=0.0, fragment=0.0, drop=0.0, seed=None):
+        """
+        Args:
+            latency (float): Seconds before a bulb answers a request.
+            jitter (float): Seconds the latency varies by, in both directions.
+            fragment (float): Probability 0-1 that a package is written in pieces.
+            drop (float): Probability 0-1 that a broadcast or a request stays
+                unanswered.
+            seed: Seed of the random decisions, for reproducible runs.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.fragment = fragment
+        self.drop = drop
+        self.random = random.Random(seed)
+
+    def delay(self) -> float:
+        return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def dropped(self) -> bool:
+        return self.random.random() < self.drop
+
+    def pieces(self, data: bytes) -> list[bytes]:
+        """Split the data at random points if it is fragmented."""
+        if len(data) < 2 or self.random.random() >= self.fragment:
+            return [data]
+        cuts = sorted(self.random.sample(range(1, len(data)), min(2, len(data) - 1)))
+        return [data[start:end] for start, end in zip([0] + cuts, cuts + [None])]
+
+
+def make_devices(count, seed=None, product_id=PRODUCT_ID) -> list[dict]:
+    """Device settings of count virtual bulbs as the klyqa cloud lists them."""
+    generator = random.Random(seed)
+    return [
+        {
+            "localDeviceId": f"{generator.getrandbits(48):012x}",
+            "aesKey": f"{generator.getrandbits(128):032x}",
+            "productId": product_id,
+            "name": f"Virtual Bulb {index + 1}",
+            "firmwareVersion": "virtual",
+            "hardwareRevision": "virtual",
+        }
+        for index in range(count)
+    ]
+
+
+def _package(pkg_type, payload: bytes) -> bytes:
+    return bytes([len(payload) // 256, len(payload) % 256, 0, pkg_type]) + payload
+
+
+async def _read_package(reader: asyncio.StreamReader) -> tuple[int, bytes]:
+    header = await reader.readexactly(4)
+    return header[3], await reader.readexactly(header[0] * 256 + header[1])
+
+
+class Fleet:
+    """Virtual bulbs answering the search broadcasts of the integration.
+
+    On a QCX-SYN broadcast every bulb without connection connects back to the
+    sender on TCP_PORT and serves the connection until the integration
+    closes it. Hundreds of bulbs run in one process.
+    """
+
+    def __init__(self, devices, conditions=None, host="0.0.0.0"):
+        self.bulbs = {x["localDeviceId"]: VirtualBulb(x) for x in devices}
+        self.conditions = conditions or NetworkConditions()
+        self.host = host
+        self.syn_received = 0
+        self.connections = 0
+        self._sessions: dict[str, asyncio.Task] = {}
+        self._transport: asyncio.DatagramTransport | None = None
+
+    async def start(self) -> None:
+        """Listen for the search broadcasts."""
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # The integration binds the same port for its broadcasts.
+        udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        udp.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        udp.bind((self.host, UDP_PORT))
+        self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _SynProtocol(self), sock=udp
+        )
+
+    async def stop(self) -> None:
+        """Stop listening and close the connections of the bulbs."""
+        if self._transport:
+            self._transport.close()
+        for task in list(self._sessions.values()):
+            task.cancel()
+        await asyncio.gather(*self._sessions.values(), return_exceptions=True)
+        self._sessions.clear()
+
+    def connected(self) -> int:
+        return len(self._sessions)
+
+    def on_syn(self, address) -> None:
+        self.syn_received += 1
+        for u_id, bulb in self.bulbs.items():
+            if u_id in self._sessions or self.conditions.dropped():
+                continue
+            self._sessions[u_id] = asyncio.create_task(self._serve(bulb, address[0]))
+
+    async def _serve(self, bulb: VirtualBulb, host):
+        try:
+            reader, writer = await asyncio.open_connection(host, TCP_PORT)
+        except OSError as exception:
+            LOGGER.debug("Virtual bulb %s cannot connect: %s", bulb.u_id, exception)
+            self._sessions.pop(bulb.u_id, None)
+            return
+
+        self.connections += 1
+        writer.get_extra_info("socket").setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+        )
+        try:
+            await self._session(bulb, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            if self._sessions.get(bulb.u_id) is asyncio.current_task():
+                del self._sessions[bulb.u_id]
+
+    async def _session(self, bulb: VirtualBulb, reader, writer):
+        local_iv = os.urandom(8)
+        await self._write(writer, _package(0, json.dumps(bulb.ident()).encode()))
+        await self._write(writer, _package(1, local_iv))
+
+        pkg_type, remote_iv = await _read_package(reader)
+        while pkg_type != 1:
+            pkg_type, remote_iv = await _read_package(reader)
+        sending_aes = AES.new(bulb.aes_key, AES.MODE_CBC, iv=local_iv + remote_iv)
+        receiving_aes = AES.new(bulb.aes_key, AES.MODE_CBC, iv=remote_iv + local_iv)
+
+        while True:
+            pkg_type, payload = await _read_package(reader)
+            if pkg_type != 2:
+                continue
+            # Every request is decrypted, the receiving cipher is chained.
+            answer = bulb.handle(receiving_aes.decrypt(payload).decode("utf-8"))
+            if answer is None or self.conditions.dropped():
+                continue
+            await asyncio.sleep(self.conditions.delay())
+            await self._write(
+                writer, encoding.encrypt_package(json.dumps(answer), sending_aes)
+            )
+
+    async def _write(self, writer: asyncio.StreamWriter, data: bytes):
+        pieces = self.conditions.pieces(data)
+        for index, piece in enumerate(pieces):
+            if index:
+                await asyncio.sleep(0.002)
+            writer.write(piece)
+            await writer.drain()
+
+
+class _SynProtocol(asyncio.DatagramProtocol):
+    def __init__(self, fleet: Fleet):
+        self._fleet = fleet
+
+    def datagram_received(self, data, addr):
+        if data == SYN:
+            self._fleet.on_syn(addr)
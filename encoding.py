@@ -0,0 +1,101 @@
+"""Encoding of the bulb commands into encrypted packages.
+
+The command payloads are filled into precompiled templates instead of being
+serialized from freshly built dicts. The templates produce the same text as
+json.dumps of the dicts, so the bulbs see no difference.
+"""
+from __future__ import annotations
+
+import json
+
+BLOCK_SIZE = 16
+PACKAGE_TYPE_ENCRYPTED = 2
+
+COLOR_TEMPLATE = (
+    '{"type": "request", "color": {"red": %s, "green": %s, "blue": %s},'
+    ' "transitionTime": %s}'
+)
+TEMPERATURE_TEMPLATE = '{"type": "request", "temperature": %s, "transitionTime": %s}'
+BRIGHTNESS_TEMPLATE = (
+    '{"type": "request", "brightness": {"percentage": %s}, "transitionTime": %s}'
+)
+PERCENT_COLOR_TEMPLATE = (
+    '{"type": "request", "p_color": {"red": %s, "green": %s, "blue": %s,'
+    ' "warm": %s, "cold": %s}, "transitionTime": %s}'
+)
+
+
+def value(data) -> str:
+    """Encode a template value as json, integers without the json encoder."""
+    if type(data) is int:
+        return str(data)
+    return json.dumps(data)
+
+
+def color_payload(red, green, blue, transition) -> str:
+    return COLOR_TEMPLATE % (value(red), value(green), value(blue), value(transition))
+
+
+def temperature_payload(temperature, transition) -> str:
+    return TEMPERATURE_TEMPLATE % (value(temperature), value(transition))
+
+
+def brightness_payload(brightness, transition) -> str:
+    return BRIGHTNESS_TEMPLATE % (value(brightness), value(transition))
+
+
+def percent_color_payload(red, green, blue, warm, cold, transition) -> str:
+    return PERCENT_COLOR_TEMPLATE % (
+        value(red),
+        value(green),
+        value(blue),
+        value(warm),
+        value(cold),
+        value(transition),
+    )
+
+
+def pad(data: bytes) -> bytes:
+    """Pad the data with spaces to the AES block size."""
+    return data + b" " * (-len(data) % BLOCK_SIZE)
+
+
+def header(length) -> bytes:
+    return bytes([length // 256, length % 256, 0, PACKAGE_TYPE_ENCRYPTED])
+
+
+def encrypt_package(message: str, sending_aes) -> bytes:
+    """Encrypt the message into a package with its header."""
+    encrypted = sending_aes.encrypt(pad(message.encode("utf-8")))
+    return header(len(encrypted)) + encrypted
+
+
+def encrypt_packages(messages, sending_aes) -> bytes:
+    """Encrypt the messages into one buffer of consecutive packages.
+
+    The messages are encrypted in a single pass, the cipher block chaining
+    continues from one message into the next just like separate encryptions.
+    """
+    plains = [pad(message.encode("utf-8")) for message in messages]
+    encrypted = sending_aes.encrypt(b"".join(plains))
+
+    buffer = bytearray()
+    offset = 0
+    for plain in plains:
+        buffer += header(len(plain))
+        buffer += encrypted[offset : offset + len(plain)]
+        offset += len(plain)
+    return bytes(buffer)
+
+
+def split_packages(data: bytes) -> tuple[list[tuple[int, bytes]], bytes]:
+    """Split received bytes into (type, payload) packages and the incomplete rest."""
+    packages = []
+    offset = 0
+    while len(data) - offset >= 4:
+        end = offset + 4 + data[offset] * 256 + data[offset + 1]
+        if end > len(data):
+            break
+        packages.append((data[offset + 3], data[offset + 4 : end]))
+        offset = end
+    return packages, data[offset:]
@@ -0,0 +1,155 @@
+"""Thread pool for the blocking I/O of the Klyqa integration."""
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import time
+
+from .const import LOGGER
+
+
+def _name(func) -> str:
+    return getattr(func, "__name__", None) or getattr(func, "func", func).__name__
+
+
+class ExecutorSaturated(Exception):
+    """The Klyqa thread pool and its queue are full."""
+
+
+class KlyqaExecutor:
+    """Small named thread pool with a bounded queue and per job timeouts.
+
+    The blocking cloud requests, discoveries and bulb sends of the integration
+    run here instead of in the shared executor of Home Assistant, so a hanging
+    request or a long discovery only ties up threads of this integration. A job
+    beyond MAX_WORKERS + MAX_QUEUE pending jobs is rejected. A job running
+    longer than its timeout is reported as timed out to the caller, its thread
+    stays busy until the job returns.
+    """
+
+    MAX_WORKERS = 8
+    MAX_QUEUE = 64
+    TIMEOUT = 30.0
+
+    def __init__(self, hass, max_workers=MAX_WORKERS, max_queue=MAX_QUEUE):
+        self._hass = hass
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="klyqa")
+        """Jobs submitted and not yet returned, running or queued."""
+        self.pending = 0
+        self.max_pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def async_add_job(self, func, *args, timeout=TIMEOUT) -> asyncio.Future:
+        """
+        Run the function with the arguments in the pool.
+
+        Args:
+            timeout (float): Seconds until the future fails with
+                asyncio.TimeoutError, None to wait for the job.
+
+        Returns:
+            asyncio.Future: Result of the function. Fails with ExecutorSaturated
+                if the pool queue is full, with RuntimeError if the pool is
+                shut down.
+        """
+        loop = self._hass.loop
+        result = loop.create_future()
+        if self.pending >= self.max_workers + self.max_queue:
+            self.rejected += 1
+            LOGGER.warning(
+                "Klyqa thread pool saturated, %s jobs pending, %s rejected",
+                self.pending,
+                self.rejected,
+            )
+            result.set_exception(ExecutorSaturated(_name(func)))
+            return result
+
+        self.pending += 1
+        self.submitted += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        queued = time.monotonic()
+        expire = None
+        if timeout is not None:
+            expire = loop.call_later(timeout, self._expire, result, func)
+
+        def run():
+            return time.monotonic(), func(*args)
+
+        def done(job):
+            with contextlib.suppress(RuntimeError):
+                loop.call_soon_threadsafe(self._finish, job, result, queued, expire)
+
+        try:
+            job = self._pool.submit(run)
+        except RuntimeError as exception:
+            # The pool is shut down.
+            self.pending -= 1
+            self.submitted -= 1
+            if expire:
+                expire.cancel()
+            result.set_exception(exception)
+            return result
+        job.add_done_callback(done)
+        return result
+
+    def metrics(self) -> dict:
+        """Return the pool usage counters."""
+        started = self.completed + self.failed
+        return {
+            "workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "pending": self.pending,
+            "queued": max(0, self.pending - self.max_workers),
+            "saturation": round(self.pending / (self.max_workers + self.max_queue), 3),
+            "max_pending": self.max_pending,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "rejected": self.rejected,
+            "wait_avg_ms": round(self.wait_total / started * 1000, 1)
+            if started
+            else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 1),
+        }
+
+    def shutdown(self) -> None:
+        """Stop the pool, queued jobs are cancelled."""
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _expire(self, result, func):
+        if result.done():
+            return
+        self.timed_out += 1
+        LOGGER.warning("Klyqa job %s timed out", _name(func))
+        result.set_exception(asyncio.TimeoutError())
+
+    def _finish(self, job, result, queued, expire):
+        self.pending -= 1
+        if expire:
+            expire.cancel()
+        if job.cancelled():
+            result.cancel()
+            return
+        exception = job.exception()
+        if exception is not None:
+            self.failed += 1
+            if not result.done():
+                result.set_exception(exception)
+            return
+
+        started, value = job.result()
+        self.completed += 1
+        self.wait_total += started - queued
+        self.wait_max = max(self.wait_max, started - queued)
+        if not result.done():
+            result.set_result(value)
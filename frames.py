@@ -0,0 +1,114 @@
+"""Vectorized frame generation for room-wide effects.
+
+All bulbs of a room are rendered in one pass. A bulb is described by its
+position in the room (0 <= position < 1), a frame is an (n, 3) array of RGB
+values, one row per bulb. The room effects are listed in effects.ROOM_EFFECTS,
+their "frame" names the render function in FRAMES.
+"""
+from __future__ import annotations
+
+import numpy as np
+
+
+def hsv_to_rgb(hue, saturation, value) -> np.ndarray:
+    """Convert HSV arrays (0-1) into an (n, 3) RGB array (0-255)."""
+    hue, saturation, value = np.broadcast_arrays(
+        np.mod(hue, 1.0) * 6.0, saturation, value
+    )
+    sector = np.floor(hue).astype(int) % 6
+    fraction = hue - np.floor(hue)
+    p = value * (1.0 - saturation)
+    q = value * (1.0 - saturation * fraction)
+    t = value * (1.0 - saturation * (1.0 - fraction))
+
+    red = np.choose(sector, [value, q, p, p, t, value])
+    green = np.choose(sector, [t, value, value, q, p, p])
+    blue = np.choose(sector, [p, p, t, value, value, q])
+    return np.stack([red, green, blue], axis=-1) * 255.0
+
+
+def rgb_to_hsv(rgb) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Convert an (n, 3) RGB array (0-255) into HSV arrays (0-1)."""
+    rgb = np.asarray(rgb, dtype=float).reshape(-1, 3) / 255.0
+    maximum = rgb.max(axis=1)
+    delta = maximum - rgb.min(axis=1)
+    safe_delta = np.where(delta > 0, delta, 1.0)
+
+    red, green, blue = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    hue = np.select(
+        [delta == 0, maximum == red, maximum == green],
+        [
+            0.0,
+            np.mod((green - blue) / safe_delta, 6.0),
+            (blue - red) / safe_delta + 2.0,
+        ],
+        (red - green) / safe_delta + 4.0,
+    )
+    saturation = np.where(maximum > 0, delta / np.where(maximum > 0, maximum, 1.0), 0)
+    return hue / 6.0, saturation, maximum
+
+
+def ease_in_out_sine(x) -> np.ndarray:
+    """Ease 0-1 smoothly in and out."""
+    return 0.5 - 0.5 * np.cos(np.pi * np.clip(x, 0.0, 1.0))
+
+
+def ease_in_out_cubic(x) -> np.ndarray:
+    """Ease 0-1 with a steeper middle than the sine easing."""
+    x = np.clip(x, 0.0, 1.0)
+    return np.where(x < 0.5, 4.0 * x**3, 1.0 - (-2.0 * x + 2.0) ** 3 / 2.0)
+
+
+def brightness_wave(positions, elapsed, period, low=0.15) -> np.ndarray:
+    """Brightness levels of a wave travelling through the room once per period."""
+    phase = 0.5 + 0.5 * np.sin(2.0 * np.pi * (elapsed / period - positions))
+    return low + (1.0 - low) * ease_in_out_sine(phase)
+
+
+def rainbow_wave(elapsed, positions, color):
+    """Spread the hue circle over the room and let it travel."""
+    return hsv_to_rgb(positions - elapsed / 20.0, 1.0, 1.0)
+
+
+def gradient(elapsed, positions, color):
+    """Slide a gradient between the color and its complement through the room."""
+    hue, saturation, value = rgb_to_hsv(color)
+    mix = ease_in_out_sine(
+        0.5 + 0.5 * np.sin(2.0 * np.pi * (positions - elapsed / 15.0))
+    )
+    return hsv_to_rgb(hue + 0.5 * mix, np.maximum(saturation, 0.6), value)
+
+
+def chase(elapsed, positions, color):
+    """Run a light spot with a fading tail through the room."""
+    distance = np.mod(elapsed / 4.0 - positions, 1.0)
+    level = 0.05 + 0.95 * ease_in_out_cubic(1.0 - distance / 0.35)
+    return np.asarray(color, dtype=float) * level[:, np.newaxis]
+
+
+def room_breathe(elapsed, positions, color):
+    """Let the brightness of the color wash through the room."""
+    level = brightness_wave(positions, elapsed, 6.0)
+    return np.asarray(color, dtype=float) * level[:, np.newaxis]
+
+
+def positions(count) -> np.ndarray:
+    """Evenly spread positions of count bulbs in a room."""
+    return np.arange(count, dtype=float) / max(count, 1)
+
+
+"""Render functions of the room effects by name."""
+FRAMES = {
+    "rainbow_wave": rainbow_wave,
+    "gradient": gradient,
+    "chase": chase,
+    "room_breathe": room_breathe,
+}
+
+
+def render(effect, elapsed, bulb_positions, color=(255, 255, 255)) -> list:
+    """Render one frame of the room effect as a list of (r, g, b) integer rows."""
+    if effect["frame"] not in FRAMES:
+        raise ValueError(f"Unknown room effect frame: {effect['frame']}")
+    frame = FRAMES[effect["frame"]](elapsed, bulb_positions, color)
+    return np.clip(np.rint(frame), 0, 255).astype(int).tolist()
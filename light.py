@@ -1,14 +1,11 @@
 """Platform for light integration."""
 from __future__ import annotations
 
-import json
-import socket
+import asyncio
+import random
 
-from homeassistant.helpers.device_registry import DeviceEntryType
 from homeassistant.helpers import entity_registry as er
 from homeassistant.helpers import area_registry as ar
-import voluptuous as vol
-
 
 from homeassistant.util.color import (
     color_temperature_kelvin_to_mired,
@@ -28,39 +25,45 @@ from homeassistant.components.light import (
     COLOR_MODE_BRIGHTNESS,
     COLOR_MODE_COLOR_TEMP,
     COLOR_MODE_RGB,
-    COLOR_MODE_RGBWW,
     ENTITY_ID_FORMAT,
     SUPPORT_BRIGHTNESS,
     SUPPORT_COLOR,
     SUPPORT_COLOR_TEMP,
     SUPPORT_EFFECT,
     SUPPORT_TRANSITION,
-    SUPPORT_WHITE_VALUE,
     LightEntity,
 )
 from homeassistant.const import (
-    ATTR_ENTITY_ID,
     CONF_HOST,
     CONF_PASSWORD,
     CONF_USERNAME,
     EVENT_HOMEASSISTANT_STOP,
     STATE_UNAVAILABLE,
     STATE_OK,
-    STATE_OFF,
-    STATE_ON,
 )
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 
 # Import the device class from the component that you want to support
-import homeassistant.helpers.config_validation as cv
-from homeassistant.helpers.entity import DeviceInfo, Entity, generate_entity_id
+from homeassistant.helpers.entity import DeviceInfo, generate_entity_id
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
+from homeassistant.helpers.event import async_call_later, async_track_time_interval
+from homeassistant.helpers.restore_state import RestoredExtraData, RestoreEntity
 from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
 import homeassistant.util.color as color_util
 from homeassistant.config_entries import ConfigEntry
 
-from .api import SCENES, Klyqa, KlyqaLightDevice
-from .const import DOMAIN, LOGGER, CONF_SYNC_ROOMS
+from .api import (
+    SCENES,
+    BulbStatus,
+    Klyqa,
+    KlyqaLightDevice,
+    command_messages,
+    raise_fd_limit,
+    target_args,
+)
+from .effects import EFFECTS, ROOM_EFFECTS
+from .executor import ExecutorSaturated
+from .const import DOMAIN, LOGGER, CONF_PUSH, CONF_SYNC_ROOMS
 
 # all deprecated, still here for testing, color_mode is the modern way to go ...
 SUPPORT_KLYQA = (
@@ -74,10 +77,44 @@ SUPPORT_KLYQA = (
 from datetime import timedelta
 import functools as ft
 
-from homeassistant.helpers.area_registry import AreaEntry, AreaRegistry
-import homeassistant.helpers.area_registry as area_registry
-
 SCAN_INTERVAL = timedelta(seconds=3)
+"""Seconds a restored state is shown until the bulb confirms it or the light
+turns unavailable."""
+STALE_GRACE = 300
+"""Bulb state requests per second of all lights together, at most."""
+POLLS_PER_SECOND = 50
+
+
+def light_target(kwargs, transition_time) -> dict:
+    """Bulb target state (see api.target_args) for the light turn on service data."""
+    target = {"power": "on"}
+
+    if ATTR_HS_COLOR in kwargs:
+        target["color"] = tuple(color_util.color_hs_to_RGB(*kwargs[ATTR_HS_COLOR]))
+
+    if ATTR_RGB_COLOR in kwargs:
+        target["color"] = tuple(kwargs[ATTR_RGB_COLOR])
+
+    if ATTR_RGBWW_COLOR in kwargs:
+        target["percent_color"] = tuple(kwargs[ATTR_RGBWW_COLOR])
+
+    if ATTR_COLOR_TEMP in kwargs:
+        target["temperature"] = (
+            color_temperature_mired_to_kelvin(kwargs[ATTR_COLOR_TEMP])
+            if kwargs[ATTR_COLOR_TEMP]
+            else 0
+        )
+
+    if ATTR_BRIGHTNESS in kwargs:
+        target["brightness"] = round((kwargs[ATTR_BRIGHTNESS] / 255.0) * 100.0)
+
+    if ATTR_BRIGHTNESS_PCT in kwargs:
+        target["brightness"] = round(kwargs[ATTR_BRIGHTNESS_PCT])
+
+    if transition_time:
+        target["transition"] = transition_time
+
+    return target
 
 
 async def async_setup(hass: HomeAssistant, yaml_config: ConfigType) -> bool:
@@ -123,18 +160,45 @@ async def async_setup_klyqa(
         sync_rooms = (
             config.get(CONF_SYNC_ROOMS) if config.get(CONF_SYNC_ROOMS) else False
         )
-        hass.data[DOMAIN] = Klyqa(username, password, host, hass, sync_rooms=sync_rooms)
-        if not await hass.async_add_executor_job(hass.data[DOMAIN].login):
+        hass.data[DOMAIN] = Klyqa(
+            username,
+            password,
+            host,
+            hass,
+            sync_rooms=sync_rooms,
+            push_notifications=bool(config.get(CONF_PUSH)),
+        )
+        if not await hass.data[DOMAIN].executor.async_add_job(hass.data[DOMAIN].login):
             return
 
     klyqa: Klyqa = hass.data[DOMAIN]
 
     hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, klyqa.shutdown)
-    await hass.async_add_executor_job(klyqa.load_settings)
-    await hass.async_add_executor_job(
-        ft.partial(klyqa.search_lights, seconds_to_discover=1)
-    )
-
+    if not klyqa._settings["devices"] and not await klyqa.async_load_cached_settings():
+        await klyqa.async_refresh_settings()
+    # Once per setup, the limit is for the whole Home Assistant process.
+    raise_fd_limit(len(klyqa._devices))
+
+    # Index the rooms, routines and timers by bulb once instead of scanning
+    # them for every bulb of large accounts.
+    rooms_of: dict[str, list] = {}
+    for room in klyqa._settings["rooms"]:
+        for device in room["devices"]:
+            rooms_of.setdefault(device["localDeviceId"], []).append(room)
+    # TODO: perhaps the routines can be put into automations or scenes in HA
+    routines_of: dict[str, list] = {}
+    for routine in klyqa._settings["routines"]:
+        for task in routine["tasks"]:
+            for device in task["devices"]:
+                routines_of.setdefault(device, []).append(routine)
+    # TODO: same for timers.
+    timers_of: dict[str, list] = {}
+    for timer in klyqa._settings["timers"]:
+        for task in timer["tasks"]:
+            for device in task["devices"]:
+                timers_of.setdefault(device, []).append(timer)
+
+    area_reg = ar.async_get(hass)
     entities = []
 
     for device_settings in klyqa._settings["devices"]:
@@ -146,25 +210,8 @@ async def async_setup_klyqa(
         u_id = device_settings["localDeviceId"]
 
         light_state = klyqa.lights[u_id] if u_id in klyqa.lights else KlyqaLightDevice()
-        rooms = []
-        for room in klyqa._settings["rooms"]:
-            for device in room["devices"]:
-                if device["localDeviceId"] == u_id:
-                    rooms.append(room)
-        # TODO: perhaps the routines can be put into automations or scenes in HA
-        routines = []
-        for routine in klyqa._settings["routines"]:
-            for task in routine["tasks"]:
-                for device in task["devices"]:
-                    if device == u_id:
-                        routines.append(routine)
-        # TODO: same for timers.
-        timers = []
-        for timer in klyqa._settings["timers"]:
-            for task in timer["tasks"]:
-                for device in task["devices"]:
-                    if device == u_id:
-                        timers.append(timer)
+        rooms = rooms_of.get(u_id, [])
+        area = area_reg.async_get_area_by_name(rooms[0]["name"]) if rooms else None
 
         entities.append(
             KlyqaLight(
@@ -174,22 +221,150 @@ async def async_setup_klyqa(
                 entity_id,
                 should_poll=True,
                 rooms=rooms,
-                timers=timers,
-                routines=routines,
+                timers=timers_of.get(u_id, []),
+                routines=routines_of.get(u_id, []),
+                area=area.name if area else None,
             )
         )
 
-    add_entities(entities, True)
+    for room in klyqa._settings["rooms"]:
+        if len(room["devices"]) < 1:
+            continue
+        entities.append(
+            KlyqaRoomLight(
+                room,
+                klyqa,
+                generate_entity_id(ENTITY_ID_FORMAT, room["name"], hass=hass),
+            )
+        )
+
+    # The lights start with their settings and the states of connected bulbs,
+    # an update of every light before adding would queue hundreds of cloud
+    # requests and bulb requests at once. The others turn available as the
+    # search connects their bulbs.
+    missing = set(klyqa.connections.missing())
+    for entity in entities:
+        if isinstance(entity, KlyqaLight) and entity.u_id in missing:
+            hass.async_create_task(
+                entity.async_connected(klyqa.subscribe_connection(entity.u_id))
+            )
+    add_entities(entities)
+    klyqa.schedule_start(seconds_to_discover=1)
+
+
+def poll_interval(bulbs) -> timedelta:
+    """Poll interval keeping the bulb requests of all lights below POLLS_PER_SECOND."""
+    return max(SCAN_INTERVAL, timedelta(seconds=bulbs / POLLS_PER_SECOND))
+
+
+class KlyqaPollingLight(LightEntity):
+    """Light polling itself and writing its state only when it visibly changed.
+
+    With Home Assistant polling, every update writes a state. Here the visible
+    state after an update is compared with the last written one as a compact
+    snapshot, and unchanged states are not written.
+    """
+
+    _attr_should_poll = False
+    _klyqa_api: Klyqa
+    """poll the state in SCAN_INTERVAL"""
+    poll: bool = True
+    _poll_task: asyncio.Task | None = None
+    """A command came in while the running poll read the state."""
+    _poll_again: bool = False
+    _written_snapshot: tuple | None = None
+    states_written: int = 0
+    states_suppressed: int = 0
+
+    async def async_added_to_hass(self) -> None:
+        """Start polling when added to Home Assistant.
+
+        The first poll is delayed randomly within the poll interval, so the
+        polls of many lights are spread instead of all running at once.
+        """
+        self._written_snapshot = self._state_snapshot()
+        if self.poll:
+            interval = poll_interval(len(self._klyqa_api._settings["devices"]))
+            self.async_on_remove(
+                async_call_later(
+                    self.hass,
+                    random.uniform(0, interval.total_seconds()),
+                    ft.partial(self._async_start_polling, interval),
+                )
+            )
+
+    @callback
+    def _async_start_polling(self, interval, now=None) -> None:
+        self.async_on_remove(
+            async_track_time_interval(self.hass, self.async_poll, interval)
+        )
+        self.hass.async_create_task(self.async_poll())
+
+    def _state_snapshot(self) -> tuple:
+        """Compact comparable snapshot of the visible state."""
+        return (
+            self.available,
+            self.is_on,
+            round(self.brightness) if self.brightness is not None else None,
+            self.color_mode,
+            self.rgb_color,
+            self.color_temp,
+            self.effect,
+            self.name,
+        )
+
+    async def async_poll(self, now=None) -> None:
+        """Update the state and write it when it visibly changed.
+
+        Polls share the running one. A poll after a command waits for it and
+        has it poll once more, it may have read the state before the command.
+        """
+        if self._poll_task is None:
+            self._poll_task = self.hass.async_create_task(self._async_poll())
+        elif now is None:
+            self._poll_again = True
+        await asyncio.shield(self._poll_task)
+
+    async def _async_poll(self) -> None:
+        try:
+            while True:
+                self._poll_again = False
+                await self.async_update()
+                self.async_write_ha_state_if_changed()
+                if not self._poll_again:
+                    return
+        finally:
+            self._poll_task = None
+
+    @callback
+    def async_write_ha_state_if_changed(self) -> None:
+        """Write the state when it differs from the last written state."""
+        snapshot = self._state_snapshot()
+        if snapshot == self._written_snapshot:
+            self.states_suppressed += 1
+            self._klyqa_api.state_updates["suppressed"] += 1
+            return
+        self._written_snapshot = snapshot
+        self.states_written += 1
+        self._klyqa_api.state_updates["written"] += 1
+        self.async_write_ha_state()
+
 
+class KlyqaLight(KlyqaPollingLight, RestoreEntity):
+    """Representation of a Klyqa Light.
 
-class KlyqaLight(LightEntity):
-    """Representation of a Klyqa Light."""
+    The last status the bulb confirmed is stored with the restore state of
+    Home Assistant. After a restart the light shows it, marked as stale,
+    until the bulb answers or STALE_GRACE seconds passed.
+    """
 
     _attr_supported_features = SUPPORT_KLYQA
     _attr_transition_time = 500
 
     _klyqa_api: Klyqa
     _klyqa_device: KlyqaLightDevice
+    """Restored status, not confirmed by the bulb yet."""
+    _stale_status: BulbStatus | None = None
     settings = {}
     """synchrononise rooms to HA"""
     sync_rooms: bool = True
@@ -204,13 +379,14 @@ class KlyqaLight(LightEntity):
         rooms=None,
         timers=None,
         routines=None,
+        area=None,
     ):
-        """Initialize a Klyqa Light Bulb."""
+        """Initialize a Klyqa Light Bulb with the state the search got."""
         self._klyqa_api = klyqa_api
         self.u_id = settings["localDeviceId"]
         self._klyqa_device = device
         self.entity_id = entity_id
-        self._attr_should_poll = should_poll
+        self.poll = should_poll
         self._attr_device_class = "light"
         self._attr_icon = "mdi:lightbulb"
         self.rooms = rooms
@@ -222,27 +398,67 @@ class KlyqaLight(LightEntity):
             COLOR_MODE_RGB,
             # COLOR_MODE_RGBWW
         }
-        self._attr_effect_list = [x["label"] for x in SCENES]
-        """Entity state will be updated after adding the entity."""
-
-    async def async_update_settings(self):
-        """Set device specific settings from the klyqa settings cloud."""
-        devices_settings = self._klyqa_api._settings["devices"]
-
-        device_result = [
-            x for x in devices_settings if str(x["localDeviceId"]) == self.u_id
+        self._attr_effect_list = [x["label"] for x in SCENES] + [
+            x["label"] for x in EFFECTS
         ]
-        if len(device_result) < 1:
+        """Suggested area of the device, the area of its first room."""
+        self._area = area
+        self._apply_settings(settings)
+        self._attr_available = device.status is not None
+        if device.status:
+            self._apply_status(device.status)
+
+    async def async_added_to_hass(self) -> None:
+        """Restore the last confirmed status if the bulb has not answered yet."""
+        if self._klyqa_device.status is None:
+            extra_data = await self.async_get_last_extra_data()
+            status = BulbStatus.from_dict(extra_data.as_dict()) if extra_data else None
+            if status:
+                self._stale_status = status
+                self._attr_available = True
+                self._apply_status(status)
+                self.async_on_remove(
+                    async_call_later(self.hass, STALE_GRACE, self._async_stale_expired)
+                )
+        await super().async_added_to_hass()
+
+    @callback
+    def _async_stale_expired(self, now=None) -> None:
+        if self._stale_status is None:
             return
+        LOGGER.info("Bulb %s did not confirm its restored state", self.entity_id)
+        self._stale_status = None
+        self._attr_available = False
+        self.async_write_ha_state_if_changed()
 
-        response_object = await self.hass.async_add_executor_job(
-            self._klyqa_api.request_get_beared,
-            "/config/product/" + device_result[0]["productId"],
-        )
+    @property
+    def extra_restore_state_data(self) -> RestoredExtraData | None:
+        """Last status confirmed by the bulb, in this run or before."""
+        status = self._klyqa_device.status or self._stale_status
+        return RestoredExtraData(status.as_dict()) if status else None
+
+    @property
+    def extra_state_attributes(self) -> dict:
+        return {"stale": self._stale_status is not None}
 
-        self.device_config = json.loads(response_object.text)
+    def _state_snapshot(self) -> tuple:
+        return super()._state_snapshot() + (self._stale_status is not None,)
+
+    async def async_connected(self, connection: asyncio.Future):
+        """Take the state of the bulb once the search connects it."""
+        if not await connection or self.u_id not in self._klyqa_api.lights:
+            return
+        self._klyqa_device = self._klyqa_api.lights[self.u_id]
+        if self._klyqa_device.status:
+            self._stale_status = None
+            self._attr_available = True
+            self._apply_status(self._klyqa_device.status)
+        if self._written_snapshot is not None:
+            self.async_write_ha_state_if_changed()
 
-        self.settings = device_result[0]
+    def _apply_settings(self, settings):
+        """Set name and device info from the account settings of the bulb."""
+        self.settings = settings
         self._attr_name = self.settings["name"]
         self._attr_unique_id = self.settings["localDeviceId"]
         self._attr_device_info = DeviceInfo(
@@ -254,11 +470,22 @@ class KlyqaLight(LightEntity):
             hw_version=self.settings["hardwareRevision"],  # TODO: Maybe exclude.
             configuration_url="https://www.klyqa.de/produkte/e27-color-lampe",  # TODO: Maybe exclude. Or make rest call for device url.
         )
-        if len(self.rooms) > 0:
-            area_reg = ar.async_get(self.hass)
-            area = area_reg.async_get_area_by_name(self.rooms[0]["name"])
-            if area:
-                self._attr_device_info["suggested_area"] = area.name
+        if self._area:
+            self._attr_device_info["suggested_area"] = self._area
+
+    async def async_update_settings(self):
+        """Set device specific settings from the klyqa settings cloud."""
+        settings = self._klyqa_api.device_settings(self.u_id)
+        if settings is None:
+            return
+
+        device_config = await self._klyqa_api.async_product_config(
+            settings["productId"]
+        )
+        if device_config:
+            self.device_config = device_config
+        if settings is not self.settings:
+            self._apply_settings(settings)
 
     @property
     def entity_registry_enabled_default(self) -> bool:
@@ -270,25 +497,32 @@ class KlyqaLight(LightEntity):
 
         entity_registry = er.async_get(self.hass)
 
-        await self.async_update_klyqa()
-        args = ["--power", "on"]
+        self._klyqa_api.effects.stop(self.u_id)
+
+        if ATTR_TRANSITION in kwargs:
+            self._attr_transition_time = kwargs[ATTR_TRANSITION]
+        target = light_target(kwargs, self._attr_transition_time)
 
         if ATTR_HS_COLOR in kwargs:
-            rgb = color_util.color_hs_to_RGB(*kwargs[ATTR_HS_COLOR])
-            self._attr_rgb_color = (rgb[0], rgb[1], rgb[2])
             self._attr_hs_color = kwargs[ATTR_HS_COLOR]
-
-        if ATTR_RGB_COLOR in kwargs:
-            self._attr_rgb_color = kwargs[ATTR_RGB_COLOR]
-
-        if ATTR_RGB_COLOR in kwargs or ATTR_HS_COLOR in kwargs:
-            args.extend(["--color", *([str(rgb) for rgb in self._attr_rgb_color])])
-
+        if "color" in target:
+            self._attr_rgb_color = target["color"]
         if ATTR_RGBWW_COLOR in kwargs:
             self._attr_rgbww_color = kwargs[ATTR_RGBWW_COLOR]
-            args.extend(
-                ["--percent_color", *([str(rgb) for rgb in self._attr_rgbww_color])]
-            )
+        if ATTR_COLOR_TEMP in kwargs:
+            self._attr_color_temp = kwargs[ATTR_COLOR_TEMP]
+        if ATTR_BRIGHTNESS in kwargs:
+            self._attr_brightness = kwargs[ATTR_BRIGHTNESS]
+        elif ATTR_BRIGHTNESS_PCT in kwargs:
+            self._attr_brightness = round(kwargs[ATTR_BRIGHTNESS_PCT] * 255 / 100)
+
+        if ATTR_EFFECT not in kwargs and self.u_id in self._klyqa_api.lights:
+            target = self._klyqa_api.lights[self.u_id].changes(target)
+            if not target:
+                LOGGER.debug("Bulb %s already in the target state", self.entity_id)
+                return
+
+        args = target_args(target)
 
         if ATTR_EFFECT in kwargs:
             scene_result = [x for x in SCENES if x["label"] == kwargs[ATTR_EFFECT]]
@@ -299,15 +533,18 @@ class KlyqaLight(LightEntity):
                 if len(commands.split(";")) > 2:
                     commands += "l 0;"
 
-                ret = self._klyqa_api.send_to_bulb(
-                    "--routine_id",
-                    "0",
-                    "--routine_scene",
-                    str(scene["id"]),
-                    "--routine_put",
-                    "--routine_command",
-                    commands,
-                    u_id=self.u_id,
+                ret = await self._klyqa_api.executor.async_add_job(
+                    ft.partial(
+                        self._klyqa_api.send_to_bulb,
+                        "--routine_id",
+                        "0",
+                        "--routine_scene",
+                        str(scene["id"]),
+                        "--routine_put",
+                        "--routine_command",
+                        commands,
+                        u_id=self.u_id,
+                    )
                 )
                 if ret:
                     args.extend(
@@ -318,62 +555,48 @@ class KlyqaLight(LightEntity):
                         ]
                     )
 
-        if ATTR_COLOR_TEMP in kwargs:
-            self._attr_color_temp = kwargs[ATTR_COLOR_TEMP]
-            args.extend(
-                [
-                    "--temperature",
-                    str(
-                        color_temperature_mired_to_kelvin(self._attr_color_temp)
-                        if self._attr_color_temp
-                        else 0
-                    ),
-                ]
-            )
-
-        if ATTR_TRANSITION in kwargs:
-            self._attr_transition_time = kwargs[ATTR_TRANSITION]
-
-        if self._attr_transition_time:
-            args.extend(["--transitionTime", str(self._attr_transition_time)])
+        await self.async_send_command(*args)
 
-        if ATTR_BRIGHTNESS in kwargs:
-            self._attr_brightness = kwargs[ATTR_BRIGHTNESS]
-            args.extend(
-                ["--brightness", str(round((self._attr_brightness / 255.0) * 100.0))]
-            )
-
-        if ATTR_BRIGHTNESS_PCT in kwargs:
-            self._attr_brightness = int(
-                round((kwargs[ATTR_BRIGHTNESS_PCT] / 100) * 255)
-            )
-            args.extend(["--brightness", str(ATTR_BRIGHTNESS_PCT)])
+        if ATTR_EFFECT in kwargs and self._klyqa_api.effects.start(
+            self.u_id,
+            kwargs[ATTR_EFFECT],
+            color=self._attr_rgb_color or (255, 255, 255),
+        ):
+            self._attr_effect = kwargs[ATTR_EFFECT]
 
-        LOGGER.info(
-            "Send to bulb " + str(self.entity_id) + "%s: %s",
-            " (" + self.name + ")" if self.name else "",
-            " ".join(args),
-        )
-        ret = self._klyqa_api.send_to_bulb(*(args), u_id=self.u_id)
-        await self.async_update()
+        await self.async_poll()
 
     async def async_turn_off(self, **kwargs):
         """Instruct the light to turn off."""
-        args = ["--power", "off"]
-        if self._attr_transition_time:
-            args.extend(["--transitionTime", str(self._attr_transition_time)])
-        await self.async_update_klyqa()
+        self._klyqa_api.effects.stop(self.u_id)
+        target = {"power": "off", "transition": self._attr_transition_time}
+        if self.u_id in self._klyqa_api.lights:
+            target = self._klyqa_api.lights[self.u_id].changes(target)
+            if not target:
+                LOGGER.debug("Bulb %s already off", self.entity_id)
+                return
+
+        await self.async_send_command(*target_args(target))
+        await self.async_poll()
+
+    async def async_send_command(self, *args):
+        """Send the command to the bulb, synchronized with commands to other bulbs."""
         LOGGER.info(
             "Send to bulb " + str(self.entity_id) + "%s: %s",
             " (" + self.name + ")" if self.name else "",
             " ".join(args),
         )
-        ret = self._klyqa_api.send_to_bulb(*(args), u_id=self.u_id)
-        await self.async_update()
+        if not await self._klyqa_api.dispatcher.async_send(
+            self.u_id, command_messages(*args)
+        ):
+            # Not connected, send_to_bulb reconnects.
+            await self._klyqa_api.executor.async_add_job(
+                ft.partial(self._klyqa_api.send_to_bulb, *args, u_id=self.u_id)
+            )
 
     async def async_update_klyqa(self):
         """Fetch settings from klyqa cloud account."""
-        await self.hass.async_add_executor_job(self._klyqa_api.load_settings)
+        await self._klyqa_api.async_refresh_settings()
         await self.async_update_settings()
         # if self._attr_state == STATE_UNAVAILABLE:
         #     await self.hass.async_add_executor_job(self._klyqa_api.search_missing_bulbs)
@@ -384,11 +607,22 @@ class KlyqaLight(LightEntity):
         This is the only method that should fetch new data for Home Assistant.
         """
         await self.async_update_klyqa()
-        ret = self._klyqa_api.send_to_bulb("--request", u_id=self.u_id)
+        try:
+            ret = await self._klyqa_api.executor.async_add_job(
+                ft.partial(self._klyqa_api.send_to_bulb, "--request", u_id=self.u_id)
+            )
+        except (ExecutorSaturated, asyncio.TimeoutError) as exception:
+            # The state is unknown, like a bulb not answering.
+            self._klyqa_api.metrics.bulb(self.u_id).executor_errors += 1
+            LOGGER.debug("State request of %s failed: %r", self.entity_id, exception)
+            ret = None
         self._update_state(ret)
 
     def _update_state(self, state_complete):
         """Process state request response from the bulb to the entity state."""
+        if not state_complete and self._stale_status:
+            # Keep the restored state until the grace period ends.
+            return
         # self.state = STATE_OK if state_complete else STATE_UNAVAILABLE
         self._attr_state = STATE_OK if state_complete else STATE_UNAVAILABLE
         if self._attr_state == STATE_UNAVAILABLE:
@@ -406,10 +640,7 @@ class KlyqaLight(LightEntity):
         if not state_complete or not isinstance(state_complete, dict):
             return
 
-        LOGGER.info(
-            "Update bulb " + str(self.entity_id) + "%s.",
-            " (" + self.name + ")" if self.name else "",
-        )
+        LOGGER.debug("Update bulb %s (%s).", self.entity_id, self.name)
 
         if "error" in state_complete:
             LOGGER.error(state_complete["error"])
@@ -419,40 +650,165 @@ class KlyqaLight(LightEntity):
             LOGGER.error(state_complete["type"])
             return
 
-        state_type = state_complete.get("type")
-        if not state_type or state_type != "status":
+        status = BulbStatus.from_response(state_complete)
+        if status is None:
             return
 
-        self._klyqa_device.state = state_complete
+        self._klyqa_device.status = status
+        self._stale_status = None
+        self._apply_status(status)
+
+    def _apply_status(self, status: BulbStatus):
+        """Set the entity state from the bulb status."""
         self._attr_color_temp = (
-            color_temperature_kelvin_to_mired(state_complete["temperature"])
-            if state_complete["temperature"]
+            color_temperature_kelvin_to_mired(status.temperature)
+            if status.temperature
             else 0
         )
 
-        self._attr_rgb_color = (
-            state_complete["color"]["red"],
-            state_complete["color"]["green"],
-            state_complete["color"]["blue"],
-        )
+        self._attr_rgb_color = status.rgb
         self._attr_hs_color = color_util.color_RGB_to_hs(*self._attr_rgb_color)
         # interpolate brightness from klyqa bulb 0 - 100 percent to homeassistant 0 - 255 points
-        self._attr_brightness = (
-            float(state_complete["brightness"]["percentage"]) / 100
-        ) * 255
-        self._attr_is_on = state_complete["status"] == "on"
+        self._attr_brightness = (status.brightness / 100) * 255
+        self._attr_is_on = status.power == "on"
 
         self._attr_color_mode = (
             COLOR_MODE_COLOR_TEMP
-            if state_complete["mode"] == "cct"
+            if status.mode == "cct"
             else "effect"
-            if state_complete["mode"] == "cmd"
-            else state_complete["mode"]
+            if status.mode == "cmd"
+            else status.mode
         )
-        self._attr_effect = ""
-        if "active_scene" in state_complete and state_complete["mode"] == "cmd":
-            scene_result = [
-                x for x in SCENES if str(x["id"]) == state_complete["active_scene"]
-            ]
+        self._attr_effect = self._klyqa_api.effects.running_effect(self.u_id) or ""
+        if status.mode == "cmd":
+            scene_result = [x for x in SCENES if str(x["id"]) == status.active_scene]
             if len(scene_result) > 0:
                 self._attr_effect = scene_result[0]["label"]
+
+
+class KlyqaRoomLight(KlyqaPollingLight):
+    """Representation of a Klyqa room, controlling all its bulbs at once.
+
+    A command fans out to the connections of the member bulbs concurrently and
+    is written to them in one synchronized send. The state is aggregated from
+    the last known states of the members, the members are not polled again but
+    their answers to the room commands are read.
+    """
+
+    _attr_supported_features = SUPPORT_KLYQA
+    _attr_transition_time = 500
+
+    _klyqa_api: Klyqa
+
+    def __init__(self, room, klyqa_api, entity_id):
+        """Initialize a Klyqa room light."""
+        self._klyqa_api = klyqa_api
+        self.room = room
+        self.u_ids = [device["localDeviceId"] for device in room["devices"]]
+        self.entity_id = entity_id
+        self._attr_name = room["name"]
+        self._attr_unique_id = "room_" + str(room.get("id", room["name"]))
+        self._attr_icon = "mdi:lightbulb-group"
+        self._attr_supported_color_modes = {
+            COLOR_MODE_BRIGHTNESS,
+            COLOR_MODE_COLOR_TEMP,
+            COLOR_MODE_RGB,
+        }
+        self._attr_effect_list = [x["label"] for x in ROOM_EFFECTS]
+
+    async def async_turn_on(self, **kwargs):
+        """Instruct the bulbs of the room to turn on."""
+        for u_id in self.u_ids:
+            self._klyqa_api.effects.stop(u_id)
+
+        if ATTR_TRANSITION in kwargs:
+            self._attr_transition_time = kwargs[ATTR_TRANSITION]
+        target = light_target(kwargs, self._attr_transition_time)
+        await self.async_send_target(target)
+
+        if ATTR_EFFECT in kwargs:
+            self._klyqa_api.effects.start_room(
+                [x for x in self.u_ids if x in self._klyqa_api.lights],
+                kwargs[ATTR_EFFECT],
+                color=target.get("color", (255, 255, 255)),
+            )
+        await self.async_poll()
+
+    async def async_turn_off(self, **kwargs):
+        """Instruct the bulbs of the room to turn off."""
+        for u_id in self.u_ids:
+            self._klyqa_api.effects.stop(u_id)
+
+        await self.async_send_target(
+            {"power": "off", "transition": self._attr_transition_time}
+        )
+        await self.async_poll()
+
+    async def async_send_target(self, target):
+        """Send the target state to all bulbs of the room in one synchronized send.
+
+        Each bulb only gets the part of the target it does not show yet.
+        """
+        LOGGER.info("Send to room %s: %s", self.name, target)
+        commands = {}
+        for u_id in self.u_ids:
+            if u_id not in self._klyqa_api.lights:
+                continue
+            changes = self._klyqa_api.lights[u_id].changes(target)
+            if changes:
+                commands[u_id] = target_args(changes)
+
+        results = await asyncio.gather(
+            *[
+                self._klyqa_api.dispatcher.async_send(u_id, command_messages(*args))
+                for u_id, args in commands.items()
+            ]
+        )
+        # Not connected bulbs, send_to_bulb reconnects.
+        await asyncio.gather(
+            *[
+                self._klyqa_api.executor.async_add_job(
+                    ft.partial(self._klyqa_api.send_to_bulb, *args, u_id=u_id)
+                )
+                for (u_id, args), result in zip(commands.items(), results)
+                if not result
+            ]
+        )
+
+    async def async_update(self):
+        """Aggregate the room state from the last known states of its bulbs."""
+        try:
+            await self._klyqa_api.executor.async_add_job(
+                self._klyqa_api.read_answers, self.u_ids
+            )
+        except Exception as exception:
+            LOGGER.debug(
+                "Reading the answers of room %s failed: %s", self.name, exception
+            )
+        statuses = [
+            self._klyqa_api.lights[u_id].status
+            for u_id in self.u_ids
+            if u_id in self._klyqa_api.lights and self._klyqa_api.lights[u_id].status
+        ]
+        self._attr_available = len(statuses) > 0
+        statuses_on = [x for x in statuses if x.power == "on"]
+        self._attr_is_on = len(statuses_on) > 0
+        if not self._attr_is_on:
+            return
+
+        self._attr_brightness = (
+            sum(x.brightness for x in statuses_on) / len(statuses_on) / 100
+        ) * 255
+        status = statuses_on[0]
+        self._attr_rgb_color = status.rgb
+        self._attr_hs_color = color_util.color_RGB_to_hs(*self._attr_rgb_color)
+        self._attr_color_temp = (
+            color_temperature_kelvin_to_mired(status.temperature)
+            if status.temperature
+            else 0
+        )
+        self._attr_color_mode = (
+            COLOR_MODE_COLOR_TEMP if status.mode == "cct" else COLOR_MODE_RGB
+        )
+        effect = self._klyqa_api.effects.running_effect(self.u_ids[0])
+        self._attr_effect = effect if effect in self._attr_effect_list else ""
@@ -0,0 +1,150 @@
+"""Latency and reliability counters of the Klyqa bulbs and the cloud."""
+from __future__ import annotations
+
+import bisect
+
+
+class Histogram:
+    """Counts of samples in fixed buckets, with their sum and maximum.
+
+    The percentiles are the upper bounds of the buckets they fall in, so they
+    are estimates, good enough to tell the slow bulbs from the fast ones.
+    """
+
+    """Upper bounds of the buckets in seconds, the last bucket is unbounded."""
+    BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    __slots__ = ("counts", "count", "total", "maximum")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, seconds) -> None:
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def percentile(self, fraction) -> float:
+        """Estimate the percentile (0-1) in seconds."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.BOUNDS[index] if index < len(self.BOUNDS) else self.maximum
+        return self.maximum
+
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def as_dict(self) -> dict:
+        buckets = {
+            f"le_{int(bound * 1000)}ms": count
+            for bound, count in zip(self.BOUNDS, self.counts)
+        }
+        buckets["inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.average() * 1000, 1),
+            "p50_ms": round(self.percentile(0.5) * 1000, 1),
+            "p95_ms": round(self.percentile(0.95) * 1000, 1),
+            "max_ms": round(self.maximum * 1000, 1),
+            "buckets": buckets,
+        }
+
+
+class BulbMetrics:
+    """Counters of the commands and the connection of one bulb."""
+
+    __slots__ = (
+        "commands",
+        "answered",
+        "no_answer",
+        "retries",
+        "reconnects",
+        "frame_errors",
+        "decrypt_errors",
+        "json_errors",
+        "executor_errors",
+        "rtt",
+        "handshake",
+    )
+
+    def __init__(self):
+        self.commands = 0
+        self.answered = 0
+        """Commands without answer after all retries."""
+        self.no_answer = 0
+        self.retries = 0
+        self.reconnects = 0
+        """Packages the bulb did not take or that could not be framed."""
+        self.frame_errors = 0
+        self.decrypt_errors = 0
+        self.json_errors = 0
+        """Commands the full thread pool rejected or that timed out in it."""
+        self.executor_errors = 0
+        """Round trip time from sending a command to its answer."""
+        self.rtt = Histogram()
+        """Time from the bulb connecting to the established AES session."""
+        self.handshake = Histogram()
+
+    def as_dict(self) -> dict:
+        return {
+            "commands": self.commands,
+            "answered": self.answered,
+            "no_answer": self.no_answer,
+            "retries": self.retries,
+            "reconnects": self.reconnects,
+            "frame_errors": self.frame_errors,
+            "decrypt_errors": self.decrypt_errors,
+            "json_errors": self.json_errors,
+            "executor_errors": self.executor_errors,
+            "rtt": self.rtt.as_dict(),
+            "handshake": self.handshake.as_dict(),
+        }
+
+
+class CloudMetrics:
+    """Latency and failures of the requests to the klyqa cloud."""
+
+    __slots__ = ("requests", "errors", "latency")
+
+    def __init__(self):
+        self.requests = 0
+        """Requests failing or answered with an error status."""
+        self.errors = 0
+        self.latency = Histogram()
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency": self.latency.as_dict(),
+        }
+
+
+class Metrics:
+    """Metrics of the bulbs by local device id and of the cloud requests."""
+
+    def __init__(self):
+        self.bulbs: dict[str, BulbMetrics] = {}
+        self.cloud = CloudMetrics()
+
+    def bulb(self, u_id) -> BulbMetrics:
+        """Return the metrics of the bulb, created on first use."""
+        metrics = self.bulbs.get(u_id)
+        if metrics is None:
+            metrics = self.bulbs[u_id] = BulbMetrics()
+        return metrics
+
+    def as_dict(self) -> dict:
+        return {
+            "bulbs": {u_id: x.as_dict() for u_id, x in self.bulbs.items()},
+            "cloud": self.cloud.as_dict(),
+        }
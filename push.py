@@ -0,0 +1,149 @@
+"""Account change notifications of the klyqa cloud over a websocket."""
+from __future__ import annotations
+
+import asyncio
+import json
+import random
+import time
+
+from .const import LOGGER
+
+# The route and the message type are assumed, the cloud does not document a
+# notification channel yet. The channel is therefore off unless the
+# push_notifications option is set, and the emulator serves the same route.
+"""Websocket route of the account notifications on the cloud host."""
+PUSH_PATH = "/notifications"
+"""Notification type of changed account settings: renames, room moves, new devices."""
+SETTINGS_CHANGED = "settingsChanged"
+
+
+def push_url(host: str) -> str:
+    """Websocket url of the account notifications on the cloud host."""
+    scheme, separator, rest = host.partition("://")
+    if not separator:
+        return "wss://" + host.rstrip("/") + PUSH_PATH
+    scheme = "wss" if scheme == "https" else "ws"
+    return scheme + "://" + rest.rstrip("/") + PUSH_PATH
+
+
+class SettingsPush:
+    """Refreshes the account settings when the cloud signals a change.
+
+    While the channel is connected, the polling of the lights only refreshes
+    the settings every FALLBACK_AGE seconds, so a lost notification is picked
+    up late instead of never. Reconnects back off from MIN_BACKOFF up to
+    MAX_BACKOFF seconds, and a reconnect refreshes the settings once for the
+    changes missed meanwhile. A rejected access token is renewed by a login
+    before the next attempt. The websocket is opened with the aiohttp session
+    of Home Assistant.
+    """
+
+    MIN_BACKOFF = 1.0
+    MAX_BACKOFF = 300.0
+    FALLBACK_AGE = 900.0
+    HEARTBEAT = 30.0
+
+    def __init__(self, klyqa):
+        self._klyqa = klyqa
+        self._task: asyncio.Task | None = None
+        self._refresh: asyncio.Task | None = None
+        """Monotonic time of the last signalled change."""
+        self._signalled_at = 0.0
+        self._backoff = self.MIN_BACKOFF
+        self.connected = False
+        self.connects = 0
+        self.failures = 0
+        self.notifications = 0
+
+    def start(self) -> None:
+        """Listen to the notifications until stopped, if they are enabled."""
+        klyqa = self._klyqa
+        if self._task is None and klyqa.push_notifications and not klyqa._stopped:
+            self._task = self._klyqa.hass.async_create_task(self._async_run())
+
+    def stop(self) -> None:
+        for task in (self._task, self._refresh):
+            if task:
+                task.cancel()
+        self._task = None
+        self._refresh = None
+        self.connected = False
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.connected,
+            "connects": self.connects,
+            "failures": self.failures,
+            "notifications": self.notifications,
+            "backoff": self._backoff,
+        }
+
+    async def _async_run(self):
+        while True:
+            try:
+                await self._async_listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exception:
+                self.failures += 1
+                LOGGER.debug("Klyqa notifications disconnected: %s", exception)
+            self.connected = False
+            # Spread the reconnects of many instances after a cloud outage.
+            await asyncio.sleep(self._backoff * random.uniform(0.5, 1.0))
+            self._backoff = min(self._backoff * 2, self.MAX_BACKOFF)
+
+    async def _async_listen(self):
+        import aiohttp
+        from homeassistant.helpers.aiohttp_client import async_get_clientsession
+
+        klyqa = self._klyqa
+        if not klyqa._access_token and not await klyqa.executor.async_add_job(
+            klyqa.login
+        ):
+            raise ConnectionError("login failed")
+        try:
+            websocket = await async_get_clientsession(klyqa.hass).ws_connect(
+                push_url(klyqa._host),
+                headers={"Authorization": "Bearer " + klyqa._access_token},
+                heartbeat=self.HEARTBEAT,
+            )
+        except aiohttp.WSServerHandshakeError as exception:
+            if exception.status == 401:
+                klyqa._access_token = ""
+            raise
+        self.connected = True
+        self.connects += 1
+        self._backoff = self.MIN_BACKOFF
+        if self.connects > 1:
+            self._signalled()
+        try:
+            async for message in websocket:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                try:
+                    notification = json.loads(message.data)
+                except ValueError:
+                    continue
+                if notification.get("type") == SETTINGS_CHANGED:
+                    self.notifications += 1
+                    self._signalled()
+        finally:
+            await websocket.close()
+
+    def _signalled(self):
+        self._signalled_at = time.monotonic()
+        if self._refresh is None:
+            self._refresh = self._klyqa.hass.async_create_task(self._async_refresh())
+
+    async def _async_refresh(self):
+        klyqa = self._klyqa
+        try:
+            # A refresh requested before the last change was signalled may
+            # miss it, changes signalled meanwhile are covered by one more.
+            while klyqa._settings_loaded < self._signalled_at:
+                await klyqa.async_refresh_settings(max_age=0)
+        except Exception as exception:
+            LOGGER.warning("Klyqa settings refresh failed: %s", exception)
+        finally:
+            if self._refresh is asyncio.current_task():
+                self._refresh = None
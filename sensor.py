@@ -0,0 +1,117 @@
+"""Diagnostic sensors of the Klyqa bulb connections."""
+from __future__ import annotations
+
+from datetime import timedelta
+
+from homeassistant.components.sensor import SensorEntity, SensorStateClass
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.const import TIME_MILLISECONDS
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.entity import DeviceInfo, EntityCategory
+from homeassistant.helpers.entity_platform import AddEntitiesCallback
+
+from .api import Klyqa
+from .const import DOMAIN
+
+SCAN_INTERVAL = timedelta(seconds=30)
+
+"""Sensors of every bulb: key, name, unit and value from the bulb metrics."""
+BULB_SENSORS = [
+    ("rtt", "Round trip time", TIME_MILLISECONDS, lambda x: x.rtt.average() * 1000),
+    (
+        "rtt_p95",
+        "Round trip time p95",
+        TIME_MILLISECONDS,
+        lambda x: x.rtt.percentile(0.95) * 1000,
+    ),
+    (
+        "handshake",
+        "Handshake time",
+        TIME_MILLISECONDS,
+        lambda x: x.handshake.average() * 1000,
+    ),
+    ("no_answer", "Unanswered commands", None, lambda x: x.no_answer),
+    ("retries", "Retries", None, lambda x: x.retries),
+    ("reconnects", "Reconnects", None, lambda x: x.reconnects),
+    (
+        "errors",
+        "Protocol errors",
+        None,
+        lambda x: x.frame_errors + x.decrypt_errors + x.json_errors,
+    ),
+]
+
+
+async def async_setup_entry(
+    hass: HomeAssistant, entry: ConfigEntry, async_add_entities: AddEntitiesCallback
+) -> None:
+    """Set up the diagnostic sensors of the Klyqa bulbs."""
+    klyqa: Klyqa = hass.data[DOMAIN]
+
+    entities: list[SensorEntity] = [KlyqaCloudLatencySensor(klyqa)]
+    for device in klyqa._settings["devices"]:
+        for key, name, unit, value in BULB_SENSORS:
+            entities.append(
+                KlyqaBulbMetricSensor(klyqa, device, key, name, unit, value)
+            )
+
+    async_add_entities(entities)
+
+
+class KlyqaMetricSensor(SensorEntity):
+    """Diagnostic sensor, disabled until enabled in the entity settings."""
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_entity_registry_enabled_default = False
+    _attr_state_class = SensorStateClass.MEASUREMENT
+
+    _klyqa_api: Klyqa
+
+
+class KlyqaBulbMetricSensor(KlyqaMetricSensor):
+    """Metric of the commands and the connection of one bulb."""
+
+    def __init__(self, klyqa_api, device, key, name, unit, value):
+        self._klyqa_api = klyqa_api
+        self.u_id = device["localDeviceId"]
+        self._value = value
+        self._attr_name = f"{device['name']} {name}"
+        self._attr_unique_id = f"{self.u_id}_{key}"
+        self._attr_native_unit_of_measurement = unit
+        self._attr_device_info = DeviceInfo(identifiers={(DOMAIN, self.u_id)})
+        if unit is None:
+            self._attr_state_class = SensorStateClass.TOTAL_INCREASING
+
+    @property
+    def native_value(self):
+        value = self._value(self._klyqa_api.metrics.bulb(self.u_id))
+        return round(value, 1) if isinstance(value, float) else value
+
+    @property
+    def extra_state_attributes(self) -> dict | None:
+        """All metrics of the bulb, on its round trip time sensor only."""
+        if not self._attr_unique_id.endswith("_rtt"):
+            return None
+        return self._klyqa_api.metrics.bulb(self.u_id).as_dict()
+
+
+class KlyqaCloudLatencySensor(KlyqaMetricSensor):
+    """Average latency of the requests to the klyqa cloud."""
+
+    _attr_name = "Klyqa cloud latency"
+    _attr_unique_id = "klyqa_cloud_latency"
+    _attr_native_unit_of_measurement = TIME_MILLISECONDS
+
+    def __init__(self, klyqa_api):
+        self._klyqa_api = klyqa_api
+
+    @property
+    def native_value(self):
+        return round(self._klyqa_api.metrics.cloud.latency.average() * 1000, 1)
+
+    @property
+    def extra_state_attributes(self) -> dict:
+        return {
+            **self._klyqa_api.metrics.cloud.as_dict(),
+            "thread_pool": self._klyqa_api.executor.metrics(),
+        }
@@ -0,0 +1,229 @@
+"""Services of the Klyqa integration."""
+from __future__ import annotations
+
+import asyncio
+import functools as ft
+import time
+
+import voluptuous as vol
+
+from homeassistant.components.light import (
+    DOMAIN as LIGHT_DOMAIN,
+    ATTR_BRIGHTNESS_PCT,
+    ATTR_EFFECT,
+    ATTR_KELVIN,
+    ATTR_RGB_COLOR,
+)
+from homeassistant.const import ATTR_ENTITY_ID, CONF_STATE, STATE_OFF, STATE_ON
+from homeassistant.core import HomeAssistant, ServiceCall, valid_entity_id
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers import entity_registry as er
+import homeassistant.helpers.config_validation as cv
+
+from .api import Klyqa
+from .const import DOMAIN, LOGGER
+
+SERVICE_START_ROOM_EFFECT = "start_room_effect"
+SERVICE_STOP_ROOM_EFFECT = "stop_room_effect"
+SERVICE_STREAM_COLORS = "stream_colors"
+SERVICE_SET_MANY = "set_many"
+SERVICE_DUMP_TRACE = "dump_trace"
+
+EVENT_SET_MANY_RESULT = "klyqa_set_many_result"
+
+ATTR_ROOM = "room"
+ATTR_FPS = "fps"
+ATTR_FRAMES = "frames"
+ATTR_TRANSITION_TIME = "transition_time"
+ATTR_TARGETS = "targets"
+ATTR_FILENAME = "filename"
+
+RGB_COLOR = vol.All(vol.ExactSequence((cv.byte,) * 3), vol.Coerce(tuple))
+
+START_ROOM_EFFECT_SCHEMA = vol.Schema(
+    {
+        vol.Required(ATTR_ROOM): cv.string,
+        vol.Required(ATTR_EFFECT): cv.string,
+        vol.Optional(ATTR_RGB_COLOR, default=[255, 255, 255]): RGB_COLOR,
+        vol.Optional(ATTR_FPS): vol.All(vol.Coerce(int), vol.Range(min=1, max=30)),
+    }
+)
+
+STOP_ROOM_EFFECT_SCHEMA = vol.Schema({vol.Required(ATTR_ROOM): cv.string})
+
+STREAM_COLORS_SCHEMA = vol.Schema(
+    {
+        vol.Inclusive(ATTR_ENTITY_ID, "color"): cv.entity_ids,
+        vol.Inclusive(ATTR_RGB_COLOR, "color"): RGB_COLOR,
+        vol.Optional(ATTR_FRAMES, default={}): {cv.string: RGB_COLOR},
+        vol.Optional(ATTR_TRANSITION_TIME, default=0): vol.All(
+            vol.Coerce(int), vol.Range(min=0, max=200)
+        ),
+    }
+)
+
+"""A plain json lines file name, the dump stays in the config folder."""
+DUMP_TRACE_SCHEMA = vol.Schema(
+    {vol.Optional(ATTR_FILENAME): vol.All(cv.string, vol.Match(r"^[\w.-]+\.jsonl\Z"))}
+)
+
+TARGET_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_STATE, default=STATE_ON): vol.In([STATE_ON, STATE_OFF]),
+        vol.Optional(ATTR_RGB_COLOR): RGB_COLOR,
+        vol.Optional(ATTR_BRIGHTNESS_PCT): vol.All(
+            vol.Coerce(int), vol.Range(min=0, max=100)
+        ),
+        vol.Optional(ATTR_KELVIN): vol.All(
+            vol.Coerce(int), vol.Range(min=1000, max=12000)
+        ),
+        vol.Optional(ATTR_TRANSITION_TIME): vol.All(vol.Coerce(int), vol.Range(min=0)),
+    }
+)
+
+SET_MANY_SCHEMA = vol.Schema(
+    {vol.Required(ATTR_TARGETS): vol.Schema({cv.string: TARGET_SCHEMA})}
+)
+
+
+def _local_device_id(hass: HomeAssistant, key) -> str:
+    """
+    Local device id of the bulb of a Klyqa light entity id, other keys are
+    taken as local device ids.
+
+    Raises:
+        HomeAssistantError: The key is no light of a bulb of the account, like
+            a room light or a sensor.
+    """
+    u_id = key
+    if valid_entity_id(key):
+        entry = er.async_get(hass).async_get(key)
+        if not entry or entry.platform != DOMAIN or entry.domain != LIGHT_DOMAIN:
+            raise HomeAssistantError(f"{key} is not a Klyqa light")
+        u_id = entry.unique_id
+    klyqa: Klyqa = hass.data[DOMAIN]
+    if klyqa.device_settings(u_id) is None:
+        raise HomeAssistantError(f"{key} is not a bulb of the Klyqa account")
+    return u_id
+
+
+def _target(data) -> dict:
+    """Bulb target state (see api.target_args) for the set_many target data."""
+    target = {"power": data[CONF_STATE]}
+    if ATTR_RGB_COLOR in data:
+        target["color"] = data[ATTR_RGB_COLOR]
+    if ATTR_BRIGHTNESS_PCT in data:
+        target["brightness"] = data[ATTR_BRIGHTNESS_PCT]
+    if ATTR_KELVIN in data:
+        target["temperature"] = data[ATTR_KELVIN]
+    if ATTR_TRANSITION_TIME in data:
+        target["transition"] = data[ATTR_TRANSITION_TIME]
+    return target
+
+
+def async_setup_services(hass: HomeAssistant) -> None:
+    """Register the Klyqa services."""
+
+    async def async_start_room_effect(call: ServiceCall) -> None:
+        klyqa: Klyqa = hass.data[DOMAIN]
+        room = call.data[ATTR_ROOM]
+        u_ids = [x for x in klyqa.room_devices(room) if x in klyqa.lights]
+        if len(u_ids) < 1:
+            LOGGER.warning("No connected bulbs in room %s", room)
+            return
+
+        await asyncio.gather(
+            *[
+                klyqa.executor.async_add_job(
+                    ft.partial(klyqa.send_to_bulb, "--power", "on", u_id=u_id)
+                )
+                for u_id in u_ids
+            ]
+        )
+        if not klyqa.effects.start_room(
+            u_ids,
+            call.data[ATTR_EFFECT],
+            color=call.data[ATTR_RGB_COLOR],
+            fps=call.data.get(ATTR_FPS),
+        ):
+            LOGGER.warning("Unknown room effect %s", call.data[ATTR_EFFECT])
+
+    async def async_stop_room_effect(call: ServiceCall) -> None:
+        klyqa: Klyqa = hass.data[DOMAIN]
+        for u_id in klyqa.room_devices(call.data[ATTR_ROOM]):
+            klyqa.effects.stop(u_id)
+
+    async def async_stream_colors(call: ServiceCall) -> None:
+        klyqa: Klyqa = hass.data[DOMAIN]
+        frames = dict(call.data[ATTR_FRAMES])
+        for entity_id in call.data.get(ATTR_ENTITY_ID, []):
+            frames[_local_device_id(hass, entity_id)] = call.data[ATTR_RGB_COLOR]
+
+        for u_id in frames:
+            klyqa.effects.stop(u_id)
+        klyqa.stream.push(frames, transition=call.data[ATTR_TRANSITION_TIME])
+
+    async def async_set_many(call: ServiceCall) -> None:
+        klyqa: Klyqa = hass.data[DOMAIN]
+        targets = {
+            _local_device_id(hass, key): _target(data)
+            for key, data in call.data[ATTR_TARGETS].items()
+        }
+        for u_id in targets:
+            klyqa.effects.stop(u_id)
+
+        results = await klyqa.async_set_many(targets)
+        LOGGER.debug("Set many bulbs: %s", results)
+        hass.bus.async_fire(EVENT_SET_MANY_RESULT, results)
+
+    async def async_dump_trace(call: ServiceCall) -> None:
+        klyqa: Klyqa = hass.data[DOMAIN]
+        filename = call.data.get(
+            ATTR_FILENAME, time.strftime("klyqa_trace_%Y%m%d_%H%M%S.jsonl")
+        )
+        path = hass.config.path(filename)
+        frames = await klyqa.executor.async_add_job(klyqa.trace.dump, path)
+        LOGGER.info("Dumped %s protocol frames to %s", frames, path)
+
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_START_ROOM_EFFECT,
+        async_start_room_effect,
+        schema=START_ROOM_EFFECT_SCHEMA,
+    )
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_STOP_ROOM_EFFECT,
+        async_stop_room_effect,
+        schema=STOP_ROOM_EFFECT_SCHEMA,
+    )
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_STREAM_COLORS,
+        async_stream_colors,
+        schema=STREAM_COLORS_SCHEMA,
+    )
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_SET_MANY,
+        async_set_many,
+        schema=SET_MANY_SCHEMA,
+    )
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_DUMP_TRACE,
+        async_dump_trace,
+        schema=DUMP_TRACE_SCHEMA,
+    )
+
+
+def async_unload_services(hass: HomeAssistant) -> None:
+    """Remove the Klyqa services."""
+    for service in (
+        SERVICE_START_ROOM_EFFECT,
+        SERVICE_STOP_ROOM_EFFECT,
+        SERVICE_STREAM_COLORS,
+        SERVICE_SET_MANY,
+        SERVICE_DUMP_TRACE,
+    ):
+        hass.services.async_remove(DOMAIN, service)
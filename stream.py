@@ -0,0 +1,135 @@
+"""High frame rate color streaming to the Klyqa bulbs."""
+from __future__ import annotations
+
+import asyncio
+import collections
+
+from .const import LOGGER
+from .executor import ExecutorSaturated
+
+EVENT_STREAM_STATS = "klyqa_stream_stats"
+
+
+class StreamStats:
+    """Frame counters of one streamed bulb."""
+
+    def __init__(self):
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.sent_times = collections.deque(maxlen=64)
+
+    def as_dict(self) -> dict:
+        fps = 0.0
+        if len(self.sent_times) > 1:
+            duration = self.sent_times[-1] - self.sent_times[0]
+            if duration > 0:
+                fps = (len(self.sent_times) - 1) / duration
+        return {
+            "received": self.received,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "fps": round(fps, 1),
+            "lag_ms": round(self.lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+        }
+
+
+class ColorStream:
+    """Streams color frames to the bulbs, the newest frame wins.
+
+    Every bulb has a single frame slot. A frame pushed while the previous one
+    still waits replaces it and the previous one counts as dropped. One sender
+    task per bulb writes the slot without the status round trip of send_to_bulb,
+    and stops after IDLE_TIMEOUT seconds without frames.
+    """
+
+    IDLE_TIMEOUT = 5.0
+
+    def __init__(self, klyqa):
+        self._klyqa = klyqa
+        self._slots: dict[str, tuple] = {}
+        self._wakeups: dict[str, asyncio.Event] = {}
+        self._senders: dict[str, asyncio.Task] = {}
+        self._reporter: asyncio.Task | None = None
+        self._stats: dict[str, StreamStats] = {}
+
+    def push(self, frames: dict, transition=0) -> None:
+        """Queue the colors, mapping local device id to (r, g, b), for sending."""
+        hass = self._klyqa.hass
+        now = hass.loop.time()
+        for u_id, color in frames.items():
+            stats = self._stats.setdefault(u_id, StreamStats())
+            stats.received += 1
+            if u_id in self._slots:
+                stats.dropped += 1
+            self._slots[u_id] = (tuple(color), transition, now)
+            self._wakeups.setdefault(u_id, asyncio.Event()).set()
+            if u_id not in self._senders:
+                self._senders[u_id] = hass.async_create_task(self._async_send(u_id))
+
+        if self._reporter is None:
+            self._reporter = hass.async_create_task(self._async_report())
+
+    def stats(self) -> dict:
+        """Return the stream counters per bulb."""
+        return {u_id: stats.as_dict() for u_id, stats in self._stats.items()}
+
+    def stop(self) -> None:
+        """Stop streaming, pending frames are discarded."""
+        for task in list(self._senders.values()):
+            task.cancel()
+        if self._reporter:
+            self._reporter.cancel()
+        self._senders.clear()
+        self._slots.clear()
+        self._wakeups.clear()
+        self._reporter = None
+
+    async def _async_send(self, u_id):
+        hass = self._klyqa.hass
+        wakeup = self._wakeups[u_id]
+        stats = self._stats[u_id]
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self.IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return
+                wakeup.clear()
+                if u_id not in self._slots:
+                    continue
+                (red, green, blue), transition, pushed = self._slots.pop(u_id)
+
+                try:
+                    sent = await self._klyqa.executor.async_add_job(
+                        self._klyqa.send_color_frame, u_id, red, green, blue, transition
+                    )
+                except (ExecutorSaturated, asyncio.TimeoutError):
+                    self._klyqa.metrics.bulb(u_id).executor_errors += 1
+                    sent = False
+                now = hass.loop.time()
+                if not sent:
+                    stats.failed += 1
+                    continue
+                stats.sent += 1
+                stats.sent_times.append(now)
+                stats.lag = now - pushed
+                stats.max_lag = max(stats.max_lag, stats.lag)
+        finally:
+            if self._senders.get(u_id) is asyncio.current_task():
+                del self._senders[u_id]
+
+    async def _async_report(self):
+        try:
+            while self._senders:
+                await asyncio.sleep(1)
+                self._klyqa.hass.bus.async_fire(EVENT_STREAM_STATS, self.stats())
+            LOGGER.debug("Color stream idle: %s", self.stats())
+        finally:
+            if self._reporter is asyncio.current_task():
+                self._reporter = None
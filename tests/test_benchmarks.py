@@ -0,0 +1,19 @@
+"""Startup budgets and scale targets, with small emulated accounts."""
+import asyncio
+
+from ..benchmarks import scale, startup
+
+"""Seconds a benchmark may run before the test fails instead of hanging."""
+TIMEOUT = 120
+
+
+def test_startup_budgets():
+    args = startup.parse_args(["--bulbs", "10", "--repeat", "3"])
+    results = startup.run(args, timeout=TIMEOUT)
+    assert not results["missed"], results["missed"]
+
+
+def test_scale_targets():
+    args = scale.parse_args(["--bulbs", "100", "--discovery-seconds", "5"])
+    results = asyncio.run(asyncio.wait_for(scale.run(args), TIMEOUT))
+    assert not results["missed"], results["missed"]
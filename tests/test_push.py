@@ -0,0 +1,64 @@
+"""Settings push channel against the websocket of the cloud stub."""
+import asyncio
+import tempfile
+import time
+
+from homeassistant.core import HomeAssistant
+
+from ..api import Klyqa
+from ..emulator.cloud import CloudStub, make_account
+
+
+async def wait_for(condition, timeout=5.0):
+    started = time.monotonic()
+    while not condition():
+        assert time.monotonic() - started < timeout, "timed out"
+        await asyncio.sleep(0.01)
+
+
+async def run_push():
+    hass = HomeAssistant()
+    hass.config.config_dir = tempfile.mkdtemp()
+    settings = make_account(5, seed=0)
+    cloud = CloudStub(settings)
+    host = await cloud.start()
+    klyqa = Klyqa(
+        "push@klyqa.de", "push", host, hass, sync_rooms=False, push_notifications=True
+    )
+    klyqa.push.MIN_BACKOFF = klyqa.push._backoff = 0.05
+    try:
+        await klyqa.executor.async_add_job(klyqa.login)
+        await klyqa.async_refresh_settings()
+        klyqa.push.start()
+        await wait_for(lambda: klyqa.push.connected)
+
+        # A rename is picked up.
+        u_id = settings["devices"][0]["localDeviceId"]
+        settings["devices"][0]["name"] = "Renamed"
+        assert await cloud.notify_settings_changed() == 1
+        await wait_for(lambda: klyqa.device_settings(u_id)["name"] == "Renamed")
+
+        # A burst of signals is coalesced.
+        await wait_for(lambda: klyqa.push._refresh is None)
+        requests = cloud.requests["settings"]
+        for _ in range(10):
+            await cloud.notify_settings_changed()
+        await wait_for(lambda: klyqa.push.notifications == 11)
+        await wait_for(lambda: klyqa.push._refresh is None)
+        assert 1 <= cloud.requests["settings"] - requests <= 2
+
+        # A rejected token is renewed and the channel reconnects.
+        logins = cloud.requests["login"]
+        cloud.expire_tokens()
+        await cloud.disconnect_notifications()
+        await wait_for(lambda: klyqa.push.connects == 2 and klyqa.push.connected)
+        assert cloud.requests["login"] == logins + 1
+        assert cloud.statuses[401] >= 1
+    finally:
+        await klyqa.async_stop()
+        await cloud.stop()
+        await hass.async_stop(force=True)
+
+
+def test_push():
+    asyncio.run(asyncio.wait_for(run_push(), 60))
@@ -0,0 +1,195 @@
+"""Ring buffer of the protocol frames exchanged with the Klyqa bulbs.
+
+The last frames are kept in memory with their decrypted payloads and the
+bytes received from the bulbs as they were read, so a field issue can be
+looked at without debug logging. Dump the buffer with the klyqa.dump_trace
+service and replay the received bytes offline with the AES keys of the bulbs
+python -m custom_components.klyqa.trace <dump file> --key <u_id>:<aes key hex>
+"""
+from __future__ import annotations
+
+import collections
+import json
+import socket
+import time
+
+TX = "tx"
+RX = "rx"
+"""Frame type of the bytes of one socket read, before they are split into packages."""
+RAW = "raw"
+"""Error counters of the bulb metrics reported by a replay."""
+REPLAY_ERRORS = ("frame_errors", "decrypt_errors", "json_errors")
+
+
+class FrameTrace:
+    """Bounded buffer of the latest frames, the oldest frames are dropped.
+
+    Recording a frame appends a tuple, the payloads are only formatted when
+    the buffer is dumped.
+    """
+
+    SIZE = 2000
+
+    def __init__(self, size=SIZE):
+        self._frames = collections.deque(maxlen=size)
+        self.recorded = 0
+
+    def record(self, direction, u_id, pkg_type, payload) -> None:
+        """
+        Args:
+            direction (str): TX to the bulb or RX from the bulb.
+            pkg_type (int|str): 0 plain, 1 initial vector, 2 encrypted or RAW
+                for received bytes.
+            payload (str|bytes): Decrypted message, initial vectors and
+                received bytes as bytes.
+        """
+        self._frames.append((time.time(), direction, u_id, pkg_type, payload))
+        self.recorded += 1
+
+    def frames(self) -> list[dict]:
+        """Return the buffered frames, oldest first."""
+        return [
+            {
+                "time": timestamp,
+                "direction": direction,
+                "u_id": u_id,
+                "type": pkg_type,
+                "payload": payload.hex() if isinstance(payload, bytes) else payload,
+            }
+            for timestamp, direction, u_id, pkg_type, payload in list(self._frames)
+        ]
+
+    def dump(self, path) -> int:
+        """Write the buffered frames as json lines, return the number of frames."""
+        frames = self.frames()
+        with open(path, "w", encoding="utf-8") as file:
+            for frame in frames:
+                file.write(json.dumps(frame) + "\n")
+        return len(frames)
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self._frames),
+            "size": self._frames.maxlen,
+            "recorded": self.recorded,
+        }
+
+
+def load(path) -> list[dict]:
+    """Read the frames of a dump."""
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+class _ReplaySocket:
+    """Socket handing out the recorded reads, one per receive of the integration."""
+
+    _closed = False
+
+    def __init__(self):
+        self.reads = collections.deque()
+
+    def recv(self, size):
+        if not self.reads:
+            raise socket.timeout()
+        return self.reads.popleft()
+
+
+def replay(frames, keys) -> list[dict]:
+    """
+    Run the received bytes of a dump through the receive path of the integration.
+
+    The reads of each bulb are handed to Klyqa._read_pending one by one as the
+    socket returned them, so they are framed, kept over incomplete packages,
+    decrypted with the chained cipher of the session and parsed like in the
+    field. The cipher of a session is set up from its recorded initial vectors.
+
+    Args:
+        frames (list): Frames of a dump, see load.
+        keys (dict): Local device id to the AES key of the bulb.
+
+    Returns:
+        list: Per decrypted answer the u_id, payload and the parsed status,
+            and the frame, decrypt and json errors of the reads.
+    """
+    # Replay only, not needed while Home Assistant runs.
+    from .api import STATE_CONNECTED, BulbStatus, Connection, Klyqa, new_aes
+
+    klyqa = Klyqa("", "", "")
+    klyqa.trace = FrameTrace(size=None)
+    connections = {}
+    local_ivs = {}
+    results = []
+    try:
+        for frame in frames:
+            u_id = frame["u_id"]
+            if frame["type"] == 1 and frame["direction"] == TX:
+                local_ivs[u_id] = bytes.fromhex(frame["payload"])
+            elif frame["type"] == 1 and u_id in local_ivs:
+                # The initial vector of the bulb completes the handshake.
+                if u_id not in keys:
+                    results.append({"u_id": u_id, "error": "no aes key"})
+                    continue
+                # A new session, its reads go through a new connection.
+                connection = connections[u_id] = Connection(_ReplaySocket())
+                connection.u_id = u_id
+                connection.state = STATE_CONNECTED
+                connection.receiving_aes = new_aes(
+                    keys[u_id],
+                    bytes.fromhex(frame["payload"]) + local_ivs[u_id],
+                )
+            elif frame["type"] == RAW and u_id in connections:
+                # Reads of a handshake come before its initial vectors.
+                connection = connections[u_id]
+                connection.socket.reads.append(bytes.fromhex(frame["payload"]))
+                metrics = klyqa.metrics.bulb(u_id)
+                errors = [getattr(metrics, x) for x in REPLAY_ERRORS]
+                answers = klyqa.trace.recorded
+                klyqa._read_pending(connection)
+                for answer in klyqa.trace.frames()[answers:]:
+                    if answer["type"] != 2:
+                        continue
+                    try:
+                        message = json.loads(answer["payload"])
+                    except ValueError:
+                        message = None
+                    status = BulbStatus.from_response(message)
+                    results.append(
+                        {
+                            "time": frame["time"],
+                            "u_id": u_id,
+                            "payload": answer["payload"],
+                            "status": status.as_tuple() if status else None,
+                        }
+                    )
+                for name, count in zip(REPLAY_ERRORS, errors):
+                    if getattr(metrics, name) > count:
+                        results.append(
+                            {"time": frame["time"], "u_id": u_id, "error": name}
+                        )
+    finally:
+        klyqa.executor.shutdown()
+    for u_id, connection in connections.items():
+        if connection.rx_buffer:
+            results.append({"u_id": u_id, "error": "incomplete package at the end"})
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replay a Klyqa protocol trace")
+    parser.add_argument("dump", help="json lines file of klyqa.dump_trace")
+    parser.add_argument(
+        "--key",
+        action="append",
+        default=[],
+        help="<local device id>:<aes key hex> of a bulb, repeated per bulb",
+    )
+    args = parser.parse_args()
+    aes_keys = {}
+    for key in args.key:
+        u_id, _, aes_key = key.partition(":")
+        aes_keys[u_id] = bytes.fromhex(aes_key)
+    for replayed in replay(load(args.dump), aes_keys):
+        print(json.dumps(replayed))